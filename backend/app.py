@@ -5,6 +5,10 @@ from src.graph.builder import GraphBuilder
 from src.db_connection.connection import CONNECTION_STRING
 from fastapi import FastAPI
 from src.agent.model_loader import llm, EMBEDDING
+from src.db_connection.vectorstore import vectorstore_registry
+from src.ingestion.pdf_parser import shutdown_executor as shutdown_pdf_parse_pool
+from backend.services.usage_logger import usage_logger
+from backend.services.background_summary import background_summarizer
 from langchain_core.messages import HumanMessage
 import asyncio
 
@@ -16,11 +20,15 @@ import asyncio
 async def lifespan(app: FastAPI):
     """
     Lifespan context manager handles startup and shutdown.
-    - On startup: Initialize checkpointer and build graph
-    - On shutdown: Cleanup happens automatically via async context manager
+    - On startup: Initialize checkpointer, vectorstore pool, usage logger and build graph
+    - On shutdown: Drain usage logger, dispose vectorstore pool + pdf parsing processes, checkpointer cleanup happens via async context manager
     """
     async with AsyncPostgresSaver.from_conn_string(CONNECTION_STRING) as cp:
         await cp.setup()
+        # shared (bounded + health checked) pool used by retriever and document_ingestion PGVector stores
+        await asyncio.to_thread(vectorstore_registry.init_pool)
+        # write-behind token usage logger (bulk inserts, spills to disk if supabase is down)
+        usage_logger.start()
         # wehave to checkpointer and graph instance in app state so that we can access it in route handlers
         app.state.checkpointer = cp
         app.state.graph = GraphBuilder(checkpointer=cp).build_graph()
@@ -51,6 +59,15 @@ async def lifespan(app: FastAPI):
 
         yield
 
+        # flush the usage rows still in the queue before the process exits
+        await usage_logger.stop()
+        # summaries not written yet are dropped (checkpointer is still open for writes in progress)
+        await background_summarizer.stop()
+        # close pooled vectorstore connections on shutdown
+        await asyncio.to_thread(vectorstore_registry.close)
+        # stop the pdf parsing processes (if a large pdf started them)
+        shutdown_pdf_parse_pool()
+
 
 
 app = FastAPI(title="QanoonAI",lifespan=lifespan)
@@ -65,16 +82,18 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],  # /all_threads pagination
 )
 
 
-from backend.routes import threads,chat,auth,audio,settings
+from backend.routes import threads,chat,auth,audio,settings,metrics
 # Binds Router To the Fastapi object
 app.include_router(threads.router)
 app.include_router(chat.router)
 app.include_router(auth.router)
 app.include_router(audio.router)
 app.include_router(settings.router)
+app.include_router(metrics.router)
 
 
 
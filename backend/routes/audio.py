@@ -1,16 +1,18 @@
 from fastapi import HTTPException, UploadFile, Form, File, Request, Depends
 from fastapi.responses import Response
 
-from langchain_core.messages import HumanMessage, AIMessage
 from src.db_connection.connection import supabase_client
 from backend.services.initial_state import prepare_initial_state
+from backend.services.thread_store import thread_preview, utc_now, append_turn, touch_thread
+from backend.services.follow_up_state import prepare_follow_up_state
+from backend.services.background_summary import background_summarizer
 from backend.services.streaming import stream_graph
-from backend.routes.threads import load_thread_messages
 
 from backend.routes.auth import get_current_user  # for user authentication
 from fastapi import APIRouter
 
 from fastapi.concurrency import run_in_threadpool
+from postgrest.exceptions import APIError
 import time
 import os
 import tempfile
@@ -101,16 +103,18 @@ async def ask_question_audio(
             "thread_id": thread_id,
             "doc_ids": doc_ids,  
             "user_id": user.id,
-            "messages": [
-                {"role": "human", "content": question},
-                {"role": "ai", "content": answer}
-                ]
+            "preview": thread_preview(question),  # sidebar preview (/all_threads never reads messages)
+            "updated_at": utc_now(),
             }).execute()
             )
+            # first turn of the thread (seq 1 and 2) in the append-only message store (after the row, thread_id is a foreign key)
+            await append_turn(thread_id, user.id, 0, question, answer)
             print("Thread upserted successfully in ask/audio endpoint.")
 
         except asyncio.TimeoutError:
             print("Supbase timeout error while upserting thread data")
+        except APIError as e:
+            print(f"Supabase rejected the thread write while upserting thread data ({e.code}: {e.message})")
 
 
      # schedule token usage logging in database in background task
@@ -161,35 +165,14 @@ async def follow_up_audio(
     print("Transcribed audio to text:", question)
 
 
-    # Load previous messages for the selected thread
-    previous_messages, doc_ids, summary = await load_thread_messages(thread_id, user.id)
+    # only the new question goes into the graph, the conversation itself comes from the checkpointer
+    # (falls back to the thread_messages store for threads without a checkpoint, see backend/services/follow_up_state.py)
+    graph = request.app.state.graph
+    state, doc_ids = await prepare_follow_up_state(graph, thread_id, user.id, question)
 
     if not doc_ids:
         raise HTTPException(status_code=404, detail="No documents found for this thread")
 
-    # Use user-based collection name for multi-PDF support
-    collection_name = f"user_{user.id}"
-
-    # Build messages list with context
-    messages = []
-    for m in previous_messages:
-        if m["role"] == "human":
-            messages.append(HumanMessage(content=m["content"]))
-        else:
-            messages.append(AIMessage(content=m["content"]))
-
-    messages.append(HumanMessage(content=question))
-
-    # Prepare state for the graph
-    state = {
-        "user_id": user.id,
-        "doc_ids": doc_ids,  # Changed to doc_ids array
-        "collection_name": collection_name,
-        "summary": summary or "",
-        "messages": messages,
-        "vectorstore_uploaded": True
-    }
-
     start_time = time.time()
 
     # Callback to update database after streaming completes
@@ -200,28 +183,21 @@ async def follow_up_audio(
 
 
         #UPDATE THREAD
-        # first apppend the new ai message in state["messages"]
-        state["messages"].append(AIMessage(content=answer))
-        clean_messages = [
-                {"role":"human","content":m.content}
-                if isinstance(m, HumanMessage)
-                else {"role":"ai","content":m.content}
-                for m in state["messages"]
-        ]
-        # here we will use update insted of upsert as the thread already exist we just need to update the messages field
+        # append ONLY the new question + answer (one insert), bump updated_at (+ summary if this turn made one)
         try:
-            
-            await run_in_threadpool(
-                lambda:supabase_client.table("threads")
-                .update({
-                "messages": clean_messages,
-                "summary": final_state.get("summary", state.get("summary", ""))
-                })
-                .eq("thread_id", thread_id).execute())
+            await asyncio.gather(
+                append_turn(thread_id, user.id, None, question, answer),
+                touch_thread(thread_id, final_state.get("summary")),
+            )
             print("Thread updated successfully in follow_up endpoint.")
 
         except asyncio.TimeoutError:
             print("Supbase timeout error while updating thread data")
+        except APIError as e:
+            print(f"Supabase rejected the thread write while updating thread data ({e.code}: {e.message})")
+
+        # conversation summary (if due) runs after the stream is closed, not before the done event
+        background_tasks.add_task(background_summarizer.schedule, graph, thread_id)
 
         
         token_usage = final_state.get("token_usage")
@@ -236,7 +212,6 @@ async def follow_up_audio(
             print(f"token logged to supbase in follow up endpoint")
 
     config = {"configurable": {"thread_id": thread_id}}
-    graph = request.app.state.graph
 
     # we can not store stream_graph in variable as it is streaming response 
     return await stream_graph(graph, state, config, on_complete, thread_id=thread_id,first_message=question)
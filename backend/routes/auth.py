@@ -1,6 +1,6 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from src.db_connection.connection import supabase_client
+from backend.services.jwt_auth import authenticator, InvalidToken
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,25 +12,25 @@ router = APIRouter()
 # and enables the "Authorize" button in Swagger UI.
 security = HTTPBearer()
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def get_current_user(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
     """
     Validates the Bearer token from the Authorization header.
     Returns the user object if valid, raises 401 otherwise.
     Compatible with both Frontend and Swagger UI.
+
+    Token is verified locally (cached per token until it expires), Supabase is only asked when
+    it can not be verified locally (see backend/services/jwt_auth.py).
+    The user is stored in request.state.user so prepare_initial_state does not resolve it again.
     """
     token = credentials.credentials
 
     try:
-        # Verify token with Supabase
-        user = supabase_client.auth.get_user(token)
-    except Exception as e:
-        # Handle cases where Supabase client raises an error (e.g. network)
-        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-
-    if not user or not user.user:
+        user = await authenticator.resolve(token)
+    except InvalidToken:
         raise HTTPException(status_code=401, detail="Invalid token or expired session")
 
-    return user.user
+    request.state.user = user
+    return user
 
 
 # for local testing we have to run the fronend then login then go to 
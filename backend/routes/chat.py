@@ -1,14 +1,16 @@
 from fastapi import HTTPException, UploadFile, Form, File, Request,Depends
-from langchain_core.messages import HumanMessage, AIMessage
 from src.db_connection.connection import supabase_client
 from backend.services.initial_state import prepare_initial_state
+from backend.services.thread_store import thread_preview, utc_now, append_turn, touch_thread
+from backend.services.follow_up_state import prepare_follow_up_state
+from backend.services.background_summary import background_summarizer
 from backend.services.streaming import stream_graph
-from backend.routes.threads import load_thread_messages
 
 from backend.routes.auth import get_current_user  # for user authentication
 from fastapi import APIRouter
 
 from fastapi.concurrency import run_in_threadpool
+from postgrest.exceptions import APIError
 import time
 import asyncio
 from backend.services.token_limit import check_token_limit
@@ -51,16 +53,18 @@ async def ask_question(
                 "thread_id": thread_id,
                 "doc_ids": doc_ids,
                 "user_id":user.id, # add supbase user id for auth
-                "messages": [
-                    {"role": "human", "content": question},
-                    {"role": "ai", "content": answer}
-                ],
+                "preview": thread_preview(question),  # sidebar preview (/all_threads never reads messages)
+                "updated_at": utc_now(),
                 "summary": final_state.get("summary", "")  # Save summary(just for consitency as ask endpoint never create summary it only trigger when first message is sent)
             }).execute())
+            # first turn of the thread (seq 1 and 2) in the append-only message store (after the row, thread_id is a foreign key)
+            await append_turn(thread_id, user.id, 0, question, answer)
             print("Thread upserted successfully in ask endpoint.")
 
         except asyncio.TimeoutError:
             print("Supbase timeout error while upserting thread data")
+        except APIError as e:
+            print(f"Supabase rejected the thread write while upserting thread data ({e.code}: {e.message})")
 
         # schedule token usage logging in database in background task
         token_usage = final_state.get("token_usage")
@@ -110,54 +114,14 @@ async def follow_up(
     await check_token_limit(user.id)
 
 
-    # first we will load previous message for the seelcted thread id that user had previously used
-    previous_messages, doc_ids,summary = await load_thread_messages(thread_id,user.id)
-
+    # only the new question goes into the graph, the conversation itself comes from the checkpointer
+    # (falls back to the thread_messages store for threads without a checkpoint, see backend/services/follow_up_state.py)
+    graph = request.app.state.graph  # we fetch the graph instance from app state
+    state, doc_ids = await prepare_follow_up_state(graph, thread_id, user.id, question)
 
     if not doc_ids:
         raise HTTPException(status_code=404, detail="No documents found for this thread")
 
-    # Use user-based collection name for multi-PDF support
-    collection_name = f"user_{user.id}"
-
-
-    messages = []
-    # we will append previous message + new message in the messages list  to provide the contet to the model
-    # as our query_rewiter node use previous context to rewrite the query so we have to pass aprevious msg along with new quesiton to get contextuall aware query
-    for m in previous_messages:
-        if m["role"] == "human":
-            messages.append(HumanMessage(content=m["content"]))
-        else:
-            messages.append(AIMessage(content=m["content"]))
-
-    # we will append the new quesion in th messages list
-    messages.append(HumanMessage(content=question))
-
-    # Fetch custom prompt for this user
-    custom_prompt = None
-    try:
-        settings_response = await run_in_threadpool(
-            lambda: supabase_client.table("user_settings")
-                .select("custom_prompt")
-                .eq("user_id", str(user.id))
-                .limit(1)
-                .execute()
-        )
-        if settings_response.data and len(settings_response.data) > 0:
-            custom_prompt = settings_response.data[0].get("custom_prompt")
-    except Exception:
-        pass  # Use default prompt if fetch fails
-
-    # now we will pass the state to the graph
-    state = {
-        "user_id": user.id,   # unique user id from supbase
-        "doc_ids": doc_ids,  # which doc_id we are using
-        "collection_name": collection_name,  # which vectorstore collection to use,
-        "summary": summary or " ", # previous summary of the document if exist
-        "messages": messages, # list of all previous messages + new question(to provide context to the model)
-        "vectorstore_uploaded": True, # PDF already ingested, skip document ingestion
-        "custom_prompt": custom_prompt  # User's custom prompt (None = use default)
-    }
     start_time = time.time()  # start timer before streaming
 
     # after streaming is done we need to append the new question and answer to the previous messages and update the database
@@ -168,29 +132,21 @@ async def follow_up(
 
         
         #UPDATE THREAD
-        # first apppend the new ai message in state["messages"]
-        state["messages"].append(AIMessage(content=answer))
-        clean_messages = [
-                {"role":"human","content":m.content}
-                if isinstance(m, HumanMessage)
-                else {"role":"ai","content":m.content}
-                for m in state["messages"]
-        ]
-        # here we will use update insted of upsert as the thread already exist we just need to update the messages field
+        # append ONLY the new question + answer (one insert), bump updated_at (+ summary if this turn made one)
         try:
-            
-            await run_in_threadpool(
-                lambda:supabase_client
-                .table("threads")
-                .update({
-                "messages": clean_messages,
-                "summary": final_state.get("summary", state.get("summary", ""))
-                })
-                .eq("thread_id", thread_id).execute())
+            await asyncio.gather(
+                append_turn(thread_id, user.id, None, question, answer),
+                touch_thread(thread_id, final_state.get("summary")),
+            )
             print("Thread updated successfully in follow_up endpoint.")
 
         except asyncio.TimeoutError:
             print("Supbase timeout error while updating thread data")
+        except APIError as e:
+            print(f"Supabase rejected the thread write while updating thread data ({e.code}: {e.message})")
+
+        # conversation summary (if due) runs after the stream is closed, not before the done event
+        background_tasks.add_task(background_summarizer.schedule, graph, thread_id)
 
 
         # Schedule token usage logging as background task
@@ -206,8 +162,6 @@ async def follow_up(
             print(f"token logged to supbase in follow up endpoint")
 
     config = {"configurable": {"thread_id": thread_id}}
-
-    graph = request.app.state.graph  # we fetch the graph instance from app state
     return await stream_graph(graph, state, config, on_complete)
     
 
@@ -221,9 +175,8 @@ async def follow_up(
 
 
 # ===================== Add PDF to Existing Thread =====================
-from src.utils.file_hash import get_file_hash
+from backend.services.upload_sink import save_upload
 from pathlib import Path
-import aiofiles
 
 UPLOAD_DIR = Path("uploaded_docs")
 
@@ -243,15 +196,9 @@ async def add_pdf_to_thread(
     3. Add doc_id to thread's doc_ids array
     4. Trigger document ingestion (Background Task)
     """
-    # Save PDF
+    # Save PDF, doc_id (sha256 of the content) is computed while writing
     pdf_path = UPLOAD_DIR / pdf.filename
-    async with aiofiles.open(pdf_path, "wb") as f:
-        while chunk := await pdf.read(1024 * 1024):
-            await f.write(chunk)
-    
-    # Generate doc_id with user-based collection
-    # Run hashing in threadpool to avoid blocking event loop
-    new_doc_id = await run_in_threadpool(get_file_hash, str(pdf_path))
+    new_doc_id = await save_upload(pdf, pdf_path)
     collection_name = f"user_{user.id}"  # User-based collection for multi-PDF
     
     # Get existing thread to retrieve current doc_ids
@@ -289,6 +236,7 @@ async def add_pdf_to_thread(
         "user_id": user.id,
         "documents_path": str(pdf_path),
         "doc_ids": [new_doc_id],  # Only the new doc for ingestion check
+        "documents_paths": {new_doc_id: str(pdf_path)},
         "collection_name": collection_name,
         "messages": [],  # No messages, just ingestion
         "summary": "",
@@ -316,4 +264,18 @@ async def add_pdf_to_thread(
         "message": message,
         "doc_id": new_doc_id,
         "doc_ids": updated_doc_ids
-    }
\ No newline at end of file
+    }
+
+
+# ===================== Ingestion Status Endpoint =====================
+from src.ingestion.tracker import ingestion_tracker
+
+@router.get("/ingestion_status")
+async def ingestion_status(doc_ids: str | None = None, user=Depends(get_current_user)):
+    """
+    Status + progress of this user's document ingestions (queued / running / completed / failed).
+    Frontend can poll it after /add_pdf returns "processing_started".
+    doc_ids = optional comma separated filter
+    """
+    wanted = [d for d in doc_ids.split(",") if d] if doc_ids else None
+    return {"documents": ingestion_tracker.get(user.id, wanted)}
@@ -0,0 +1,41 @@
+from fastapi import APIRouter, Depends
+from backend.routes.auth import get_current_user
+from src.cache.bm25_cache import bm25_cache
+from src.db_connection.vectorstore import vectorstore_registry
+from src.graph.grader import grading_stats
+from src.graph.speculative import speculation_stats
+from src.graph.rewrite_gate import rewrite_gate
+from src.graph.context_packer import context_packer
+from src.agent.model_loader import EMBEDDING
+from src.cache.answer_cache import answer_cache
+from src.graph.builder import nodes
+from src.cache.chunk_embedding_store import chunk_embedding_store
+from backend.services.jwt_auth import authenticator
+from backend.services.token_limit import token_quota
+from backend.services.usage_logger import usage_logger
+from backend.services.background_summary import background_summarizer
+
+router = APIRouter()
+
+
+# ============================= Runtime metrics =============================
+# counters are per worker process (each uvicorn worker has its own caches)
+@router.get("/metrics")
+async def get_metrics(user=Depends(get_current_user)):
+    """Cache / pool counters of this worker for debugging latency"""
+    return {
+        "bm25_cache": bm25_cache.stats(),
+        "vectorstore_pool": vectorstore_registry.stats(),
+        "crag_grading": grading_stats.stats(),
+        "speculative_retrieval": speculation_stats.stats(),
+        "rewrite_gate": rewrite_gate.stats(),
+        "context_packing": context_packer.stats(),
+        "embedding_cache": EMBEDDING.stats(),
+        "answer_cache": answer_cache.stats(),
+        "embedding_uploader": nodes.embedding_uploader.stats(),
+        "chunk_embedding_store": chunk_embedding_store.stats(),
+        "auth": authenticator.stats(),
+        "token_quota": token_quota.stats(),
+        "usage_logger": usage_logger.stats(),
+        "background_summary": background_summarizer.stats(),
+    }
@@ -12,27 +12,34 @@ class PromptUpdate(BaseModel):
     custom_prompt: Optional[str] = None
 
 
+class AnswerCacheUpdate(BaseModel):
+    enabled: bool
+
+
 @router.get("/settings")
 async def get_settings(user=Depends(get_current_user)):
     """Get user settings including custom prompt"""
     try:
         response = await run_in_threadpool(
             lambda: supabase_client.table("user_settings")
-                .select("custom_prompt")
+                .select("*")
                 .eq("user_id", str(user.id))
                 .limit(1)
                 .execute()
         )
         
         custom_prompt = None # default value
+        answer_cache_enabled = True # default value
         if response.data and len(response.data) > 0:
             custom_prompt = response.data[0].get("custom_prompt")
+            answer_cache_enabled = response.data[0].get("answer_cache_enabled") is not False
         
-        # it return thises 3 values and we display them in frontend
+        # it return thises values and we display them in frontend
         return {
             "email": user.email,
             "user_id": str(user.id),
-            "custom_prompt": custom_prompt
+            "custom_prompt": custom_prompt,
+            "answer_cache_enabled": answer_cache_enabled
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -72,3 +79,21 @@ async def reset_prompt(user=Depends(get_current_user)):
         return {"success": True, "message": "Prompt reset to default"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/settings/answer_cache")
+async def set_answer_cache(data: AnswerCacheUpdate, user=Depends(get_current_user)):
+    """Opt in / out of the shared semantic answer cache"""
+    try:
+        await run_in_threadpool(
+            lambda: supabase_client.table("user_settings")
+                .upsert({
+                    "user_id": str(user.id),
+                    "answer_cache_enabled": data.enabled,
+                    "updated_at": "now()"
+                })
+                .execute()
+        )
+        return {"success": True, "answer_cache_enabled": data.enabled}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
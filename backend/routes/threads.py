@@ -1,63 +1,52 @@
-from fastapi import HTTPException,Depends
+import asyncio
+from fastapi import HTTPException,Depends,Query,Response
 from src.db_connection.connection import supabase_client
 from fastapi import APIRouter
 from backend.routes.auth import get_current_user
+from backend.services.thread_store import list_threads, load_thread, load_messages, THREADS_PAGE_MAX
 
 router = APIRouter()
 
 # ============================= Load Thread Messages =============================
 
-async def load_thread_messages(thread_id: str,user_id:str):
-    response = (
-        await run_in_threadpool(
-        lambda:supabase_client
-        .table("threads")
-        .select("messages, doc_ids,summary")
-        .eq("thread_id", thread_id)
-        .eq("user_id",user_id)   # filter by login user id
-        .single()
-        .execute()
-    ))
-    if not response.data:
-        raise HTTPException(status_code=404, detail="Thread not found")
-
-    return response.data["messages"], response.data["doc_ids"],response.data.get("summary","")
+async def load_thread_messages(thread_id: str,user_id:str,last_n:int | None = None):
+    """
+    messages (from the append-only thread_messages store), doc_ids and summary of a thread.
+    last_n = only the last n messages (follow-ups), None = the whole thread (chat window)
+    """
+    # thread row (no messages column anymore) and the messages are two independent queries
+    thread, messages = await asyncio.gather(
+        load_thread(thread_id, user_id),
+        load_messages(thread_id, user_id, last_n),
+    )
+    return messages, thread["doc_ids"],thread.get("summary","")
 
 
 
 # ============================= Get All Threads with Previews =============================
 # sidebar chats threads
+# newest first. Without `limit` every thread is returned (what the frontend does today, no paging there).
+# With `limit`: one page, the body stays a list and the cursor of the next page is sent in the
+# X-Next-Cursor header (absent on the last page).
 @router.get("/all_threads")
-async def get_all_threads(user=Depends(get_current_user)):
-    """Get all threads with previews"""
+async def get_all_threads(
+    response: Response,
+    limit: int | None = Query(None, ge=1, le=THREADS_PAGE_MAX),
+    cursor: str | None = None,
+    user=Depends(get_current_user)
+):
+    """Get one page of threads with previews (no messages are loaded)"""
     try:
-        response = (
-            await run_in_threadpool(
-            lambda:supabase_client
-            .table("threads")
-            .select("thread_id, doc_ids, messages")
-            .eq("user_id",user.id)  # filter by login user
-            .execute()
-        ))
-        
-        threads = []
-        if response.data:
-            for thread in response.data:
-                messages = thread.get("messages", [])
-                preview = "New Chat"
-                if messages and len(messages) > 0:
-                    preview = messages[0].get("content", "New Chat")[:50] + "..."
-                
-                threads.append({
-                    "thread_id": thread["thread_id"],
-                    "doc_ids": thread["doc_ids"],
-                    "preview": preview
-                })
-        
-        return threads
+        threads, next_cursor = await list_threads(user.id, limit, cursor)
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error fetching threads: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return threads
     
 
 
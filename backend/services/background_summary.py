@@ -0,0 +1,135 @@
+import time
+import asyncio
+import contextlib
+from src.graph.builder import nodes, SUMMARY_MODE
+from backend.services.thread_store import save_summary
+
+# ============================= Background conversation summary =============================
+# Before: when should_summzarizer fired, summarize ran after agent_response in the SAME graph run, so the SSE
+# done event and the on_complete db writes waited for one more LLM call.
+#
+# Now (SUMMARY_MODE=background, default) the answer run ends at agent_response. /follow_up schedules the summary
+# as a background task once the stream is closed:
+#   1. read the thread's checkpoint, stop if should_summzarizer is False
+#   2. summary LLM call (nodes.summary_creation)
+#   3. write it back as the summarize node (graph.aupdate_state: summary + RemoveMessage of the summarized messages)
+#      and to the threads row (FOLLOW_UP_STATE_SOURCE=threads fallback reads it there)
+# Next question of the same thread before the summary is written (claim() in prepare_follow_up_state):
+#   - LLM call still running → it is cancelled, the turn uses the full message history instead and the summary
+#     scheduled after that turn covers both turns (the user never waits for the summary)
+#   - write already started → wait for it (one checkpoint put, not an LLM call)
+# Tasks are per worker: if the next question lands on another worker, the write still only removes messages that
+# are still in the checkpoint and is dropped if another summary was written in between.
+
+class _Job:
+    __slots__ = ("task", "summarizing", "writing")
+
+    def __init__(self):
+        self.task = None
+        self.summarizing = False  # summary LLM call started (cancelling it wastes that call)
+        self.writing = False  # summary is being written (too late to cancel)
+
+
+class BackgroundSummarizer:
+    def __init__(self, graph_nodes=nodes, mode: str = SUMMARY_MODE):
+        self.nodes = graph_nodes
+        self.mode = mode
+        self._jobs: dict[str, _Job] = {}
+        self.scheduled = 0
+        self.written = 0
+        self.cancelled = 0
+        self.stale = 0
+        self.failed = 0
+        self.latency_ms_total = 0.0
+
+    async def schedule(self, graph, thread_id: str):
+        """start the summary of the thread (async so BackgroundTasks runs it on the event loop)"""
+        if self.mode != "background":
+            return
+        previous = self._jobs.get(thread_id)
+        if previous is not None and not previous.task.done() and not previous.writing:
+            previous.task.cancel()  # the new one covers this turn too
+            self.cancelled += previous.summarizing
+        job = _Job()
+        job.task = asyncio.create_task(self._run(graph, thread_id, job, previous))
+        self._jobs[thread_id] = job
+        self.scheduled += 1
+
+    async def claim(self, thread_id: str):
+        """a new question of the thread arrived: cancel a running summary, only wait for a write in progress"""
+        job = self._jobs.pop(thread_id, None)
+        if job is None or job.task.done():
+            return
+        if job.writing:
+            with contextlib.suppress(Exception):
+                await asyncio.shield(job.task)
+            return
+        job.task.cancel()
+        if job.summarizing:
+            self.cancelled += 1
+            print(f"[SUMMARY] next question of thread {thread_id} came first → summary cancelled")
+
+    async def _run(self, graph, thread_id: str, job: _Job, previous: _Job | None):
+        config = {"configurable": {"thread_id": thread_id}}
+        try:
+            if previous is not None and previous.writing:
+                with contextlib.suppress(Exception):
+                    await asyncio.shield(previous.task)
+
+            snapshot = await graph.aget_state(config)
+            state = dict(snapshot.values)
+            if not state.get("messages") or not self.nodes.should_summzarizer(state):
+                return
+            summary_before = state.get("summary") or ""
+            state["summary"] = summary_before
+
+            start = time.perf_counter()
+            job.summarizing = True
+            update = await self.nodes.summary_creation(state)
+
+            job.writing = True
+            current = (await graph.aget_state(config)).values
+            if (current.get("summary") or "") != summary_before:
+                self.stale += 1  # another summary was written meanwhile (other worker)
+                return
+            # only messages still in the checkpoint (add_messages fails on unknown ids)
+            live_ids = {m.id for m in current.get("messages", [])}
+            removals = [m for m in update["messages"] if m.id in live_ids]
+            await graph.aupdate_state(config, {"summary": update["summary"], "messages": removals}, as_node="summarize")
+            await save_summary(thread_id, update["summary"])
+
+            self.written += 1
+            self.latency_ms_total += (time.perf_counter() - start) * 1000
+            print(f"[SUMMARY] thread {thread_id} summarized in background ({len(removals)} messages folded)")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed += 1
+            print(f"[SUMMARY] background summary of thread {thread_id} failed: {e}")
+        finally:
+            if self._jobs.get(thread_id) is job:
+                del self._jobs[thread_id]
+
+    async def stop(self):
+        """app shutdown: pending summaries are dropped (the next turn schedules them again)"""
+        jobs = list(self._jobs.values())
+        self._jobs.clear()
+        for job in jobs:
+            if not job.writing:
+                job.task.cancel()
+        await asyncio.gather(*(job.task for job in jobs), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "in_flight": len(self._jobs),
+            "scheduled": self.scheduled,
+            "written": self.written,
+            "cancelled": self.cancelled,
+            "stale": self.stale,
+            "failed": self.failed,
+            "latency_ms_avg": round(self.latency_ms_total / self.written, 2) if self.written else 0.0,
+        }
+
+
+background_summarizer = BackgroundSummarizer()
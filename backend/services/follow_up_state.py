@@ -0,0 +1,74 @@
+import os
+import asyncio
+from langchain_core.messages import HumanMessage, AIMessage
+from backend.services.thread_store import load_thread, load_messages, THREAD_CONTEXT_MESSAGES
+from backend.services.user_settings import get_user_settings
+from backend.services.background_summary import background_summarizer
+
+# ============================= Follow-up state =============================
+# Before: every follow-up reloaded the previous messages from the db, rebuilt HumanMessage / AIMessage objects
+# and passed the whole list into the graph. The AsyncPostgresSaver checkpointer already has that conversation
+# under the same thread_id, so add_messages merged the history into itself again (new ids ==> duplicates).
+#
+# Now (FOLLOW_UP_STATE_SOURCE=checkpoint, default) the graph gets ONLY the new HumanMessage; messages and
+# summary come from the checkpoint. The threads row is still read for ownership + doc_ids (/add_pdf changes them)
+# and the thread_messages store is only written (chat window, sidebar).
+# Threads without a checkpoint (created before the checkpointer, or checkpoint tables reset) fall back to the
+# old way: last THREAD_CONTEXT_MESSAGES messages from thread_messages + summary from the threads row.
+# FOLLOW_UP_STATE_SOURCE=threads always uses the fallback.
+
+FOLLOW_UP_STATE_SOURCE = os.environ.get("FOLLOW_UP_STATE_SOURCE", "checkpoint").lower()
+
+
+async def _has_checkpoint(graph, config: dict) -> bool:
+    checkpointer = getattr(graph, "checkpointer", None)
+    if checkpointer is None:
+        return False
+    checkpoint = await checkpointer.aget_tuple(config)
+    return bool(checkpoint and checkpoint.checkpoint.get("channel_values", {}).get("messages"))
+
+
+async def _history_from_threads(thread_id: str, user_id: str) -> list:
+    previous_messages = await load_messages(thread_id, user_id, THREAD_CONTEXT_MESSAGES)
+    return [
+        HumanMessage(content=m["content"]) if m["role"] == "human" else AIMessage(content=m["content"])
+        for m in previous_messages
+    ]
+
+
+async def prepare_follow_up_state(graph, thread_id: str, user_id: str, question: str):
+    """
+    Graph input for a follow-up question. Returns (state, doc_ids).
+    Thread row, checkpoint lookup and user settings are fetched concurrently.
+    """
+    config = {"configurable": {"thread_id": thread_id}}
+    use_checkpoint = FOLLOW_UP_STATE_SOURCE == "checkpoint"
+
+    # summary of the previous turn still running → cancelled (never waited for), so the checkpoint read below
+    # is not raced by its write (see backend/services/background_summary.py)
+    await background_summarizer.claim(thread_id)
+
+    thread, checkpointed, settings = await asyncio.gather(
+        load_thread(thread_id, user_id),  # 404 if the thread is not this user's
+        _has_checkpoint(graph, config) if use_checkpoint else asyncio.sleep(0, False),
+        get_user_settings(user_id),
+    )
+
+    state = {
+        "user_id": user_id,   # unique user id from supbase
+        "doc_ids": thread["doc_ids"],  # which doc_id we are using (may have changed through /add_pdf)
+        "collection_name": f"user_{user_id}",  # user-based collection name for multi-PDF support
+        "vectorstore_uploaded": True, # PDF already ingested, skip document ingestion
+        "custom_prompt": settings["custom_prompt"],  # User's custom prompt (None = use default)
+        "answer_cache_enabled": settings["answer_cache_enabled"]  # per user answer cache opt out
+    }
+
+    if checkpointed:
+        # add_messages appends it to the checkpointed conversation (summary also comes from the checkpoint)
+        state["messages"] = [HumanMessage(content=question)]
+    else:
+        print(f"No checkpoint for thread {thread_id} → rebuilding the conversation from thread_messages")
+        state["messages"] = await _history_from_threads(thread_id, user_id) + [HumanMessage(content=question)]
+        state["summary"] = thread.get("summary") or " "  # previous summary of the conversation if exist
+
+    return state, thread["doc_ids"]
@@ -1,10 +1,13 @@
-from src.utils.file_hash import get_file_hash
 import uuid
-import aiofiles
+import asyncio
 from pathlib import Path
 from langchain_core.messages import HumanMessage
 from src.db_connection.connection import supabase_client
 from fastapi import Request, HTTPException
+from backend.services.user_settings import get_user_settings
+from backend.services.upload_sink import hash_upload, persist_upload
+from backend.services.jwt_auth import authenticator, InvalidToken
+from fastapi.concurrency import run_in_threadpool
 
 UPLOAD_DIR = Path("uploaded_docs")
 UPLOAD_DIR.mkdir(exist_ok=True, parents=True)
@@ -35,60 +38,83 @@ def get_access_token_from_request(request: Request) -> str:
 
 
 
+async def is_doc_ingested(user_id: str, doc_id: str) -> bool:
+    """True if this user already has chunks of this pdf (same query as the check_pdf node)"""
+    response = await run_in_threadpool(
+        lambda: supabase_client.table("documents")
+            .select("doc_id")
+            .eq("doc_id", doc_id)
+            .eq("user_id", user_id)
+            .limit(1)
+            .execute()
+    )
+    return bool(response.data)
+
+
+
 # Initail state for the graph
 async def prepare_initial_state(pdf, question: str, request: Request):
     """ 
     Prepares the state for RAG graph.
-    - Saves PDF
-    - Generates doc_id
-    - Gets user_id from Supabase access token
+    - Hashes the uploaded PDF (doc_id)
+    - Gets user_id from the user resolved by get_current_user (request.state.user)
+    - Checks ONCE if the user already has this PDF:
+        yes → bytes are discarded, graph goes straight to query_rewriter (no disk write, no parsing)
+        no  → PDF is saved to uploaded_docs/ for document_ingestion
     """
-    # path to store uploaded pdf
-    pdf_path = UPLOAD_DIR / pdf.filename
+    # sha256 of the content (= doc_id), computed on the upload spool without writing anything
+    doc_id = await hash_upload(pdf)
 
-    # load the pdf as async
-    async with aiofiles.open(pdf_path, "wb") as f:
-        while chunk := await pdf.read(1024 * 1024):
-            await f.write(chunk)
-
-    # generate doc_id, thread id
-    doc_id = get_file_hash(str(pdf_path))  # generate unique doc id based on file content using get_file_hash funciton
+    # generate thread id
     thread_id = str(uuid.uuid4())  # genearate thread id for the conversation
 
-    # Extract access token(JWT) from request headers
-    access_token = get_access_token_from_request(request)
-
-    # Get user info from Supabase
-    user_response = supabase_client.auth.get_user(access_token)
-    user_id = user_response.user.id
+    # user already resolved by get_current_user for this request (no second verification)
+    user = getattr(request.state, "user", None)
+    if user is None:
+        # Extract access token(JWT) from request headers
+        access_token = get_access_token_from_request(request)
+        try:
+            user = await authenticator.resolve(access_token)
+        except InvalidToken:
+            raise HTTPException(status_code=401, detail="Invalid token or expired session")
+    user_id = user.id
     
     # Use user-based collection name for multi-PDF support
     collection_name = f"user_{user_id}"
 
-    # Fetch custom prompt for this user (if exists)
-    custom_prompt = None
-    try:
-        settings_response = supabase_client.table("user_settings") \
-            .select("custom_prompt") \
-            .eq("user_id", str(user_id)) \
-            .limit(1) \
-            .execute()
-        if settings_response.data and len(settings_response.data) > 0:
-            custom_prompt = settings_response.data[0].get("custom_prompt")
-    except Exception:
-        pass  # Use default prompt if fetch fails
+    # existence check + custom prompt / answer cache opt out (if exists) at the same time
+    already_ingested, settings = await asyncio.gather(
+        is_doc_ingested(user_id, doc_id),
+        get_user_settings(user_id)
+    )
     
     # Prepare state
     state = {
         "user_id": user_id,   # unique user id from supbase
-        "documents_path": str(pdf_path),
         "doc_ids": [doc_id],  # array of doc_ids for multi-PDF support
         "collection_name": collection_name,
         "messages": [HumanMessage(content=question)],
         "summary": "",
-        "custom_prompt": custom_prompt  # User's custom prompt (None = use default)
+        "custom_prompt": settings["custom_prompt"],  # User's custom prompt (None = use default)
+        "answer_cache_enabled": settings["answer_cache_enabled"]  # per user answer cache opt out
     }
 
+    if already_ingested:
+        # fast path: check_pdf skips its query and the graph goes straight to query_rewriter
+        print("Pdf already exist in supbase skipping upload + documnet ingesion...")
+        state.update({"vectorstore_uploaded": True, "existing_doc_ids": [doc_id], "new_doc_ids": []})
+    else:
+        # path to store uploaded pdf
+        pdf_path = UPLOAD_DIR / pdf.filename
+        await persist_upload(pdf, pdf_path)
+        state.update({
+            "documents_path": str(pdf_path),
+            "documents_paths": {doc_id: str(pdf_path)},  # doc_id -> pdf path for ingestion
+            "vectorstore_uploaded": False,
+            "existing_doc_ids": [],
+            "new_doc_ids": [doc_id],  # already checked, check_pdf does not query again
+        })
+
     return state, thread_id, [doc_id]  # Changed: return array
 
 
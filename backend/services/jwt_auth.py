@@ -0,0 +1,220 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import jwt
+from fastapi.concurrency import run_in_threadpool
+
+from src.db_connection.connection import supabase_client, SUPABASE_URL
+
+# ============================ Local JWT verification ============================
+# Before: every request called supabase_client.auth.get_user(token) (sync network call ON the event loop)
+# and /ask did it a second time in prepare_initial_state.
+#
+# Now:
+# 1. decoded user is memoized per token until the token expires (most requests stop here)
+# 2. else the JWT is verified locally:
+#    - HS256 tokens with the project JWT secret (SUPABASE_JWT_SECRET)
+#    - RS256 / ES256 tokens with the project signing keys (JWKS from SUPABASE_URL, cached by PyJWKClient)
+# 3. only when it can not be verified locally (no secret configured, unknown key, JWKS down) we ask Supabase
+#    (in the threadpool) like before.
+# Bad signature / expired token ==> 401 directly, Supabase would say the same.
+#
+# Note: a locally verified token stays valid until its exp (1 hour by default in Supabase) even after logout.
+
+SUPABASE_JWT_SECRET = os.environ.get("SUPABASE_JWT_SECRET") or os.environ.get("JWT_SECRET", "")
+SUPABASE_JWT_AUDIENCE = os.environ.get("SUPABASE_JWT_AUDIENCE", "authenticated")
+AUTH_CACHE_MAX_ENTRIES = int(os.environ.get("AUTH_CACHE_MAX_ENTRIES", "10000"))
+AUTH_REMOTE_CACHE_TTL_S = int(os.environ.get("AUTH_REMOTE_CACHE_TTL_S", "300"))  # cap for remotely verified users
+JWT_LEEWAY_S = int(os.environ.get("JWT_LEEWAY_S", "30"))  # clock skew allowed on exp / iat
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class AuthUser:
+    """The fields of the supabase User we use, built from the JWT claims (routes only need user.id)."""
+
+    def __init__(self, id: str, email: str | None = None, role: str | None = None,
+                 app_metadata: dict | None = None, user_metadata: dict | None = None):
+        self.id = id
+        self.email = email
+        self.role = role
+        self.app_metadata = app_metadata or {}
+        self.user_metadata = user_metadata or {}
+
+    @classmethod
+    def from_claims(cls, claims: dict) -> "AuthUser":
+        return cls(
+            id=claims["sub"],
+            email=claims.get("email"),
+            role=claims.get("role"),
+            app_metadata=claims.get("app_metadata"),
+            user_metadata=claims.get("user_metadata"),
+        )
+
+    def __repr__(self):
+        return f"AuthUser(id={self.id!r}, email={self.email!r})"
+
+
+class CannotVerifyLocally(Exception):
+    """token may be fine, but we do not have the key for it ==> remote verification"""
+
+
+class JWTVerifier:
+    def __init__(
+        self,
+        jwt_secret: str = SUPABASE_JWT_SECRET,
+        jwks_url: str | None = f"{SUPABASE_URL.rstrip('/')}/auth/v1/.well-known/jwks.json" if SUPABASE_URL else None,
+        audience: str = SUPABASE_JWT_AUDIENCE,
+        leeway_s: int = JWT_LEEWAY_S,
+    ):
+        self.jwt_secret = jwt_secret
+        self.audience = audience
+        self.leeway_s = leeway_s
+        # PyJWKClient caches the key set (and each key by kid), so JWKS is fetched once per lifespan
+        self.jwks_client = jwt.PyJWKClient(jwks_url, cache_jwk_set=True, lifespan=3600) if jwks_url else None
+
+    def _key_for(self, token: str):
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.PyJWTError as e:
+            raise InvalidToken(str(e))
+        alg = header.get("alg")
+        if alg == "HS256":
+            if not self.jwt_secret:
+                raise CannotVerifyLocally("no SUPABASE_JWT_SECRET configured")
+            return self.jwt_secret, alg
+        if alg in ("RS256", "ES256"):
+            if self.jwks_client is None:
+                raise CannotVerifyLocally("no JWKS url configured")
+            try:
+                return self.jwks_client.get_signing_key_from_jwt(token).key, alg
+            except jwt.PyJWKClientError as e:
+                raise CannotVerifyLocally(str(e))
+        raise InvalidToken(f"unsupported alg {alg}")
+
+    def verify(self, token: str) -> dict:
+        """claims of a valid token. InvalidToken if it is not valid, CannotVerifyLocally if we can not tell."""
+        key, alg = self._key_for(token)  # JWKS fetch (first time) is blocking: call verify from the threadpool
+        try:
+            return jwt.decode(
+                token,
+                key,
+                algorithms=[alg],
+                audience=self.audience,
+                leeway=self.leeway_s,
+                options={"require": ["exp", "sub"]},
+            )
+        except jwt.PyJWTError as e:
+            raise InvalidToken(str(e))
+
+
+class TokenUserCache:
+    """token hash -> (user, expires_at), LRU bounded"""
+
+    def __init__(self, max_entries: int = AUTH_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple[AuthUser, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(token: str) -> str:
+        # tokens are never kept in memory as is
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token: str):
+        key = self.key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return user
+
+    def set(self, token: str, user, expires_at: float):
+        with self._lock:
+            self._entries[self.key(token)] = (user, expires_at)
+            self._entries.move_to_end(self.key(token))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Authenticator:
+    def __init__(self, verifier: JWTVerifier | None = None, cache: TokenUserCache | None = None, remote_client=supabase_client):
+        self.verifier = verifier or JWTVerifier()
+        self.cache = cache if cache is not None else TokenUserCache()
+        self.remote_client = remote_client
+        self._lock = threading.Lock()
+        self.cached = 0
+        self.local = 0
+        self.remote = 0
+        self.rejected = 0
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _remote(self, token: str):
+        response = self.remote_client.auth.get_user(token)
+        return response.user if response else None
+
+    async def resolve(self, token: str):
+        """user for this token (AuthUser when verified locally, supabase User when verified remotely)"""
+        user = self.cache.get(token)
+        if user is not None:
+            self._count("cached")
+            return user
+
+        try:
+            claims = await run_in_threadpool(self.verifier.verify, token)
+            user = AuthUser.from_claims(claims)
+            self.cache.set(token, user, float(claims["exp"]))
+            self._count("local")
+            return user
+        except InvalidToken:
+            self._count("rejected")
+            raise
+        except CannotVerifyLocally as e:
+            print(f"JWT can not be verified locally ({e}) → verifying with Supabase")
+
+        try:
+            user = await run_in_threadpool(self._remote, token)
+        except Exception as e:
+            self._count("rejected")
+            raise InvalidToken(str(e))
+        if not user:
+            self._count("rejected")
+            raise InvalidToken("Invalid token or expired session")
+
+        # cache until the token expires (read without verification, Supabase just accepted it)
+        try:
+            exp = float(jwt.decode(token, options={"verify_signature": False}).get("exp", 0))
+        except jwt.PyJWTError:
+            exp = 0
+        self.cache.set(token, user, min(exp or float("inf"), time.time() + AUTH_REMOTE_CACHE_TTL_S))
+        self._count("remote")
+        return user
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "cached": self.cached,
+                "local": self.local,
+                "remote": self.remote,
+                "rejected": self.rejected,
+                "entries": len(self.cache),
+            }
+
+
+# process wide authenticator used by get_current_user
+authenticator = Authenticator()
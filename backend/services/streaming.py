@@ -1,15 +1,179 @@
-import json, asyncio
+import json, asyncio, re, os
 from fastapi.responses import StreamingResponse
+from langchain_core.messages import AIMessageChunk
 import time
 
+try:
+    import orjson  # ~5-10x faster than json.dumps for these small frames
+except ImportError:  # optional: fall back to the standard library encoder
+    orjson = None
+
+
+
+# ===================== Coalesced SSE frames =====================
+# Before: json.dumps + one SSE frame + await asyncio.sleep(0) for EVERY model token
+# (hundreds of frames / syscalls per answer, per stream).
+#
+# Now tokens are buffered and sent as one {"token": "..."} frame when
+#   - STREAM_FLUSH_INTERVAL_MS passed since the last frame, or
+#   - STREAM_FLUSH_BYTES of text are waiting
+# The FIRST token is always sent immediately (time to first token does not change), and whatever is left is
+# flushed before on_complete / the done event. The frontend already appends data.token, so nothing changes there.
+# The buffer is checked on every graph event, so text waits at most until the next event (or the end of the answer).
+# STREAM_FLUSH_INTERVAL_MS=0 and STREAM_FLUSH_BYTES=0 ==> one frame per token like before.
+# Benchmark: python -m src.testing_locally.stream_benchmark
+
+STREAM_FLUSH_INTERVAL_MS = float(os.environ.get("STREAM_FLUSH_INTERVAL_MS", "40"))
+STREAM_FLUSH_BYTES = int(os.environ.get("STREAM_FLUSH_BYTES", "256"))
+
+
+def sse_frame(payload: dict) -> bytes:
+    """one SSE message: data: <json>\n\n (the double newline ends the event)"""
+    if orjson is not None:
+        return b"data: " + orjson.dumps(payload) + b"\n\n"
+    return f"data: {json.dumps(payload)}\n\n".encode("utf-8")
+
+
+class TokenCoalescer:
+    """Buffers streamed tokens and decides when they go out as one frame."""
+
+    def __init__(self, flush_interval_ms: float = STREAM_FLUSH_INTERVAL_MS, flush_bytes: int = STREAM_FLUSH_BYTES):
+        self.flush_interval_s = flush_interval_ms / 1000
+        self.flush_bytes = flush_bytes
+        self._parts: list[str] = []
+        self._size = 0
+        self._last_flush = None  # None until the first token went out
+        self.frames = 0
+
+    def add(self, token: str) -> bytes | None:
+        """buffer a token, returns a frame if it is time to send"""
+        self._parts.append(token)
+        self._size += len(token)
+        if self._last_flush is None or self._size >= self.flush_bytes:
+            return self.flush()
+        return self.poll()
+
+    def poll(self) -> bytes | None:
+        """frame if buffered text is older than the flush interval (called on every graph event)"""
+        if self._parts and time.monotonic() - self._last_flush >= self.flush_interval_s:
+            return self.flush()
+        return None
+
+    def flush(self) -> bytes | None:
+        if not self._parts:
+            return None
+        text = "".join(self._parts)
+        self._parts.clear()
+        self._size = 0
+        self._last_flush = time.monotonic()
+        self.frames += 1
+        return sse_frame({"token": text})
+
+
+
+
+# ===================== Graph stream sources =====================
+# Before: stream_graph consumed graph.astream_events(version="v2"): start / end / stream events of EVERY runnable in
+# EVERY node (rewriter, grader, summary LLMs, retrievers, prompts ...) and filtered them for agent_response in python.
+#
+# Now (STREAM_SOURCE=modes, default) it uses graph.astream(stream_mode=["messages", "custom"]):
+# - "messages" = chat model token chunks only (kept when they come from the agent_response node)
+# - "custom"   = explicit events the nodes send with emit_stream_event (src/graph/nodes.py):
+#                token_usage (agent_response), summary (summarize), answer_cache_hit (answer_cache_lookup)
+# STREAM_SOURCE=events keeps the old astream_events path (rollback / comparison).
+# Benchmark: python -m src.testing_locally.stream_modes_benchmark
+#
+# Both sources yield the same (kind, value) items:
+#   ("token", str)          token of the answer
+#   ("token_usage", dict)   usage of the answer (logged by on_complete)
+#   ("summary", str)        new conversation summary
+#   ("cached_answer", str)  answer cache hit, no tokens will come
+#   ("tick", None)          anything else (lets the coalescer flush on time)
+
+STREAM_SOURCE = os.environ.get("STREAM_SOURCE", "modes").lower()
+_CUSTOM_KINDS = {"token_usage": "token_usage", "summary": "summary", "answer_cache_hit": "cached_answer"}
+
+
+async def _graph_stream_modes(graph, state, config):
+    async for mode, payload in graph.astream(state, config=config, stream_mode=["messages", "custom"]):
+        if mode == "messages":
+            chunk, metadata = payload
+            # only streamed chunks: the full AIMessage a node returns is re-emitted by the messages mode too
+            if (
+                isinstance(chunk, AIMessageChunk)
+                and metadata.get("langgraph_node") == "agent_response"
+                and chunk.content
+            ):
+                yield "token", chunk.content
+                continue
+        elif mode == "custom" and isinstance(payload, dict):
+            for key, kind in _CUSTOM_KINDS.items():
+                if key in payload:
+                    yield kind, payload[key]
+            continue
+        yield "tick", None
+
+
+async def _graph_stream_events(graph, state, config):
+    # IMPORTANT INFORMATION
+    # WHEN WE USE LANGGRAPHH WITH STREAMING WE FACE A ISSUE
+    ## WE only get STREAMING CHUNKS, not the final state
+    # THEN How do WE access token_usage??
+    # WITHOUT the capture code:
+    # graph.astream_events() yields:
+    #   ├─ on_chain_start (node: agent_response)
+    #   ├─ on_chat_model_stream (token: "The")      ← You capture these for UI
+    #   ├─ on_chat_model_stream (token: " penalty")  ← You capture these for UI
+    #   ├─ on_chat_model_stream (token: " is...")    ← You capture these for UI
+    #   └─ on_chain_end (node: agent_response)       ← THIS has our token_usage!
+    #      └─ output: {token_usage: {...}, answer: "...", messages: [...]}
+    # The on_chain_end event contains the complete output from our node, including all the state updates like token_usage and summary.
+    # EXAMPLE:
+    #    kitchen events:
+    # - on_chain_start: "Started cooking"
+    # - on_stream: "Smell of cooking burger..."  ← Customer experiences this
+    # - on_chain_end: "Burger ready!"
+    #     └─ output: {
+    #         burger: "🍔",
+    #         cost: "$10",           ← You need this for billing!
+    #         calories: 500
+    #     }
+    async for event in graph.astream_events(state, config=config, version="v2"):
+        # the node from which we want streaming
+        node = event.get("metadata", {}).get("langgraph_node")
+        output = event.get("data", {}).get("output", {}) if event["event"] == "on_chain_end" else None
+
+        # Capture token_usage from agent_response node
+        if node == "agent_response" and isinstance(output, dict) and "token_usage" in output:
+            yield "token_usage", output["token_usage"]
+
+        # Answer cache hit (node can emit more than one on_chain_end, stream_graph replays only once)
+        elif node == "answer_cache_lookup" and isinstance(output, dict) and output.get("answer_cache_hit") and output.get("answer"):
+            yield "cached_answer", output["answer"]
+
+        # Capture state updates from summarize node
+        elif node == "summarize" and isinstance(output, dict) and "summary" in output:
+            yield "summary", output["summary"]
+
+        elif event["event"] == "on_chat_model_stream" and node == "agent_response":
+            chunk = event.get("data", {}).get("chunk")
+            if chunk and getattr(chunk, "content", None):
+                yield "token", chunk.content
+                continue
+
+        yield "tick", None
 
 
 
 
 # ===================== Streaming Graph =====================
-async def stream_graph(graph, state, config, on_complete=None, thread_id=None,first_message=None):
+async def stream_graph(graph, state, config, on_complete=None, thread_id=None,first_message=None,
+                       flush_interval_ms=STREAM_FLUSH_INTERVAL_MS, flush_bytes=STREAM_FLUSH_BYTES,
+                       stream_source=STREAM_SOURCE):
     """
     first_message:it is for transcibed message audio endpoint only
+    flush_interval_ms / flush_bytes: token frame coalescing (see TokenCoalescer)
+    stream_source: "modes" (messages + custom stream modes) or "events" (astream_events v2, old path)
     """
 
 
@@ -17,80 +181,68 @@ async def stream_graph(graph, state, config, on_complete=None, thread_id=None,fi
 
         tokens = []
         final_state = {}  # Capture the final state from the graph
+        cache_replayed = False  # answer cache hit already streamed
+        coalescer = TokenCoalescer(flush_interval_ms, flush_bytes)
 
         if first_message:
-            yield f"data: {json.dumps({'transcribed_text': first_message})}\n\n"
+            yield sse_frame({'transcribed_text': first_message})
             
         # Send thread_id first if this is a new thread (from /ask endpoint)
         if thread_id:
-            yield f"data: {json.dumps({'type': 'thread_created', 'thread_id': thread_id})}\n\n"
+            yield sse_frame({'type': 'thread_created', 'thread_id': thread_id})
 
 
         print("Token streaming started...")
 
 
-        # IMPORTANT INFORMATION
-        # WHEN WE USE LANGGRAPHH WITH STREAMING WE FACE A ISSUE
-        ## WE only get STREAMING CHUNKS, not the final state
-        # THEN How do WE access token_usage??
-        # WITHOUT the capture code:
-        # graph.astream_events() yields:
-        #   ├─ on_chain_start (node: agent_response)
-        #   ├─ on_chat_model_stream (token: "The")      ← You capture these for UI
-        #   ├─ on_chat_model_stream (token: " penalty")  ← You capture these for UI
-        #   ├─ on_chat_model_stream (token: " is...")    ← You capture these for UI
-        #   └─ on_chain_end (node: agent_response)       ← THIS has our token_usage!
-        #      └─ output: {token_usage: {...}, answer: "...", messages: [...]}
-        # The on_chain_end event contains the complete output from our node, including all the state updates like token_usage and summary.
-        # EXAMPLE:
-        #    kitchen events:
-        # - on_chain_start: "Started cooking"
-        # - on_stream: "Smell of cooking burger..."  ← Customer experiences this
-        # - on_chain_end: "Burger ready!"
-        #     └─ output: {
-        #         burger: "🍔",
-        #         cost: "$10",           ← You need this for billing!
-        #         calories: 500
-        #     }
         try:
-            async for event in graph.astream_events(state, config=config, version="v2"):
-                # the node from which we want streaming
-                node = event.get("metadata", {}).get("langgraph_node")
-                # event_type = event.get("event", "")
-
-
-                # Capture token_usage from agent_response node
-                if event["event"] == "on_chain_end" and node == "agent_response":
-                    output = event.get("data", {}).get("output", {})
-                    if isinstance(output, dict):
-                        if "token_usage" in output:
-                            final_state["token_usage"] = output["token_usage"]
-
-
-                # Capture state updates from summarize node
-                if event["event"] == "on_chain_end" and node == "summarize":
-                    output = event.get("data", {}).get("output", {})
-                    if isinstance(output, dict) and "summary" in output:
-                        final_state["summary"] = output["summary"]
-                        # print(f"Captured summary from summarize node: {output['summary'][:100]}...")
-                
-                # workflow.add_node("agent_response", nodes.agent_response) ==> as we have this node we check that we only stream from this node(agent)
-                # Streaming started here (we have to close it also)
-                if (
-                        event["event"] == "on_chat_model_stream"
-                        and node == "agent_response"
-                    ):
-                    chunk = event.get("data", {}).get("chunk")
-                    if chunk and getattr(chunk, "content", None):
-                        tokens.append(chunk.content) # we also append token in list as to persist the wole content is databse as otherwise we are genrating token by token so it will save incorrectly in database
-                        yield f"data: {json.dumps({'token': chunk.content})}\n\n"
-                        await asyncio.sleep(0)
+            source = _graph_stream_modes if stream_source == "modes" else _graph_stream_events
+            async for kind, value in source(graph, state, config):
+
+                # workflow.add_node("agent_response", nodes.agent_response) ==> only tokens of this node(agent) are streamed
+                if kind == "token":
+                    tokens.append(value) # we also append token in list as to persist the wole content is databse as otherwise we are genrating token by token so it will save incorrectly in database
+                    frame = coalescer.add(value)  # first token goes out at once, then batched
+                    if frame:
+                        yield frame
+                    continue
+
+                # Answer cache hit: no agent_response tokens will come, so replay the cached answer as token frames
+                if kind == "cached_answer" and not cache_replayed:
+                    cache_replayed = True  # replay only once
+                    for token in re.findall(r"\S+\s*|\s+", value):
+                        tokens.append(token)
+                        frame = coalescer.add(token)
+                        if frame:
+                            yield frame
+                    # whole answer is already here: send the rest now
+                    frame = coalescer.flush()
+                    if frame:
+                        yield frame
+                    await asyncio.sleep(0)
+
+                # state updates on_complete needs (token_usage from agent_response, summary from summarize)
+                if kind in ("token_usage", "summary"):
+                    final_state[kind] = value
+
+                # any other item: send buffered tokens that waited long enough
+                frame = coalescer.poll()
+                if frame:
+                    yield frame
                         
         except Exception as e:
-            yield f"data: {json.dumps({'type':'error','message':str(e)})}\n\n"
+            frame = coalescer.flush()  # tokens already generated still reach the client
+            if frame:
+                yield frame
+            yield sse_frame({'type':'error','message':str(e)})
             return
+
+        # last partial batch
+        frame = coalescer.flush()
+        if frame:
+            yield frame
         
-        print("Token streaming finished.")
+        print(f"Token streaming finished ({len(tokens)} tokens in {coalescer.frames} frames).")
 
         final_answer = "".join(tokens)  # join all the tokens in single string
 
@@ -109,7 +261,7 @@ async def stream_graph(graph, state, config, on_complete=None, thread_id=None,fi
         # In SSE every msg is sent as data: <message>\n\n
         # The double newline \n\n is required by SSE protocol to signal end of the event.
         # our froned can detect this done message to know that the streaming is complete
-        yield f"data: {json.dumps({'type': 'done'})}\n\n"
+        yield sse_frame({'type': 'done'})
         print("sending event to fronend")
 
     print("Starting event generator...")
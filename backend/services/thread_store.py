@@ -0,0 +1,221 @@
+import os
+import base64
+import json
+from datetime import datetime, timezone
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from postgrest.exceptions import APIError
+from src.db_connection.connection import supabase_client
+
+# ============================= Thread listing (sidebar) =============================
+# Before: /all_threads selected the FULL messages jsonb of every thread of the user, only to cut the first
+# 50 characters of the first message (megabytes per sidebar load for heavy users).
+#
+# Now the threads row carries its own `preview` (written once by /ask) and `updated_at` (bumped by every turn),
+# so the listing never touches `messages`:
+# - newest first: ORDER BY updated_at DESC, thread_id DESC (index threads_user_updated_idx, see docs/database.md)
+# - keyset (cursor) pagination on (updated_at, thread_id) ==> every page costs the same, whatever the page number
+# ==> response size scales with `limit`, not with the conversation volume of the user.
+# No limit (the current frontend) = every thread of the user, still without messages.
+
+THREAD_PREVIEW_CHARS = 50
+THREADS_PAGE_MAX = 200
+
+
+def thread_preview(question: str) -> str:
+    """sidebar preview of a thread = start of its first question (same format as before)"""
+    return question[:THREAD_PREVIEW_CHARS] + "..." if question else "New Chat"
+
+
+def utc_now() -> str:
+    """updated_at value (timestamptz), written by the app so it also moves on .update()"""
+    return datetime.now(timezone.utc).isoformat()
+
+
+# ---------------------- cursor ----------------------
+# opaque for the client: urlsafe base64 of [updated_at, thread_id] of the last thread of the page
+
+def encode_cursor(updated_at: str, thread_id: str) -> str:
+    raw = json.dumps([updated_at, thread_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[str, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        updated_at, thread_id = json.loads(raw)
+        # validated here because both values end up in a postgrest filter
+        datetime.fromisoformat(updated_at)
+        if not isinstance(thread_id, str) or '"' in thread_id or "\\" in thread_id:
+            raise ValueError("bad thread_id")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return updated_at, thread_id
+
+
+# ---------------------- listing ----------------------
+
+async def list_threads(user_id: str, limit: int | None = None, cursor: str | None = None):
+    """
+    One page of the user's threads, newest first, without their messages.
+    Returns (threads, next_cursor); next_cursor is None on the last page (and when limit is None = all threads).
+    """
+    after = decode_cursor(cursor) if cursor else None
+
+    def query():
+        q = (
+            supabase_client
+            .table("threads")
+            .select("thread_id, doc_ids, preview, updated_at")
+            .eq("user_id", user_id)  # filter by login user
+        )
+        if after:
+            updated_at, thread_id = after
+            # strictly after the last row of the previous page in (updated_at DESC, thread_id DESC) order
+            q = q.or_(
+                f'updated_at.lt."{updated_at}",'
+                f'and(updated_at.eq."{updated_at}",thread_id.lt."{thread_id}")'
+            )
+        q = q.order("updated_at", desc=True).order("thread_id", desc=True)
+        if limit is None:
+            return q.execute()
+        # one extra row tells us if there is a next page
+        return q.limit(limit + 1).execute()
+
+    response = await run_in_threadpool(query)
+    rows = response.data or []
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last["updated_at"], last["thread_id"])
+
+    threads = [
+        {
+            "thread_id": row["thread_id"],
+            "doc_ids": row["doc_ids"],
+            "preview": row.get("preview") or "New Chat",
+            "updated_at": row.get("updated_at"),
+        }
+        for row in rows
+    ]
+    return threads, next_cursor
+
+
+# ============================= Append-only message store =============================
+# Before: every follow-up rewrote the WHOLE messages array of the thread row (.update({"messages": ...})),
+# so turn n wrote n messages and a thread of n turns cost O(n²) writes in total.
+#
+# Now every message is one row of thread_messages (thread_id, seq, role, content), see docs/database.md:
+# - a turn = ONE insert of 2 rows (question + answer) with the next sequence numbers
+# - follow-ups read only the last THREAD_CONTEXT_MESSAGES messages (older turns are covered by the summary)
+# - /get_threads reads the whole thread (the chat window shows it all)
+# threads.messages is not written anymore (kept only for the one time backfill).
+
+# the graph summarizes once the conversation has more than 6 messages (GraphNodes.should_summzarizer)
+THREAD_CONTEXT_MESSAGES = int(os.environ.get("THREAD_CONTEXT_MESSAGES", "6"))
+
+_UNIQUE_VIOLATION = "23505"
+# inserts of one turn before giving up when concurrent turns of the same thread keep taking the next seq
+APPEND_TURN_ATTEMPTS = int(os.environ.get("APPEND_TURN_ATTEMPTS", "5"))
+
+
+def _message_rows(thread_id: str, user_id: str, first_seq: int, question: str, answer: str) -> list[dict]:
+    return [
+        {"thread_id": thread_id, "user_id": user_id, "seq": first_seq, "role": "human", "content": question},
+        {"thread_id": thread_id, "user_id": user_id, "seq": first_seq + 1, "role": "ai", "content": answer},
+    ]
+
+
+async def load_thread(thread_id: str, user_id: str) -> dict:
+    """doc_ids + summary of a thread of this user (404 if it is not theirs / does not exist)"""
+    response = await run_in_threadpool(
+        lambda: supabase_client
+        .table("threads")
+        .select("doc_ids,summary")
+        .eq("thread_id", thread_id)
+        .eq("user_id", user_id)  # filter by login user id
+        .maybe_single()
+        .execute()
+    )
+    if not response or not response.data:
+        raise HTTPException(status_code=404, detail="Thread not found")
+    return response.data
+
+
+async def touch_thread(thread_id: str, summary: str | None = None):
+    """bump updated_at (top of the sidebar) and store the new summary if the turn produced one"""
+    values = {"updated_at": utc_now()}
+    if summary is not None:
+        values["summary"] = summary
+    await run_in_threadpool(
+        lambda: supabase_client.table("threads").update(values).eq("thread_id", thread_id).execute()
+    )
+
+
+async def save_summary(thread_id: str, summary: str):
+    """summary computed after the turn (background summary), updated_at is left alone"""
+    await run_in_threadpool(
+        lambda: supabase_client.table("threads").update({"summary": summary}).eq("thread_id", thread_id).execute()
+    )
+
+
+def _last_seq(thread_id: str) -> int:
+    response = (
+        supabase_client
+        .table("thread_messages")
+        .select("seq")
+        .eq("thread_id", thread_id)
+        .order("seq", desc=True)
+        .limit(1)
+        .execute()
+    )
+    return response.data[0]["seq"] if response.data else 0
+
+
+async def load_messages(thread_id: str, user_id: str, last_n: int | None = None) -> list[dict]:
+    """
+    Messages of a thread in order, as {"seq", "role", "content"}.
+    last_n = only the last n messages (None = the whole thread).
+    """
+    def query():
+        q = (
+            supabase_client
+            .table("thread_messages")
+            .select("seq, role, content")
+            .eq("thread_id", thread_id)
+            .eq("user_id", user_id)  # filter by login user id
+        )
+        if last_n is not None:
+            # newest first so LIMIT keeps the last ones, reversed below
+            return q.order("seq", desc=True).limit(last_n).execute()
+        return q.order("seq").execute()
+
+    response = await run_in_threadpool(query)
+    rows = response.data or []
+    return rows[::-1] if last_n is not None else rows
+
+
+async def append_turn(thread_id: str, user_id: str, after_seq: int | None, question: str, answer: str):
+    """
+    Store one question / answer pair with ONE insert.
+    after_seq = seq of the last message the caller knows of (0 for a new thread, None = not loaded, it is read first).
+    If other requests appended to the same thread in between, the (thread_id, seq) unique key rejects the
+    insert and it is retried after the last seq is re-read (up to APPEND_TURN_ATTEMPTS inserts).
+    """
+    def insert(first_seq: int):
+        supabase_client.table("thread_messages").insert(
+            _message_rows(thread_id, user_id, first_seq, question, answer)
+        ).execute()
+
+    if after_seq is None:
+        after_seq = await run_in_threadpool(_last_seq, thread_id)
+    for attempt in range(1, APPEND_TURN_ATTEMPTS + 1):
+        try:
+            await run_in_threadpool(insert, after_seq + 1)
+            return
+        except APIError as e:
+            if e.code != _UNIQUE_VIOLATION or attempt == APPEND_TURN_ATTEMPTS:
+                raise
+            after_seq = await run_in_threadpool(_last_seq, thread_id)
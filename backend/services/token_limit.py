@@ -1,26 +1,150 @@
 
+import os
+import time
+import threading
 from src.db_connection.connection import supabase_client
 from fastapi import HTTPException
 from fastapi.concurrency import run_in_threadpool
 
 # ============================ Token limit check ============================
+# Before: every question selected ALL usage rows of the user and summed them in python (slower as history grows).
+#
+# Now every worker keeps a counter per user:
+#   used = db_total (SUM(total_tokens) from ONE aggregate query) + pending (logged by this worker, not in the db yet)
+# - seeded on the first question of the user
+# - log_token_usage adds to pending, and moves it to db_total once the row is inserted
+# - re-seeded (reconciled) every QUOTA_RECONCILE_S so usage of the OTHER workers is picked up; pending is reset to
+#   the rows this worker still holds (queue / flush in progress, see unwritten_tokens): a row spilled during an
+#   outage may be replayed by ANOTHER worker, it is then in db_total and must not stay pending here too
+# - close to the limit (less than QUOTA_NEAR_LIMIT_MARGIN left) it is reconciled on every check,
+#   so the 100k limit holds across workers and a user can not overshoot by hopping between them
+# ==> check_token_limit is a dict lookup for almost all questions.
 
 TOKEN_LIMIT = 100000
+QUOTA_RECONCILE_S = int(os.environ.get("QUOTA_RECONCILE_S", "60"))
+QUOTA_NEAR_LIMIT_MARGIN = int(os.environ.get("QUOTA_NEAR_LIMIT_MARGIN", "10000"))
+
+
+class UserQuota:
+    def __init__(self, db_total: int):
+        self.db_total = db_total
+        self.pending = 0
+        self.reconciled_at = time.monotonic()
+
+    @property
+    def used(self) -> int:
+        return self.db_total + self.pending
+
+
+class TokenQuota:
+    def __init__(self, limit: int = TOKEN_LIMIT, reconcile_s: int = QUOTA_RECONCILE_S,
+                 near_limit_margin: int = QUOTA_NEAR_LIMIT_MARGIN, engine_factory=None):
+        self.limit = limit
+        self.reconcile_s = reconcile_s
+        self.near_limit_margin = near_limit_margin
+        self.engine_factory = engine_factory  # pooled engine for the aggregate query (None = supabase fallback only)
+        self._users: dict[str, UserQuota] = {}
+        # user_id -> tokens logged by this worker that are not written yet (set by backend/services/usage_logger.py)
+        self.unwritten_tokens = None
+        self._lock = threading.Lock()
+        self.checks = 0
+        self.reconciles = 0
+        self.reconcile_errors = 0
+
+    # ---------------------- db ----------------------
+    def _aggregate(self, user_id: str) -> int:
+        """SUM(total_tokens) of the user in ONE query (sums the rows in python only if the pool is not available)"""
+        if self.engine_factory is not None:
+            from sqlalchemy import text
+            try:
+                with self.engine_factory().connect() as conn:
+                    return int(conn.execute(
+                        text("SELECT COALESCE(SUM(total_tokens), 0) FROM usage WHERE user_id = :user_id"),
+                        {"user_id": user_id},
+                    ).scalar())
+            except Exception as e:
+                with self._lock:
+                    self.reconcile_errors += 1
+                print(f"Token usage aggregate failed ({e}) → summing usage rows")
+
+        response = supabase_client.table("usage").select("total_tokens").eq("user_id", user_id).execute()
+        return sum(row["total_tokens"] for row in response.data or [])
+
+    async def reconcile(self, user_id: str) -> UserQuota:
+        db_total = await run_in_threadpool(self._aggregate, user_id)
+        with self._lock:
+            quota = self._users.get(user_id)
+            if quota is None:
+                quota = self._users[user_id] = UserQuota(db_total)
+            else:
+                quota.db_total = db_total
+                if self.unwritten_tokens is not None:
+                    quota.pending = self.unwritten_tokens(user_id)
+                quota.reconciled_at = time.monotonic()
+            self.reconciles += 1
+        return quota
+
+    # ---------------------- check / record ----------------------
+    def _needs_reconcile(self, quota: UserQuota | None) -> bool:
+        if quota is None:
+            return True
+        if time.monotonic() - quota.reconciled_at > self.reconcile_s:
+            return True
+        # near the limit other workers may have pushed the user over it
+        return quota.used >= self.limit - self.near_limit_margin
+
+    async def used(self, user_id: str) -> int:
+        with self._lock:
+            self.checks += 1
+            quota = self._users.get(user_id)
+        if self._needs_reconcile(quota):
+            quota = await self.reconcile(user_id)
+        return quota.used
+
+    def add_pending(self, user_id: str, tokens: int):
+        """usage of an answer that is about to be written (counts immediately)"""
+        with self._lock:
+            quota = self._users.get(user_id)
+            if quota is not None:  # not seeded yet ==> the next check seeds from the db anyway
+                quota.pending += tokens
+
+    def mark_persisted(self, user_id: str, tokens: int):
+        """the usage row(s) with these tokens are in the db now"""
+        with self._lock:
+            quota = self._users.get(user_id)
+            if quota is not None:
+                quota.pending = max(quota.pending - tokens, 0)
+                quota.db_total += tokens
+
+    def mark_failed(self, user_id: str, tokens: int):
+        """the usage row could not be written, forget it (the db stays the source of truth)"""
+        with self._lock:
+            quota = self._users.get(user_id)
+            if quota is not None:
+                quota.pending = max(quota.pending - tokens, 0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._users),
+                "checks": self.checks,
+                "reconciles": self.reconciles,
+                "reconcile_errors": self.reconcile_errors,
+            }
+
+
+def _default_engine():
+    from src.db_connection.vectorstore import vectorstore_registry
+    return vectorstore_registry.init_pool()
+
+
+# per worker counters (the database stays the shared source of truth between workers)
+token_quota = TokenQuota(engine_factory=_default_engine)
+
 
 async def check_token_limit(user_id:str):
-    # fetch the usage table from database and select its total_tokens attribute
-    response = await run_in_threadpool(
-        lambda: supabase_client
-        .table("usage")
-        .select("total_tokens")
-        .eq("user_id", user_id)
-        .execute()
-    )
-    if not response.data:
-        return False
-
-    # we sum the total_tokens(attribute) of all rows of that user to get how many token he has used till not
-    total_tokens = sum(row["total_tokens"] for row in response.data)
+    # O(1) in-memory counter (seeded / reconciled from one SUM query when needed)
+    total_tokens = await token_quota.used(user_id)
     if total_tokens >= TOKEN_LIMIT:
         raise HTTPException(status_code=429, detail="You have reached your maximum API limit (100,000 tokens)")
-    return True
\ No newline at end of file
+    return True
@@ -0,0 +1,97 @@
+import os
+import shutil
+import hashlib
+import aiofiles
+from pathlib import Path
+from fastapi import HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+
+# ============================ Streaming upload sink ============================
+# Before: upload was written to disk in 1 MB chunks, then get_file_hash read the WHOLE file again (one f.read())
+# to compute the doc_id, in prepare_initial_state even on the event loop.
+# Now the SHA-256 is updated with every chunk while it is written ==> doc_id is known when the write ends (no second pass).
+# Memory stays at one chunk whatever the pdf size and uploads over MAX_UPLOAD_MB are rejected (413) while streaming.
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB
+MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", "100"))
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class HashingUploadSink:
+    """Writes chunks to a file and hashes them on the way (sha256 hexdigest = doc_id)."""
+
+    def __init__(self, path: Path, max_bytes: int = MAX_UPLOAD_MB * 1024 * 1024):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._hasher = hashlib.sha256()
+        self._file = None
+
+    async def __aenter__(self):
+        self._file = await aiofiles.open(self.path, "wb")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._file.close()
+        if exc_type is not None:
+            # never leave a half written pdf behind (it would be picked up by its file name later)
+            self.path.unlink(missing_ok=True)
+        return False
+
+    async def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise UploadTooLarge(f"Upload is larger than {self.max_bytes // (1024 * 1024)} MB")
+        self._hasher.update(chunk)
+        await self._file.write(chunk)
+
+    def hexdigest(self) -> str:
+        return self._hasher.hexdigest()
+
+
+async def save_upload(upload: UploadFile, path: Path, max_bytes: int = MAX_UPLOAD_MB * 1024 * 1024) -> str:
+    """Stream an UploadFile to `path` and return its sha256 (doc_id)."""
+    try:
+        async with HashingUploadSink(path, max_bytes) as sink:
+            while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                await sink.write(chunk)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return sink.hexdigest()
+
+
+# ---------------------- hash first, write only if needed (fast path for already ingested pdfs) ----------------------
+# /ask needs the doc_id before anything else to know if the user already has this pdf.
+# Starlette already keeps the received upload in a SpooledTemporaryFile (memory for small files, temp file above),
+# so we hash that spool directly and only copy it to uploaded_docs/ when the pdf really has to be ingested.
+# Re-uploads (most of the traffic) are never written to disk.
+
+async def hash_upload(upload: UploadFile, max_bytes: int = MAX_UPLOAD_MB * 1024 * 1024) -> str:
+    """sha256 (doc_id) of the received upload, chunk by chunk. The upload is rewound so it can be persisted after."""
+    hasher = hashlib.sha256()
+    size = 0
+    while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Upload is larger than {max_bytes // (1024 * 1024)} MB")
+        hasher.update(chunk)
+    await upload.seek(0)
+    return hasher.hexdigest()
+
+
+def _copy_upload(upload: UploadFile, path: Path):
+    upload.file.seek(0)
+    with open(path, "wb") as f:
+        shutil.copyfileobj(upload.file, f, UPLOAD_CHUNK_SIZE)
+
+
+async def persist_upload(upload: UploadFile, path: Path):
+    """copy an already hashed upload to `path` (threadpool: the spool may be a temp file on disk)"""
+    try:
+        await run_in_threadpool(_copy_upload, upload, path)
+    except BaseException:
+        Path(path).unlink(missing_ok=True)
+        raise
@@ -0,0 +1,338 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import asyncio
+import threading
+import contextlib
+from pathlib import Path
+from fastapi.concurrency import run_in_threadpool
+from postgrest.exceptions import APIError
+from src.db_connection.connection import supabase_client
+from backend.services.token_limit import token_quota
+
+# ============================= Write-behind usage logger =============================
+# Before: one supabase insert per answer in a BackgroundTasks callback, with tenacity retries that could keep the
+# task busy for up to 30 s when supabase had a problem.
+#
+# Now log_token_usage only puts the row on an in-memory queue and returns. One flusher task writes the rows in
+# BULK inserts, when USAGE_FLUSH_BATCH rows are waiting or every USAGE_FLUSH_INTERVAL_S seconds.
+# - supabase down / insert failing → the batch is appended to a spill file (jsonl, at most USAGE_SPILL_MAX_MB)
+#   and replayed after the next successful flush. Rows that do not fit in the spill file are dropped (and counted).
+# - queue full (USAGE_QUEUE_MAX) → rows go straight to the spill file instead of blocking the request
+# - app shutdown (backend/app.py lifespan) → queue is drained and flushed one last time
+#   (rows of a flush cut by the shutdown timeout are spilled, not dropped)
+# Queue depth / flush latency are served on /metrics.
+#
+# The spill file is shared by every uvicorn worker: appends and the replay claim hold an flock on
+# <spill>.lock, and a replay renames the file to a name unique to the worker (<spill>.<pid>.<id>.replay), so two
+# workers never replay the same rows. Replay files left by a dead worker are picked up by the next replay.
+# A row the database keeps rejecting (APIError, not an outage) is retried USAGE_MAX_ATTEMPTS times, then moved
+# to <spill>.dead (dead letter) so it can not block the replay of the others.
+
+USAGE_FLUSH_BATCH = int(os.environ.get("USAGE_FLUSH_BATCH", "50"))
+USAGE_FLUSH_INTERVAL_S = float(os.environ.get("USAGE_FLUSH_INTERVAL_S", "2"))
+USAGE_QUEUE_MAX = int(os.environ.get("USAGE_QUEUE_MAX", "10000"))
+USAGE_SPILL_PATH = os.environ.get("USAGE_SPILL_PATH", "usage_spill.jsonl")
+USAGE_SPILL_MAX_MB = float(os.environ.get("USAGE_SPILL_MAX_MB", "50"))
+USAGE_MAX_ATTEMPTS = int(os.environ.get("USAGE_MAX_ATTEMPTS", "3"))  # rejected replays before dead letter
+
+_STOP = object()  # put on the queue by stop(), after the last row
+
+
+class UsageLogger:
+    def __init__(
+        self,
+        client=supabase_client,
+        flush_batch: int = USAGE_FLUSH_BATCH,
+        flush_interval_s: float = USAGE_FLUSH_INTERVAL_S,
+        queue_max: int = USAGE_QUEUE_MAX,
+        spill_path: str = USAGE_SPILL_PATH,
+        spill_max_bytes: int = int(USAGE_SPILL_MAX_MB * 1024 * 1024),
+        quota=token_quota,
+        max_attempts: int = USAGE_MAX_ATTEMPTS,
+    ):
+        self.client = client
+        self.flush_batch = flush_batch
+        self.flush_interval_s = flush_interval_s
+        self.queue_max = queue_max
+        self.spill_path = Path(spill_path)
+        self.spill_max_bytes = spill_max_bytes
+        self.lock_path = self.spill_path.with_name(self.spill_path.name + ".lock")
+        self.dead_path = self.spill_path.with_name(self.spill_path.name + ".dead")
+        self.max_attempts = max_attempts
+        self.quota = quota
+
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self._spill_lock = threading.Lock()
+        self._inflight: list[dict] = []  # rows of the flush in progress (spilled if stop() has to cancel it)
+        self._unwritten: dict[str, int] = {}  # user_id -> tokens in the queue / flush in progress (quota reconcile)
+        quota.unwritten_tokens = self.unwritten_tokens
+
+        self.enqueued = 0
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.spilled_rows = 0
+        self.replayed_rows = 0
+        self.dropped_rows = 0
+        self.dead_rows = 0
+        self.flush_ms_total = 0.0
+        self.flush_ms_max = 0.0
+
+    # ---------------------- lifecycle ----------------------
+    def start(self):
+        """start the flusher on the running loop (called from the lifespan, or lazily on first log)"""
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue(maxsize=self.queue_max)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout_s: float = 10.0):
+        """drain the queue and flush everything left (called from the lifespan on shutdown)"""
+        if self._task is None or self._task.done():
+            return
+        await self._queue.put(_STOP)  # after every row already queued
+        try:
+            await asyncio.wait_for(self._task, timeout=timeout_s)
+        except asyncio.TimeoutError:
+            # supabase too slow: keep what is left on disk for the next start
+            # (the cancelled flush too: its insert may still land, a duplicate is better than a lost row)
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            queued = [row for row in self._drain(self._queue.qsize()) if row is not _STOP]
+            rows = self._inflight + queued
+            self._inflight = []
+            await run_in_threadpool(self._spill, rows)
+            self._release(queued)  # the cancelled flush released its own rows
+        self._task = None
+        print(f"Usage logger stopped: {self.stats()}")
+
+    # ---------------------- producer ----------------------
+    def log(self, row: dict):
+        self.start()
+        self.quota.add_pending(row["user_id"], row["total_tokens"])
+        try:
+            self._queue.put_nowait(row)
+            self.enqueued += 1
+            self._unwritten[row["user_id"]] = self._unwritten.get(row["user_id"], 0) + row["total_tokens"]
+        except asyncio.QueueFull:
+            # never block (or lose) a request because of usage logging, the file write runs in a thread
+            asyncio.get_running_loop().run_in_executor(None, self._spill, [row])
+
+    # ---------------------- flusher ----------------------
+    def _drain(self, limit: int) -> list[dict]:
+        rows = []
+        while len(rows) < limit:
+            try:
+                rows.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return rows
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            # wait for the first row, then give the batch flush_interval_s to fill up
+            first = await self._queue.get()
+            if first is _STOP:
+                return
+            deadline = time.monotonic() + self.flush_interval_s
+            rows = [first]
+            while len(rows) < self.flush_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                if row is _STOP:
+                    stopping = True
+                    break
+                rows.append(row)
+            try:
+                await self._flush(rows)
+            except Exception as e:  # the flusher must never die
+                print(f"Usage flush crashed: {e}")
+            finally:
+                self._release(rows)  # inserted or spilled: this worker does not hold them anymore
+
+    def _release(self, rows: list[dict]):
+        for row in rows:
+            left = self._unwritten.get(row["user_id"], 0) - row["total_tokens"]
+            if left > 0:
+                self._unwritten[row["user_id"]] = left
+            else:
+                self._unwritten.pop(row["user_id"], None)
+
+    def unwritten_tokens(self, user_id: str) -> int:
+        """tokens of the user still in this worker's queue / flush in progress (not in the db, not spilled)"""
+        return self._unwritten.get(user_id, 0)
+
+    def _insert(self, rows: list[dict]):
+        self.client.table("usage").insert(rows).execute()
+
+    def _persisted(self, rows: list[dict]):
+        for row in rows:
+            self.quota.mark_persisted(row["user_id"], row["total_tokens"])
+
+    async def _flush(self, rows: list[dict]):
+        start = time.perf_counter()
+        self._inflight = rows
+        try:
+            await run_in_threadpool(self._insert, rows)
+        except asyncio.CancelledError:
+            raise  # stop() spills self._inflight
+        except Exception as e:
+            self._inflight = []
+            self.failed_flushes += 1
+            print(f"Failed to flush {len(rows)} usage rows ({e}) → spilling to {self.spill_path}")
+            # rows stay "pending" in the quota until they are replayed
+            await run_in_threadpool(self._spill, rows)
+            return
+        self._inflight = []
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.flushes += 1
+        self.flushed_rows += len(rows)
+        self.flush_ms_total += elapsed_ms
+        self.flush_ms_max = max(self.flush_ms_max, elapsed_ms)
+        self._persisted(rows)
+        # supabase is reachable again → send what was spilled during the outage (or left by a dead worker)
+        if self.spill_path.exists() or self._orphan_replays():
+            await run_in_threadpool(self._replay_spill)
+
+    # ---------------------- spill file ----------------------
+    @contextlib.contextmanager
+    def _file_lock(self):
+        """thread lock (this worker) + flock (all workers sharing the spill file)"""
+        with self._spill_lock, open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _spill(self, rows: list[dict]):
+        with self._file_lock():
+            size = self.spill_path.stat().st_size if self.spill_path.exists() else 0
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for row in rows:
+                    line = json.dumps(row, ensure_ascii=False) + "\n"
+                    if size + len(line) > self.spill_max_bytes:
+                        self.dropped_rows += 1
+                        self.quota.mark_failed(row["user_id"], row["total_tokens"])
+                        continue
+                    f.write(line)
+                    size += len(line)
+                    self.spilled_rows += 1
+
+    def _dead_letter(self, rows: list[dict]):
+        with self._file_lock(), open(self.dead_path, "a", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+                self.dead_rows += 1
+                self.quota.mark_failed(row["user_id"], row["total_tokens"])
+        print(f"{len(rows)} usage rows rejected {self.max_attempts} times → moved to {self.dead_path}")
+
+    def _orphan_replays(self) -> list[Path]:
+        """replay files of workers that died while replaying"""
+        orphans = []
+        for path in self.spill_path.parent.glob(self.spill_path.name + ".*.replay"):
+            try:
+                pid = int(path.name[len(self.spill_path.name) + 1:].split(".")[0])
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                orphans.append(path)
+            except (ValueError, PermissionError):
+                continue
+        return orphans
+
+    def _claim_replay(self) -> list[Path]:
+        """rename the spill file (+ orphans) to names only this worker uses, rows spilled meanwhile go to a new file"""
+        claimed = []
+        with self._file_lock():
+            sources = ([self.spill_path] if self.spill_path.exists() else []) + self._orphan_replays()
+            for source in sources:
+                target = self.spill_path.with_name(f"{self.spill_path.name}.{os.getpid()}.{uuid.uuid4().hex}.replay")
+                try:
+                    source.replace(target)
+                except FileNotFoundError:
+                    continue  # another worker claimed it first
+                claimed.append(target)
+        return claimed
+
+    def _insert_rows(self, rows: list[dict]):
+        self._insert([{k: v for k, v in row.items() if k != "_attempts"} for row in rows])
+
+    def _replay_rows(self, rows: list[dict]) -> tuple[list[dict], bool]:
+        """
+        Insert spilled rows. Returns (rows to keep for later, outage).
+        A batch the database rejects is retried row by row so only the rejected rows count an attempt.
+        """
+        keep, dead = [], []
+        pending = list(rows)
+        outage = False
+        while pending and not outage:
+            batch, pending = pending[:self.flush_batch], pending[self.flush_batch:]
+            inserted = []
+            try:
+                self._insert_rows(batch)
+                inserted = batch
+            except APIError:
+                for j, row in enumerate(batch):
+                    try:
+                        self._insert_rows([row])
+                    except APIError as e:
+                        row["_attempts"] = row.get("_attempts", 0) + 1
+                        print(f"Spilled usage row rejected ({e.code}: {e.message}), attempt {row['_attempts']}")
+                        (dead if row["_attempts"] >= self.max_attempts else keep).append(row)
+                        continue
+                    except Exception as e:
+                        print(f"Replaying spilled usage rows failed ({e}), keeping them for later")
+                        pending, outage = batch[j:] + pending, True
+                        break
+                    inserted.append(row)
+            except Exception as e:
+                print(f"Replaying spilled usage rows failed ({e}), keeping them for later")
+                pending, outage = batch + pending, True
+            self.replayed_rows += len(inserted)
+            self._persisted(inserted)
+        if dead:
+            self._dead_letter(dead)
+        return keep + pending, outage
+
+    def _replay_spill(self):
+        outage = False
+        for replay_path in self._claim_replay():
+            with open(replay_path, encoding="utf-8") as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+            if outage:
+                keep = rows  # supabase went down again: the other claimed files wait for the next replay
+            else:
+                keep, outage = self._replay_rows(rows)
+            if keep:
+                self._spill(keep)
+            replay_path.unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "enqueued": self.enqueued,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "failed_flushes": self.failed_flushes,
+            "flush_ms_avg": round(self.flush_ms_total / self.flushes, 2) if self.flushes else 0.0,
+            "flush_ms_max": round(self.flush_ms_max, 2),
+            "spilled_rows": self.spilled_rows,
+            "replayed_rows": self.replayed_rows,
+            "dropped_rows": self.dropped_rows,
+            "dead_rows": self.dead_rows,
+            "spill_bytes": self.spill_path.stat().st_size if self.spill_path.exists() else 0,
+        }
+
+
+# one logger per worker (started / drained in backend/app.py lifespan)
+usage_logger = UsageLogger()
@@ -0,0 +1,29 @@
+from src.db_connection.connection import supabase_client
+from fastapi.concurrency import run_in_threadpool
+
+# ============================ User settings for the graph state ============================
+
+async def get_user_settings(user_id: str) -> dict:
+    """
+    Fetch the per user settings the graph needs.
+    - custom_prompt (None = use default prompt)
+    - answer_cache_enabled (per user opt out of the semantic answer cache, default True)
+    Falls back to defaults if the user has no settings row or the fetch fails.
+    """
+    settings = {"custom_prompt": None, "answer_cache_enabled": True}
+    try:
+        # select * so a missing answer_cache_enabled column (old schema) does not break custom prompts
+        response = await run_in_threadpool(
+            lambda: supabase_client.table("user_settings")
+                .select("*")
+                .eq("user_id", str(user_id))
+                .limit(1)
+                .execute()
+        )
+        if response.data and len(response.data) > 0:
+            row = response.data[0]
+            settings["custom_prompt"] = row.get("custom_prompt")
+            settings["answer_cache_enabled"] = row.get("answer_cache_enabled") is not False
+    except Exception:
+        pass  # Use defaults if fetch fails
+    return settings
@@ -1,6 +1,7 @@
 from langchain_openai import ChatOpenAI,OpenAIEmbeddings
 from dotenv import load_dotenv
 load_dotenv()
+from src.cache.embedding_cache import build_cached_embeddings
 
 
 # chatting llm
@@ -10,6 +11,7 @@ llm = ChatOpenAI(model="gpt-4o-mini",
                 stream_usage=True,
                 )
 #embedding llm
-EMBEDDING = OpenAIEmbeddings(model="text-embedding-3-small")
+# wrapped with the query-embedding cache (repeated questions / CRAG retries skip the OpenAI call)
+EMBEDDING = build_cached_embeddings(OpenAIEmbeddings(model="text-embedding-3-small"))
 
 # model_kwargs={"stream_usage": True}
\ No newline at end of file
@@ -0,0 +1,174 @@
+import os
+import re
+import time
+import hashlib
+import threading
+import itertools
+from collections import OrderedDict
+import numpy as np
+
+from src.cache.embedding_cache import normalize_query
+from src.agent.model_loader import EMBEDDING
+from src.graph.rewrite_gate import ANCHOR_PATTERN
+
+
+# ============================ SEMANTIC ANSWER CACHE ============================
+# The same questions are asked again and again against the same public PDFs
+# (e.g. "punishment for false evidence" against the PPC) and each one pays rewrite + retrieval + grading + generation.
+#
+# Bucket key  = sorted doc_ids + hash of the effective prompt template (custom prompt or default)
+# Match       = cosine similarity between the rewritten query embedding and the cached query embeddings of that bucket
+#
+# doc_ids are content hashes so the same PDF has the same doc_id for every user ==> answers are shared across users.
+# To keep tenants isolated only answers generated WITHOUT conversation memory (first question, no summary) are stored,
+# they only depend on the document + prompt + question. Users can opt out in user_settings (answer_cache_enabled).
+#
+# Anchors: "punishment under section 420 PPC" and "... section 421 PPC" embed almost identically, so a similarity
+# hit also needs the SAME set of section / article references and numbers (query_anchors) as the cached question.
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0.95"))  # min cosine similarity for a hit
+ANSWER_CACHE_TTL_S = int(os.environ.get("ANSWER_CACHE_TTL_S", str(7 * 24 * 3600)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+
+
+def prompt_template_hash(template: str) -> str:
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()[:16]
+
+
+NUMBER_PATTERN = re.compile(r"\b\d+[a-z]?\b", re.IGNORECASE)
+ANCHOR_KINDS = {"sec": "section", "s": "section", "§": "section", "art": "article"}
+
+
+def query_anchors(query: str) -> frozenset[str]:
+    """section / article references ("section 420", "art. 25a" → "article 25a") and bare numbers of a query"""
+    text = query.lower()
+    anchors = set(NUMBER_PATTERN.findall(text))
+    for match in ANCHOR_PATTERN.finditer(text):
+        kind = re.match(r"[a-z§]+", match.group(0)).group(0)
+        number = NUMBER_PATTERN.search(match.group(0)).group(0)
+        anchors.add(f"{ANCHOR_KINDS.get(kind, kind)} {number}")
+    return frozenset(anchors)
+
+
+def bucket_key(doc_ids: list[str], template_hash: str) -> str:
+    return ",".join(sorted(doc_ids)) + "|" + template_hash
+
+
+class AnswerEntry:
+    def __init__(self, query: str, embedding, answer: str):
+        self.query = normalize_query(query)
+        self.anchors = query_anchors(query)
+        self.embedding = embedding
+        self.answer = answer
+        self.created_at = time.time()
+
+
+class AnswerCache:
+    """In-process LRU of answers, grouped in buckets of (doc_ids, prompt template), matched by embedding similarity."""
+
+    def __init__(
+        self,
+        embeddings,
+        similarity_threshold: float = ANSWER_CACHE_SIMILARITY,
+        ttl_s: int = ANSWER_CACHE_TTL_S,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+        enabled: bool = ANSWER_CACHE_ENABLED,
+    ):
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.enabled = enabled
+
+        self._ids = itertools.count()
+        self._entries: "OrderedDict[int, tuple[str, AnswerEntry]]" = OrderedDict()  # entry id -> (bucket, entry)
+        self._buckets: dict[str, set[int]] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    async def _embed(self, query: str):
+        vector = np.asarray(await self.embeddings.aembed_query(query), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, entry_id: int):
+        bucket, _ = self._entries.pop(entry_id)
+        ids = self._buckets.get(bucket)
+        if ids is not None:
+            ids.discard(entry_id)
+            if not ids:
+                del self._buckets[bucket]
+
+    async def lookup(self, doc_ids: list[str], template_hash: str, query: str) -> tuple[str | None, float]:
+        """Returns (cached answer or None, best similarity)."""
+        bucket = bucket_key(doc_ids, template_hash)
+        with self._lock:
+            if bucket not in self._buckets:
+                # nothing cached for these docs + prompt, no need to embed the query
+                self.misses += 1
+                return None, 0.0
+
+        vector = await self._embed(query)
+        normalized = normalize_query(query)
+        anchors = query_anchors(query)
+        now = time.time()
+
+        best_id, best_score = None, 0.0
+        with self._lock:
+            for entry_id in list(self._buckets.get(bucket, ())):
+                _, entry = self._entries[entry_id]
+                if now - entry.created_at > self.ttl_s:
+                    self._remove(entry_id)
+                    self.expirations += 1
+                    continue
+                if entry.anchors != anchors:
+                    continue  # other section / article / number: never the same answer however close the embedding
+                score = 1.0 if entry.query == normalized else float(np.dot(vector, entry.embedding))
+                if score > best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is not None and best_score >= self.similarity_threshold:
+                self._entries.move_to_end(best_id)
+                self.hits += 1
+                return self._entries[best_id][1].answer, best_score
+
+            self.misses += 1
+            return None, best_score
+
+    async def store(self, doc_ids: list[str], template_hash: str, query: str, answer: str):
+        vector = await self._embed(query)
+        bucket = bucket_key(doc_ids, template_hash)
+        with self._lock:
+            entry_id = next(self._ids)
+            self._entries[entry_id] = (bucket, AnswerEntry(query, vector, answer))
+            self._buckets.setdefault(bucket, set()).add(entry_id)
+            self.stores += 1
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "buckets": len(self._buckets),
+                "similarity_threshold": self.similarity_threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+# process wide cache shared by all requests of this worker
+answer_cache = AnswerCache(EMBEDDING)
@@ -0,0 +1,169 @@
+import os
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+from rank_bm25 import BM25Okapi
+from langchain_community.retrievers import BM25Retriever
+from langchain_community.retrievers.bm25 import default_preprocessing_func
+from langchain_core.documents import Document
+
+
+# ============================ BM25 INDEX CACHE ============================
+# Before this cache every question (and every CRAG retry) pulled all chunks of the thread's
+# doc_ids from the supabase "documents" table and re-tokenized them with BM25Retriever.from_documents
+# Now we keep one tokenized index per (user_id, doc_id) in memory and only hit supabase on a miss.
+#
+# Why per doc and not per thread?
+# Threads can have several PDFs and the same PDF is shared by many threads of that user
+# so we cache each doc once and combine the cached per-doc stats when a thread has multiple docs
+# (combining is just adding term counts, no re-tokenizing)
+
+BM25_CACHE_MAX_MB = int(os.environ.get("BM25_CACHE_MAX_MB", "256"))
+
+
+class BM25DocIndex:
+    """Tokenized BM25 statistics for all chunks of a single document of a single user."""
+
+    def __init__(self, docs: list[Document], preprocess_func=default_preprocessing_func):
+        self.docs = docs
+        self.doc_freqs = []  # one {term: count} dict per chunk
+        self.doc_len = []  # number of tokens per chunk
+        self.nd = {}  # term -> number of chunks that contain the term
+
+        for doc in docs:
+            tokens = preprocess_func(doc.page_content)
+            frequencies = {}
+            for token in tokens:
+                frequencies[token] = frequencies.get(token, 0) + 1
+            self.doc_freqs.append(frequencies)
+            self.doc_len.append(len(tokens))
+            for token in frequencies:
+                self.nd[token] = self.nd.get(token, 0) + 1
+
+        self.size_bytes = self._estimate_size()
+
+    def _estimate_size(self) -> int:
+        """Rough memory footprint (text + term dicts), used for LRU eviction by size."""
+        size = sys.getsizeof(self.nd)
+        for doc, frequencies in zip(self.docs, self.doc_freqs):
+            size += sys.getsizeof(doc.page_content) + sys.getsizeof(frequencies)
+        return size
+
+
+def combine_indexes(indexes: list[BM25DocIndex], k: int = 3) -> BM25Retriever:
+    """
+    Build a BM25Retriever from already tokenized per-doc indexes.
+    BM25Okapi only needs the per chunk term counts + the corpus wide document frequencies,
+    so we add them up instead of re-tokenizing the whole corpus.
+    """
+    docs, doc_freqs, doc_len, nd = [], [], [], {}
+    for index in indexes:
+        docs.extend(index.docs)
+        doc_freqs.extend(index.doc_freqs)
+        doc_len.extend(index.doc_len)
+        for term, count in index.nd.items():
+            nd[term] = nd.get(term, 0) + count
+
+    # same attributes BM25Okapi.__init__ would set, without running the tokenizer again
+    vectorizer = BM25Okapi.__new__(BM25Okapi)
+    vectorizer.k1, vectorizer.b, vectorizer.epsilon = 1.5, 0.75, 0.25
+    vectorizer.tokenizer = None
+    vectorizer.corpus_size = len(doc_len)
+    vectorizer.avgdl = sum(doc_len) / len(doc_len)
+    vectorizer.doc_freqs = doc_freqs
+    vectorizer.doc_len = doc_len
+    vectorizer.idf = {}
+    vectorizer._calc_idf(nd)
+
+    return BM25Retriever(vectorizer=vectorizer, docs=docs, k=k)
+
+
+class BM25IndexCache:
+    """
+    LRU cache of BM25DocIndex keyed by (user_id, doc_id), evicted by total memory size.
+    The retriever node runs it from run_in_threadpool so every access is guarded by a lock.
+    """
+
+    def __init__(self, max_bytes: int = BM25_CACHE_MAX_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple[str, str], BM25DocIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+
+        # counters exposed through /metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.builds = 0
+        self.build_time_ms = 0.0
+
+    def get(self, user_id: str, doc_id: str) -> BM25DocIndex | None:
+        key = (str(user_id), doc_id)
+        with self._lock:
+            index = self._entries.get(key)
+            if index is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)  # mark as most recently used
+            self.hits += 1
+            return index
+
+    def build(self, user_id: str, doc_id: str, docs: list[Document]) -> BM25DocIndex:
+        """Tokenize the chunks of one document and store the index (CPU bound - call from threadpool)."""
+        start = time.perf_counter()
+        index = BM25DocIndex(docs)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        key = (str(user_id), doc_id)
+        with self._lock:
+            self.builds += 1
+            self.build_time_ms += elapsed_ms
+
+            # an index bigger than the whole budget is returned but never cached
+            if index.size_bytes > self.max_bytes:
+                return index
+
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old.size_bytes
+            self._entries[key] = index
+            self.total_bytes += index.size_bytes
+
+            # evict least recently used docs until we are under the memory budget
+            while self.total_bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= evicted.size_bytes
+                self.evictions += 1
+        return index
+
+    def invalidate(self, user_id: str, doc_id: str):
+        """Drop the cached index of a doc (called by document_ingestion when the doc's chunks change)."""
+        with self._lock:
+            index = self._entries.pop((str(user_id), doc_id), None)
+            if index is not None:
+                self.total_bytes -= index.size_bytes
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "builds": self.builds,
+                "build_time_ms_total": round(self.build_time_ms, 2),
+                "build_time_ms_avg": round(self.build_time_ms / self.builds, 2) if self.builds else 0.0,
+            }
+
+
+# process wide cache shared by all requests of this worker
+bm25_cache = BM25IndexCache()
@@ -0,0 +1,128 @@
+import os
+import hashlib
+import threading
+
+
+# ============================ CONTENT ADDRESSED CHUNK EMBEDDINGS ============================
+# Collections are per user (user_{user_id}) so the same Constitution / PPC pdf uploaded by 200 users
+# used to be embedded 200 times.
+#
+# This store keeps chunk vectors keyed by sha256(embedding model + exact chunk text), in the
+# "chunk_embeddings" table (SQL in docs/database.md). The ingestion pipeline asks it first and only sends
+# the missing chunks to the embedding API, then writes the vectors into the user's own collection as before.
+#
+# Tenant isolation does not change: the user's PGVector rows and "documents" rows are still written per user.
+# The shared table only holds hash → vector (no text, no user_id), so it can not be used to read another user's pdf.
+# Any DB error is treated as a miss (the store must never break ingestion).
+#
+# Off by default (like EMBEDDING_CACHE_BACKEND=postgres): create the table first, then set
+# CHUNK_EMBEDDING_STORE_ENABLED=true. If it is enabled without the table, the first read / write finds it missing
+# (42P01), prints ONE warning and turns the store off for this worker.
+
+CHUNK_EMBEDDING_STORE_ENABLED = os.environ.get("CHUNK_EMBEDDING_STORE_ENABLED", "false").lower() == "true"
+_UNDEFINED_TABLE = "42P01"
+
+
+def _is_missing_table(error: Exception) -> bool:
+    """sqlalchemy error caused by an undefined table (psycopg 3: sqlstate, psycopg2: pgcode)"""
+    orig = getattr(error, "orig", None)
+    return (getattr(orig, "sqlstate", None) or getattr(orig, "pgcode", None)) == _UNDEFINED_TABLE
+
+
+class ChunkEmbeddingStore:
+    def __init__(self, engine_factory, enabled: bool = CHUNK_EMBEDDING_STORE_ENABLED):
+        self.engine_factory = engine_factory  # called lazily so the pool is the one opened in app lifespan
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.errors = 0
+
+    @staticmethod
+    def content_hash(model: str, text: str) -> str:
+        # exact text (no normalization): the vector must be the one the model returns for this chunk
+        return hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+    def _failed(self, operation: str, error: Exception):
+        if _is_missing_table(error):
+            with self._lock:
+                was_enabled, self.enabled = self.enabled, False
+            if was_enabled:
+                print("WARNING: chunk_embeddings table is missing (docs/database.md) → chunk embedding store disabled")
+            return
+        print(f"Chunk embedding store {operation} failed: {error}")
+
+    def _count(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def get_many(self, model: str, texts: list[str]) -> list[list[float] | None]:
+        """Vectors in the same order as texts (None for chunks never embedded with this model)."""
+        if not self.enabled or not texts:
+            return [None] * len(texts)
+        from sqlalchemy import text
+        keys = [self.content_hash(model, t) for t in texts]
+        try:
+            with self.engine_factory().connect() as conn:
+                rows = conn.execute(
+                    text(
+                        "SELECT content_hash, embedding FROM chunk_embeddings "
+                        "WHERE model = :model AND content_hash = ANY(:keys)"
+                    ),
+                    {"model": model, "keys": list(set(keys))},
+                ).all()
+        except Exception as e:
+            self._count(errors=1, misses=len(texts))
+            self._failed("read", e)
+            return [None] * len(texts)
+
+        found = {row[0]: list(row[1]) for row in rows}
+        vectors = [found.get(key) for key in keys]
+        hits = sum(v is not None for v in vectors)
+        self._count(hits=hits, misses=len(texts) - hits)
+        return vectors
+
+    def put_many(self, model: str, texts: list[str], vectors: list[list[float]]):
+        if not self.enabled or not texts:
+            return
+        from sqlalchemy import text
+        rows = [
+            {"key": self.content_hash(model, t), "model": model, "embedding": list(v)}
+            for t, v in zip(texts, vectors)
+        ]
+        try:
+            with self.engine_factory().begin() as conn:
+                conn.execute(
+                    text(
+                        "INSERT INTO chunk_embeddings (content_hash, model, embedding) "
+                        "VALUES (:key, :model, :embedding) ON CONFLICT (content_hash) DO NOTHING"
+                    ),
+                    rows,
+                )
+            self._count(stores=len(rows))
+        except Exception as e:
+            self._count(errors=1)
+            self._failed("write", e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "stores": self.stores,
+                "errors": self.errors,
+            }
+
+
+def _default_engine():
+    from src.db_connection.vectorstore import vectorstore_registry
+    return vectorstore_registry.init_pool()
+
+
+# process wide store on the pooled vectorstore engine
+chunk_embedding_store = ChunkEmbeddingStore(engine_factory=_default_engine)
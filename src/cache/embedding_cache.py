@@ -0,0 +1,227 @@
+import os
+import re
+import time
+import asyncio
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from langchain_core.embeddings import Embeddings
+
+
+# ============================ QUERY EMBEDDING CACHE ============================
+# Every retrieval (and the CRAG retry after query_transformer) embeds the query again through OpenAI (100-300 ms).
+# Popular statute questions repeat a lot across users, so we cache the query vector by its normalized text.
+#
+# 2 levels:
+# 1. in-process LRU (per worker) with TTL + max entries
+# 2. optional shared backend (postgres table "embedding_cache") so all uvicorn workers share their hits
+#    enable with EMBEDDING_CACHE_BACKEND=postgres (table SQL is in docs/database.md)
+#
+# Only embed_query is cached. embed_documents (ingestion) goes straight to the wrapped model.
+
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", "2000"))  # ~12 KB per 1536-d vector
+EMBEDDING_CACHE_TTL_S = int(os.environ.get("EMBEDDING_CACHE_TTL_S", str(24 * 3600)))
+EMBEDDING_CACHE_BACKEND = os.environ.get("EMBEDDING_CACHE_BACKEND", "memory")  # "memory" or "postgres"
+
+
+def normalize_query(text: str) -> str:
+    """ "  What is Section 420  PPC? " and "what is section 420 ppc?" share one cache entry """
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class InMemoryEmbeddingCache:
+    """Per process LRU with TTL. Vectors are stored as array('d') (~12 KB each instead of ~50 KB as a list of floats)."""
+
+    def __init__(self, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES, ttl_s: int = EMBEDDING_CACHE_TTL_S):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._entries: "OrderedDict[str, tuple[float, array]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> list[float] | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            created_at, vector = entry
+            if time.time() - created_at > self.ttl_s:
+                del self._entries[key]
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return list(vector)
+
+    def set(self, key: str, vector: list[float]):
+        with self._lock:
+            self._entries[key] = (time.time(), array("d", vector))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class PostgresEmbeddingCache:
+    """
+    Shared cache in the "embedding_cache" table, reached through the pooled vectorstore engine.
+    Expired rows are ignored on read and deleted every `cleanup_every` writes.
+    Any DB error is treated as a miss (the cache must never break retrieval).
+    """
+
+    def __init__(self, engine_factory, ttl_s: int = EMBEDDING_CACHE_TTL_S, cleanup_every: int = 500):
+        self.engine_factory = engine_factory  # called lazily so the pool is the one opened in app lifespan
+        self.ttl_s = ttl_s
+        self.cleanup_every = cleanup_every
+        self._writes = 0
+        self.errors = 0
+
+    def get(self, key: str) -> list[float] | None:
+        from sqlalchemy import text
+        try:
+            with self.engine_factory().connect() as conn:
+                row = conn.execute(
+                    text(
+                        "SELECT embedding FROM embedding_cache "
+                        "WHERE cache_key = :key AND created_at > now() - make_interval(secs => :ttl)"
+                    ),
+                    {"key": key, "ttl": self.ttl_s},
+                ).first()
+            return list(row[0]) if row else None
+        except Exception as e:
+            self.errors += 1
+            print(f"Embedding cache read failed: {e}")
+            return None
+
+    def set(self, key: str, vector: list[float], model: str = ""):
+        from sqlalchemy import text
+        try:
+            with self.engine_factory().begin() as conn:
+                conn.execute(
+                    text(
+                        "INSERT INTO embedding_cache (cache_key, model, embedding, created_at) "
+                        "VALUES (:key, :model, :embedding, now()) "
+                        "ON CONFLICT (cache_key) DO UPDATE SET embedding = EXCLUDED.embedding, created_at = now()"
+                    ),
+                    {"key": key, "model": model, "embedding": vector},
+                )
+                self._writes += 1
+                if self._writes % self.cleanup_every == 0:
+                    conn.execute(
+                        text("DELETE FROM embedding_cache WHERE created_at < now() - make_interval(secs => :ttl)"),
+                        {"ttl": self.ttl_s},
+                    )
+        except Exception as e:
+            self.errors += 1
+            print(f"Embedding cache write failed: {e}")
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Drop-in wrapper around an Embeddings object (EMBEDDING in src/agent/model_loader.py).
+    PGVector only calls embed_query for searches, so wrapping the model is enough to cache dense retrieval.
+    """
+
+    def __init__(self, embeddings: Embeddings, local: InMemoryEmbeddingCache | None = None, shared=None):
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, "model", embeddings.__class__.__name__)
+        self.local = local if local is not None else InMemoryEmbeddingCache()
+        self.shared = shared
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.embed_time_ms = 0.0
+
+    def cache_key(self, text: str) -> str:
+        # model name is part of the key so switching embedding model never returns old vectors
+        return hashlib.sha256(f"{self.model}\n{normalize_query(text)}".encode("utf-8")).hexdigest()
+
+    def _count(self, counter: str, embed_ms: float = 0.0):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            self.embed_time_ms += embed_ms
+
+    def _lookup(self, key: str) -> list[float] | None:
+        vector = self.local.get(key)
+        if vector is not None:
+            self._count("hits")
+            return vector
+        if self.shared is not None:
+            vector = self.shared.get(key)
+            if vector is not None:
+                self.local.set(key, vector)
+                self._count("shared_hits")
+                return vector
+        return None
+
+    def _store(self, key: str, vector: list[float]):
+        self.local.set(key, vector)
+        if self.shared is not None:
+            self.shared.set(key, vector, model=self.model)
+
+    def embed_query(self, text: str) -> list[float]:
+        key = self.cache_key(text)
+        vector = self._lookup(key)
+        if vector is not None:
+            return vector
+
+        start = time.perf_counter()
+        vector = self.embeddings.embed_query(text)
+        self._count("misses", (time.perf_counter() - start) * 1000)
+        self._store(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        key = self.cache_key(text)
+        # shared lookup is a blocking DB call so run it off the event loop
+        vector = await asyncio.to_thread(self._lookup, key) if self.shared is not None else self._lookup(key)
+        if vector is not None:
+            return vector
+
+        start = time.perf_counter()
+        vector = await self.embeddings.aembed_query(text)
+        self._count("misses", (time.perf_counter() - start) * 1000)
+        if self.shared is not None:
+            await asyncio.to_thread(self._store, key, vector)
+        else:
+            self._store(key, vector)
+        return vector
+
+    # documents (ingestion) are not cached here
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self.embeddings.aembed_documents(texts)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.shared_hits + self.misses
+        return {
+            "backend": "postgres" if self.shared is not None else "memory",
+            "entries": len(self.local),
+            "max_entries": self.local.max_entries,
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.shared_hits) / lookups, 4) if lookups else 0.0,
+            "evictions": self.local.evictions,
+            "expirations": self.local.expirations,
+            "shared_errors": getattr(self.shared, "errors", 0),
+            "miss_embed_ms_avg": round(self.embed_time_ms / self.misses, 2) if self.misses else 0.0,
+        }
+
+
+def build_cached_embeddings(embeddings: Embeddings, backend: str = EMBEDDING_CACHE_BACKEND) -> CachedEmbeddings:
+    """Wrap an embedding model with the in-process cache (+ the postgres shared cache when backend="postgres")."""
+    shared = None
+    if backend == "postgres":
+        from src.db_connection.vectorstore import vectorstore_registry
+        shared = PostgresEmbeddingCache(engine_factory=vectorstore_registry.init_pool)
+    elif backend != "memory":
+        raise ValueError(f"Unknown EMBEDDING_CACHE_BACKEND '{backend}', expected 'memory' or 'postgres'")
+    return CachedEmbeddings(embeddings, shared=shared)
@@ -0,0 +1,176 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+from langchain_postgres import PGVector
+
+from src.db_connection.connection import CONNECTION_STRING
+
+
+# ============================ SHARED PGVECTOR REGISTRY ============================
+# Before this every retriever / document_ingestion call created a new PGVector with NullPool
+# ==> new postgres connection + "create extension / create collection" lookup on every question.
+# Now we keep ONE pooled engine per process and ONE PGVector per collection (user_{user_id}).
+#
+# Pool is created in backend/app.py lifespan (init_pool) and disposed on shutdown.
+# If the graph is used without FastAPI (CLI / langgraph studio) the pool is created lazily on first use.
+#
+# Creating a PGVector runs the extension / collection lookup (DB round trips), so it holds a lock of ITS collection
+# only: a new user's first question no longer blocks every other user's retrieval. At most VECTOR_STORE_CACHE_MAX
+# collections are kept (least recently used evicted). Evicted stores share the pooled engine, their sessions are
+# closed after each call, so dropping them frees them; a store with its own engine gets it disposed.
+
+VECTOR_DB_POOL_SIZE = int(os.environ.get("VECTOR_DB_POOL_SIZE", "5"))  # connections kept open
+VECTOR_DB_MAX_OVERFLOW = int(os.environ.get("VECTOR_DB_MAX_OVERFLOW", "10"))  # extra connections under burst
+VECTOR_DB_POOL_TIMEOUT = float(os.environ.get("VECTOR_DB_POOL_TIMEOUT", "30"))  # seconds to wait for a free connection
+VECTOR_DB_POOL_RECYCLE = int(os.environ.get("VECTOR_DB_POOL_RECYCLE", "1800"))  # recycle connections older than this (seconds)
+VECTOR_STORE_CACHE_MAX = int(os.environ.get("VECTOR_STORE_CACHE_MAX", "1000"))  # PGVector instances kept (LRU)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool that records how long callers wait for a connection and how old the handed out connections are.
+    QueuePool._do_get calls itself when it loses a race, so only the outermost call is timed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._local = threading.local()
+        self.checkouts = 0
+        self.checkout_errors = 0  # pool timeouts + failed connects
+        self.wait_ms_total = 0.0
+        self.wait_ms_max = 0.0
+        self.connection_age_s_total = 0.0
+        self.connection_age_s_max = 0.0
+
+    def _do_get(self):
+        if getattr(self._local, "in_get", False):
+            return super()._do_get()
+
+        self._local.in_get = True
+        start = time.perf_counter()
+        try:
+            record = super()._do_get()
+        except Exception:
+            self.checkout_errors += 1
+            raise
+        finally:
+            self._local.in_get = False
+
+        wait_ms = (time.perf_counter() - start) * 1000
+        age_s = time.time() - record.starttime if getattr(record, "starttime", None) else 0.0
+        self.checkouts += 1
+        self.wait_ms_total += wait_ms
+        self.wait_ms_max = max(self.wait_ms_max, wait_ms)
+        self.connection_age_s_total += age_s
+        self.connection_age_s_max = max(self.connection_age_s_max, age_s)
+        return record
+
+
+class VectorStoreRegistry:
+    """Process wide PGVector instances keyed by collection name, all sharing one bounded connection pool."""
+
+    def __init__(self, connection_string: str = CONNECTION_STRING, max_stores: int = VECTOR_STORE_CACHE_MAX):
+        self.connection_string = connection_string
+        self.max_stores = max_stores
+        self.engine = None
+        self._stores: OrderedDict[str, PGVector] = OrderedDict()
+        self._creating: dict[str, threading.Lock] = {}  # per collection lock while its PGVector is created
+        self._lock = threading.Lock()  # guards engine / _stores / _creating (never held during a DB call)
+        self.evicted = 0
+
+    def init_pool(self):
+        """Create the shared engine (bounded + pre-ping health check). Safe to call more than once."""
+        with self._lock:
+            if self.engine is None:
+                self.engine = create_engine(
+                    self.connection_string,
+                    poolclass=InstrumentedQueuePool,
+                    pool_size=VECTOR_DB_POOL_SIZE,
+                    max_overflow=VECTOR_DB_MAX_OVERFLOW,
+                    pool_timeout=VECTOR_DB_POOL_TIMEOUT,
+                    pool_recycle=VECTOR_DB_POOL_RECYCLE,
+                    pool_pre_ping=True,  # avoid using stale connections (supabase pooler drops idle ones)
+                )
+                print("Vectorstore connection pool ready")
+            return self.engine
+
+    def get(self, collection_name: str, embeddings) -> PGVector:
+        """
+        Return the cached PGVector for a collection, creating it on first use.
+        Creating runs the extension/collection lookup once (blocking DB call - call from threadpool).
+        """
+        with self._lock:
+            store = self._stores.get(collection_name)
+            if store is not None:
+                self._stores.move_to_end(collection_name)
+                return store
+            key_lock = self._creating.setdefault(collection_name, threading.Lock())
+
+        engine = self.init_pool()
+        with key_lock:
+            with self._lock:
+                store = self._stores.get(collection_name)  # created while we waited for key_lock
+            if store is None:
+                store = PGVector(
+                    connection=engine,
+                    collection_name=collection_name,
+                    embeddings=embeddings,
+                    use_jsonb=True,
+                )
+            with self._lock:
+                self._stores[collection_name] = store
+                self._stores.move_to_end(collection_name)
+                if self._creating.get(collection_name) is key_lock:
+                    del self._creating[collection_name]
+                evicted = []
+                while len(self._stores) > self.max_stores:
+                    evicted.append(self._stores.popitem(last=False)[1])
+                self.evicted += len(evicted)
+        for old_store in evicted:
+            self._close_store(old_store)
+        return store
+
+    def _close_store(self, store: PGVector):
+        """evicted store: only an engine of its own is disposed, the shared pool stays"""
+        own_engine = getattr(store, "_engine", None)
+        if own_engine is not None and own_engine is not self.engine:
+            own_engine.dispose()
+
+    def close(self):
+        """Dispose the pool on shutdown (called from backend/app.py lifespan)."""
+        with self._lock:
+            self._stores.clear()
+            if self.engine is not None:
+                self.engine.dispose()
+                self.engine = None
+
+    def stats(self) -> dict:
+        if self.engine is None:
+            return {"pool_initialized": False, "collections": len(self._stores), "evicted_collections": self.evicted}
+
+        pool = self.engine.pool
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        checked_out = pool.checkedout()
+        return {
+            "pool_initialized": True,
+            "collections": len(self._stores),
+            "evicted_collections": self.evicted,
+            "pool_size": pool.size(),
+            "max_overflow": pool._max_overflow,
+            "checked_out": checked_out,
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "saturation": round(checked_out / capacity, 4) if capacity else 0.0,
+            "checkouts": getattr(pool, "checkouts", 0),
+            "checkout_errors": getattr(pool, "checkout_errors", 0),
+            "wait_ms_avg": round(pool.wait_ms_total / pool.checkouts, 2) if getattr(pool, "checkouts", 0) else 0.0,
+            "wait_ms_max": round(getattr(pool, "wait_ms_max", 0.0), 2),
+            "connection_age_s_avg": round(pool.connection_age_s_total / pool.checkouts, 2) if getattr(pool, "checkouts", 0) else 0.0,
+            "connection_age_s_max": round(getattr(pool, "connection_age_s_max", 0.0), 2),
+        }
+
+
+vectorstore_registry = VectorStoreRegistry()
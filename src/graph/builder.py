@@ -1,12 +1,19 @@
 import os,sys
 from dotenv import load_dotenv
 from src.graph.nodes import GraphNodes,AgentState
+from src.graph.speculative import SPECULATIVE_RETRIEVAL
 load_dotenv()
 
 
 from src.agent.model_loader import llm,EMBEDDING
 from src.db_connection.connection import supabase_client
 from langgraph.graph import START,END,StateGraph
+from langgraph.constants import TAG_NOSTREAM
+from langchain_core.runnables import RunnableLambda
+
+# "background": summarize is not part of the answer run, backend/services/background_summary.py runs it after the
+# stream closed and writes it into the checkpoint as the summarize node. "inline": old agent_response → summarize edge
+SUMMARY_MODE = os.environ.get("SUMMARY_MODE", "background").lower()
 
 
 nodes = GraphNodes(embedding_model=EMBEDDING,
@@ -15,50 +22,98 @@ nodes = GraphNodes(embedding_model=EMBEDDING,
 
 
 
+def no_stream(node, name: str):
+    """
+    Node whose LLM calls (rewriter, grader, summary) must not be streamed to the user.
+    The tag is inherited by the LLM runs inside the node, so stream_mode="messages" skips their tokens
+    instead of sending them to stream_graph only to be filtered out there.
+    """
+    return RunnableLambda(node, name=name).with_config(tags=[TAG_NOSTREAM])
+
+
+
 class GraphBuilder:
-    def __init__(self,checkpointer):
+    def __init__(self,checkpointer,grading_mode=None,speculative_retrieval=None,summary_mode=None):
         self.app = None
         self.checkpointer = checkpointer
+        self.summary_mode = summary_mode or SUMMARY_MODE
+        # retrieve on raw question + conversation keywords while query_rewriter runs (None = SPECULATIVE_RETRIEVAL env)
+        self.speculative_retrieval = SPECULATIVE_RETRIEVAL if speculative_retrieval is None else speculative_retrieval
+        # CRAG grading mode ("batched" / "per_doc" / "local"), None = CRAG_GRADING_MODE env default of the shared nodes
+        self.nodes = nodes
+        if grading_mode and grading_mode != nodes.grading_mode:
+            self.nodes = GraphNodes(embedding_model=EMBEDDING,
+                                    llm=llm,
+                                    supbase_client=supabase_client,
+                                    grading_mode=grading_mode,
+                                    embedding_uploader=nodes.embedding_uploader)  # keep one in-flight limit per process
 
     
     def build_graph(self):
         workflow = StateGraph(AgentState)
         # nodes
-        workflow.add_node("document_ingestion",nodes.document_ingestion)
-        workflow.add_node("query_rewriter", nodes.query_rewriter)
-        workflow.add_node("retriever", nodes.retriever)
-
-        workflow.add_node("retrieval_grader", nodes.retrieval_grader)  # CRAG: grade docs
-        workflow.add_node("query_transformer", nodes.query_transformer)  # CRAG: rewrite query on retry
+        workflow.add_node("document_ingestion",self.nodes.document_ingestion)
+        workflow.add_node("query_rewriter", no_stream(self.nodes.query_rewriter, "query_rewriter"))
+        workflow.add_node("answer_cache_lookup", self.nodes.answer_cache_lookup)  # semantic answer cache
+        workflow.add_node("retriever", self.nodes.retriever)
+        if self.speculative_retrieval:
+            workflow.add_node("speculative_retriever", self.nodes.speculative_retriever)
+
+        workflow.add_node("retrieval_grader", no_stream(self.nodes.retrieval_grader, "retrieval_grader"))  # CRAG: grade docs
+        workflow.add_node("query_transformer", no_stream(self.nodes.query_transformer, "query_transformer"))  # CRAG: rewrite query on retry
         
-        workflow.add_node("context_builder", nodes.context_builder)
-        workflow.add_node("agent_response", nodes.agent_response)
-        workflow.add_node("summarize", nodes.summary_creation)
-        workflow.add_node("check_pdf", nodes.check_pdf_already_uploaded)
-        workflow.add_node("set_doc_id", nodes.set_doc_id)
+        workflow.add_node("context_builder", self.nodes.context_builder)
+        workflow.add_node("agent_response", self.nodes.agent_response)
+        workflow.add_node("summarize", no_stream(self.nodes.summary_creation, "summarize"))
+        workflow.add_node("check_pdf", self.nodes.check_pdf_already_uploaded)
+        workflow.add_node("set_doc_id", self.nodes.set_doc_id)
 
         # edges
         workflow.add_edge(START, "set_doc_id")
         workflow.add_edge("set_doc_id", "check_pdf")
+        if self.speculative_retrieval:
+            # query_rewriter (LLM) and speculative_retriever run in parallel, answer_cache_lookup waits for both
+            workflow.add_conditional_edges(
+                "check_pdf",
+                self.speculative_route,
+                {
+                    "document_ingestion": "document_ingestion",
+                    "query_rewriter": "query_rewriter",
+                    "speculative_retriever": "speculative_retriever"
+                }
+            )
+            workflow.add_edge("document_ingestion", "query_rewriter")
+            workflow.add_edge("document_ingestion", "speculative_retriever")  # after ingestion: new docs are searchable
+            workflow.add_edge(["query_rewriter", "speculative_retriever"], "answer_cache_lookup")
+        else:
+            workflow.add_conditional_edges(
+                "check_pdf",
+                self.nodes.conditional,
+                {
+                    "document_ingestion": "document_ingestion",
+                    "query_rewriter": "query_rewriter"
+                }
+            )
+
+            # if new vector store path
+            workflow.add_edge("document_ingestion","query_rewriter")
+
+            workflow.add_edge("query_rewriter", "answer_cache_lookup")
+        # cache hit → done (cached answer is replayed by stream_graph), miss → normal retrieval
         workflow.add_conditional_edges(
-            "check_pdf",
-            nodes.conditional,
+            "answer_cache_lookup",
+            self.nodes.answer_cache_route,
             {
-                "document_ingestion": "document_ingestion",
-                "query_rewriter": "query_rewriter"
+                "cached": END,
+                "retriever": "retriever"
             }
         )
 
-        # if new vector store path
-        workflow.add_edge("document_ingestion","query_rewriter")
-
-        workflow.add_edge("query_rewriter", "retriever")
-
         # CRAG: retriever → grade docs → decide (generate or retry)
         workflow.add_edge("retriever", "retrieval_grader")
         workflow.add_conditional_edges(
             "retrieval_grader",
-            nodes.decide_to_generate,
+            self.nodes.decide_to_generate,
             {
                 "context_builder": "context_builder",
                 "query_transformer": "query_transformer"
@@ -68,14 +123,18 @@ class GraphBuilder:
 
         workflow.add_edge("context_builder", "agent_response")
 
-        workflow.add_conditional_edges(
-            "agent_response",
-            nodes.should_summzarizer,
-            {
-                True: "summarize",
-                False: END
-            }
-        )
+        if self.summary_mode == "inline":
+            workflow.add_conditional_edges(
+                "agent_response",
+                self.nodes.should_summzarizer,
+                {
+                    True: "summarize",
+                    False: END
+                }
+            )
+        else:
+            # answer run ends here, summarize is only the target of the background summary's update_state
+            workflow.add_edge("agent_response", END)
         workflow.add_edge("summarize", END)
 
         self.app = workflow.compile(checkpointer=self.checkpointer)
@@ -83,6 +142,13 @@ class GraphBuilder:
     
 
 
+    def speculative_route(self, state: AgentState):
+        """check_pdf fan out: ingestion first, else rewrite + speculative retrieval at the same time"""
+        route = self.nodes.conditional(state)
+        return ["query_rewriter", "speculative_retriever"] if route == "query_rewriter" else route
+
+
+
     def __call__(self):
         return self.build_graph()
 
@@ -0,0 +1,202 @@
+import os
+import threading
+from src.ingestion.embedder import TokenCounter
+
+
+# ======================== TOKEN BUDGETED CONTEXT PACKING ========================
+# Before: context_builder joined every retrieved doc as is. Chunks are split with chunk_overlap=200, so two
+# neighbouring chunks of the same pdf repeat up to 200 chars, the same text could come twice and nothing limited
+# the prompt size.
+#
+# Now the retrieved docs are packed:
+#   1. merge  ==> chunks of the same doc with consecutive chunk_index become ONE block, the overlap is kept once
+#   2. dedupe ==> a block whose text is already inside another block is dropped
+#   3. pack   ==> blocks are added in retrieval rank order while they fit in CONTEXT_TOKEN_BUDGET tokens
+#                 (the best block is always kept, cut down to the budget if it is larger on its own)
+# Token counts come from metadata["token_count"], counted at ingestion (src/ingestion/pipeline.py) so nothing is
+# tokenized here. Chunks ingested before that are counted with tiktoken on the fly.
+# The counts use the embedding model encoding, close enough to the chat model for a budget.
+# CONTEXT_PACKING=false ==> old join of all docs.
+
+CONTEXT_PACKING = os.environ.get("CONTEXT_PACKING", "true").lower() == "true"
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "3000"))
+MAX_OVERLAP_CHARS = 400  # longest overlap searched between two neighbouring chunks (splitter uses 200)
+OVERLAP_PROBE_CHARS = 32  # start of the next chunk searched in the tail of the previous one
+HEADER_TOKENS = 15  # "[Source: <file> - Page <n>]" line per block
+
+
+def overlap_length(previous: str, following: str, max_chars: int = MAX_OVERLAP_CHARS) -> int:
+    """length of the longest suffix of previous that is also a prefix of following (0 if none)"""
+    if not previous or not following:
+        return 0
+    probe = following[:min(OVERLAP_PROBE_CHARS, len(following))]
+    tail_start = max(0, len(previous) - max_chars)
+    position = previous.find(probe, tail_start)
+    while position != -1:
+        length = len(previous) - position
+        if following.startswith(previous[position:]):
+            return length
+        position = previous.find(probe, position + 1)
+    return 0
+
+
+class _Block:
+    """merged neighbouring chunks of one doc"""
+    __slots__ = ("doc_id", "file_name", "first_index", "last_index", "pages", "text", "tokens", "rank")
+
+    def __init__(self, doc, tokens: int, rank: int):
+        self.doc_id = doc.metadata.get("doc_id")
+        self.file_name = doc.metadata.get("file_name", "Unknown")
+        self.first_index = self.last_index = doc.metadata.get("chunk_index")
+        self.pages = [doc.metadata.get("page", "N/A")]
+        self.text = doc.page_content
+        self.tokens = tokens
+        self.rank = rank  # best retrieval rank of its chunks
+
+    def append(self, doc, tokens: int, rank: int):
+        text = doc.page_content
+        overlap = overlap_length(self.text, text)
+        new_text = text[overlap:]
+        # tokens of the non repeated part, estimated from the precomputed count
+        self.tokens += round(tokens * len(new_text) / len(text)) if text else 0
+        self.text += new_text if overlap else "\n" + new_text
+        self.last_index = doc.metadata.get("chunk_index")
+        page = doc.metadata.get("page", "N/A")
+        if page not in self.pages:
+            self.pages.append(page)
+        self.rank = min(self.rank, rank)
+        return overlap
+
+    def header(self) -> str:
+        pages = f"Page {self.pages[0]}" if len(self.pages) == 1 else f"Pages {self.pages[0]}-{self.pages[-1]}"
+        return f"[Source: {self.file_name} - {pages}]"
+
+
+class ContextPacker:
+    """merges, dedupes and packs retrieved docs into the prompt context (stats served on /metrics)"""
+
+    def __init__(self, token_budget: int = CONTEXT_TOKEN_BUDGET, enabled: bool = CONTEXT_PACKING, token_counter=None):
+        self.token_budget = token_budget
+        self.enabled = enabled
+        self.token_counter = token_counter or TokenCounter()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.chunks_in = 0
+        self.blocks_out = 0
+        self.merged = 0
+        self.deduped = 0
+        self.dropped = 0  # blocks that did not fit in the budget
+        self.tokens_in = 0  # sum of the retrieved chunks
+        self.tokens_out = 0  # packed context
+        self.counted_on_the_fly = 0  # chunks without a precomputed token_count
+
+    def _tokens(self, doc) -> tuple[int, bool]:
+        """(token count, counted on the fly)"""
+        count = doc.metadata.get("token_count")
+        if count is None:
+            return self.token_counter.count(doc.page_content), True
+        return count, False
+
+    def merge(self, ranked) -> tuple[list[_Block], int, int]:
+        """
+        neighbouring chunks (same doc, consecutive chunk_index) → one block, exact / contained repeats dropped
+        ranked = (doc, tokens, rank) per retrieved doc, returns (blocks in rank order, merged, deduped)
+        """
+        merged = deduped = 0
+        # chunks without chunk_index can not be merged, they keep their own block
+        mergeable = sorted(
+            (item for item in ranked if item[0].metadata.get("chunk_index") is not None),
+            key=lambda item: (str(item[0].metadata.get("doc_id")), item[0].metadata["chunk_index"]),
+        )
+        blocks = []
+        for doc, tokens, rank in mergeable:
+            last = blocks[-1] if blocks else None
+            if last is not None and last.doc_id == doc.metadata.get("doc_id"):
+                if doc.metadata["chunk_index"] == last.last_index:  # same chunk twice (BM25 + dense copies)
+                    last.rank = min(last.rank, rank)
+                    deduped += 1
+                    continue
+                if doc.metadata["chunk_index"] == last.last_index + 1:
+                    last.append(doc, tokens, rank)
+                    merged += 1
+                    continue
+            blocks.append(_Block(doc, tokens, rank))
+        blocks += [_Block(doc, tokens, rank) for doc, tokens, rank in ranked if doc.metadata.get("chunk_index") is None]
+
+        # repeated text across blocks (same passage in two docs / a chunk inside a merged block)
+        blocks.sort(key=lambda b: len(b.text), reverse=True)
+        unique = []
+        for block in blocks:
+            container = next((kept for kept in unique if block.text in kept.text), None)
+            if container is not None:
+                container.rank = min(container.rank, block.rank)
+                deduped += 1
+                continue
+            unique.append(block)
+        unique.sort(key=lambda b: b.rank)
+        return unique, merged, deduped
+
+    def pack(self, docs) -> str:
+        """context text for the prompt"""
+        if not self.enabled:
+            return "\n\n".join(
+                f"[Source: {doc.metadata.get('file_name', 'Unknown')} - Page {doc.metadata.get('page', 'N/A')}]\n"
+                f"{doc.page_content}"
+                for doc in docs
+            )
+
+        # counting (tiktoken for chunks without token_count), merging and packing touch no shared state,
+        # the lock only guards the stats so concurrent requests never wait on each other's tokenizing
+        ranked, on_the_fly = [], 0
+        for rank, doc in enumerate(docs):
+            tokens, counted = self._tokens(doc)
+            ranked.append((doc, tokens, rank))
+            on_the_fly += counted
+        blocks, merged, deduped = self.merge(ranked)
+
+        packed, used, dropped = [], 0, 0
+        for block in blocks:
+            cost = block.tokens + HEADER_TOKENS
+            if used + cost <= self.token_budget:
+                packed.append(f"{block.header()}\n{block.text}")
+                used += cost
+            elif not packed:
+                # best block alone is over the budget → keep its start
+                keep = max(0, self.token_budget - HEADER_TOKENS)
+                text = block.text[:len(block.text) * keep // max(block.tokens, 1)]
+                packed.append(f"{block.header()}\n{text}")
+                used = self.token_budget
+            else:
+                dropped += 1
+
+        with self._lock:
+            self.calls += 1
+            self.chunks_in += len(docs)
+            self.blocks_out += len(packed)
+            self.merged += merged
+            self.deduped += deduped
+            self.dropped += dropped
+            self.tokens_in += sum(tokens + HEADER_TOKENS for _, tokens, _ in ranked)
+            self.tokens_out += used
+            self.counted_on_the_fly += on_the_fly
+        return "\n\n".join(packed)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "token_budget": self.token_budget,
+                "calls": self.calls,
+                "chunks_in": self.chunks_in,
+                "blocks_out": self.blocks_out,
+                "merged": self.merged,
+                "deduped": self.deduped,
+                "dropped": self.dropped,
+                "tokens_in": self.tokens_in,
+                "tokens_out": self.tokens_out,
+                "tokens_saved_pct": round(100 * (1 - self.tokens_out / self.tokens_in), 1) if self.tokens_in else 0.0,
+                "counted_on_the_fly": self.counted_on_the_fly,
+            }
+
+
+context_packer = ContextPacker()
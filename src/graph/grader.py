@@ -0,0 +1,278 @@
+import os
+import re
+import asyncio
+import threading
+from pydantic import BaseModel, Field
+from langchain_core.messages import HumanMessage
+
+
+# ======================== CRAG RELEVANCE GRADING ========================
+# retrieval_grader can grade the retrieved docs in three ways:
+# "per_doc" ==> one LLM call per document (4 docs = 4 round trips + 4x the prompt tokens)
+# "batched" ==> ONE structured-output call grades every doc and returns a verdict per doc
+#               if the structured output can not be parsed we fall back to per_doc grading
+# "local"   ==> no LLM on the critical path, docs are scored from BM25 score + dense similarity + query term coverage
+#               only borderline docs (between the two thresholds) are sent to the LLM (batched)
+# Mode is chosen in GraphBuilder (default comes from CRAG_GRADING_MODE env variable)
+
+GRADING_MODES = ("batched", "per_doc", "local")
+CRAG_GRADING_MODE = os.environ.get("CRAG_GRADING_MODE", "batched")
+
+MAX_DOC_CHARS = 1000  # Limit each doc to first 1000 chars to save tokens
+
+
+GRADER_PROMPT = """You are a document relevance grader.
+        Your job is to assess whether a retrieved document is relevant to the user's query.
+
+        Query: {query}
+
+        Document:
+        {document}
+
+        Does this document contain information relevant to answering the query?
+        Respond with ONLY one word: "relevant" or "irrelevant"
+        """
+
+
+BATCH_GRADER_PROMPT = """You are a document relevance grader.
+        Your job is to assess whether EACH retrieved document is relevant to the user's query.
+
+        Query: {query}
+
+        Documents:
+        {documents}
+
+        For every document return its index and whether it contains information relevant to answering the query.
+        """
+
+
+class DocumentGrade(BaseModel):
+    index: int = Field(description="Index of the document exactly as shown in [Document N]")
+    relevant: bool = Field(description="True if the document is relevant to the query")
+
+
+class BatchGrades(BaseModel):
+    grades: list[DocumentGrade] = Field(description="One grade per document")
+
+
+async def grade_single_doc(llm, query: str, doc) -> bool:
+    """Grade a single document for relevance."""
+    prompt = GRADER_PROMPT.format(
+        query=query,
+        document=doc.page_content[:MAX_DOC_CHARS]
+    )
+    result = await llm.ainvoke([HumanMessage(content=prompt)])
+    verdict = result.content.strip().lower()
+    # "irrelevant" also contains "relevant" so check it first
+    return "irrelevant" not in verdict and "relevant" in verdict
+
+
+async def grade_per_doc(llm, query: str, docs) -> list[bool]:
+    """Grade all documents in parallel, each one independently (one LLM call per doc)."""
+    return list(await asyncio.gather(*[grade_single_doc(llm, query, doc) for doc in docs]))
+
+
+async def grade_batched(llm, query: str, docs) -> tuple[list[bool], bool]:
+    """
+    Grade all documents with ONE structured-output LLM call.
+    Returns (verdicts, fell_back).
+    - whole batch fails to parse ==> every doc is graded per_doc
+    - some indexes missing in the answer ==> only those docs are graded per_doc
+    """
+    documents = "\n\n".join(
+        f"[Document {i}]\n{doc.page_content[:MAX_DOC_CHARS]}"
+        for i, doc in enumerate(docs)
+    )
+    prompt = BATCH_GRADER_PROMPT.format(query=query, documents=documents)
+
+    try:
+        result = await llm.with_structured_output(BatchGrades).ainvoke([HumanMessage(content=prompt)])
+        grades = {g.index: g.relevant for g in result.grades}
+    except Exception as e:
+        print(f"[CRAG] Batched grading could not be parsed ({e}) → falling back to per-doc grading")
+        return await grade_per_doc(llm, query, docs), True
+
+    missing = [i for i in range(len(docs)) if i not in grades]
+    if missing:
+        print(f"[CRAG] Batched grading missed {len(missing)} docs → grading them one by one")
+        missing_verdicts = await grade_per_doc(llm, query, [docs[i] for i in missing])
+        grades.update(zip(missing, missing_verdicts))
+
+    return [grades[i] for i in range(len(docs))], bool(missing)
+
+
+# ----------------------- local (non-LLM) grader -----------------------
+# The defaults are starting points, NOT fitted on labelled data yet. Every value is env configurable so it can be
+# re-calibrated: run with CRAG_GRADING_MODE=local and LOCAL_GRADER_DEBUG=true, compare the printed scores with the
+# LLM verdicts of the borderline docs (and with CRAG_GRADING_MODE=batched on the same questions), move the values.
+# Where the defaults come from:
+# - dense floor / ceiling 0.15 / 0.55: cosine similarities of text-embedding-3-small are compressed, unrelated
+#   legal passages still score ~0.1-0.2 against a question, passages answering it usually 0.5+
+# - bm25 saturation 5: BM25 of a short question against ~1000 char chunks is ~0-15, s / (s + 5) = 0.5 at 5
+# - weights 0.4 / 0.3 / 0.3: coverage is the only signal every doc has (BM25 / dense are missing for docs found
+#   by the other retriever only) and the one that catches a wrong section number, so it weighs the most
+# - thresholds 0.5 / 0.3: a doc needs about half of the query terms plus one strong retrieval score to skip the LLM,
+#   less than a third of the terms and weak scores is dropped without it
+LOCAL_GRADER_RELEVANT_THRESHOLD = float(os.environ.get("LOCAL_GRADER_RELEVANT_THRESHOLD", "0.5"))
+LOCAL_GRADER_IRRELEVANT_THRESHOLD = float(os.environ.get("LOCAL_GRADER_IRRELEVANT_THRESHOLD", "0.3"))
+LOCAL_GRADER_WEIGHTS = {
+    "coverage": float(os.environ.get("LOCAL_GRADER_WEIGHT_COVERAGE", "0.4")),
+    "bm25": float(os.environ.get("LOCAL_GRADER_WEIGHT_BM25", "0.3")),
+    "dense": float(os.environ.get("LOCAL_GRADER_WEIGHT_DENSE", "0.3")),
+}
+LOCAL_GRADER_BM25_SATURATION = float(os.environ.get("LOCAL_GRADER_BM25_SATURATION", "5.0"))
+LOCAL_GRADER_DENSE_FLOOR = float(os.environ.get("LOCAL_GRADER_DENSE_FLOOR", "0.15"))
+LOCAL_GRADER_DENSE_CEILING = float(os.environ.get("LOCAL_GRADER_DENSE_CEILING", "0.55"))
+LOCAL_GRADER_DEBUG = os.environ.get("LOCAL_GRADER_DEBUG", "false").lower() == "true"  # print every doc's signals
+
+# a few english stop words so "what is the punishment for" does not count as coverage
+STOP_WORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "been", "of", "in", "on", "for", "to", "and", "or",
+    "what", "which", "who", "whom", "how", "when", "where", "why", "does", "do", "did", "can", "could",
+    "under", "by", "with", "as", "at", "from", "this", "that", "these", "those", "it", "its", "any",
+    "there", "about", "me", "my", "i", "you", "your", "tell", "explain", "please", "if", "into", "per",
+}
+
+
+def tokenize(text: str) -> list[str]:
+    """lowercase word/number tokens (keeps section numbers like 420 or 302)"""
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def stem(token: str) -> str:
+    """very light stemming: "punishment" / "punished" / "punishable" all become "punis" """
+    return token[:5]
+
+
+def query_term_coverage(query: str, text: str) -> float:
+    """fraction of the (non stop word) query terms that appear in the document"""
+    terms = {stem(t) for t in tokenize(query) if t not in STOP_WORDS}
+    if not terms:
+        return 0.0
+    doc_terms = {stem(t) for t in tokenize(text)}
+    return len(terms & doc_terms) / len(terms)
+
+
+class LocalRelevanceGrader:
+    """
+    Scores relevance without any network call.
+    Signals (all mapped to 0-1):
+    - coverage   → query_term_coverage of the doc
+    - bm25       → doc.metadata["bm25_score"] squashed with s / (s + bm25_saturation)
+    - dense      → doc.metadata["dense_score"] (cosine relevance) rescaled between dense_floor and dense_ceiling
+    Missing signals are skipped and the remaining weights re-normalized.
+
+    score >= relevant_threshold   → relevant
+    score <  irrelevant_threshold → irrelevant
+    in between                    → borderline (asked to the LLM if one is given, else score >= midpoint)
+    """
+
+    def __init__(
+        self,
+        relevant_threshold: float = LOCAL_GRADER_RELEVANT_THRESHOLD,
+        irrelevant_threshold: float = LOCAL_GRADER_IRRELEVANT_THRESHOLD,
+        weights: dict | None = None,
+        bm25_saturation: float = LOCAL_GRADER_BM25_SATURATION,
+        dense_floor: float = LOCAL_GRADER_DENSE_FLOOR,
+        dense_ceiling: float = LOCAL_GRADER_DENSE_CEILING,
+        debug: bool = LOCAL_GRADER_DEBUG,
+    ):
+        if irrelevant_threshold > relevant_threshold:
+            raise ValueError("irrelevant_threshold must be <= relevant_threshold")
+        self.relevant_threshold = relevant_threshold
+        self.irrelevant_threshold = irrelevant_threshold
+        self.weights = weights or dict(LOCAL_GRADER_WEIGHTS)
+        self.bm25_saturation = bm25_saturation
+        self.dense_floor = dense_floor
+        self.dense_ceiling = dense_ceiling
+        self.debug = debug
+
+    def signals(self, query: str, doc) -> dict:
+        signals = {"coverage": query_term_coverage(query, doc.page_content)}
+
+        bm25_score = doc.metadata.get("bm25_score")
+        if bm25_score is not None:
+            bm25_score = max(float(bm25_score), 0.0)
+            signals["bm25"] = bm25_score / (bm25_score + self.bm25_saturation)
+
+        dense_score = doc.metadata.get("dense_score")
+        if dense_score is not None:
+            scaled = (float(dense_score) - self.dense_floor) / (self.dense_ceiling - self.dense_floor)
+            signals["dense"] = min(max(scaled, 0.0), 1.0)
+        return signals
+
+    def score(self, query: str, doc) -> float:
+        return self.combine(self.signals(query, doc))
+
+    def combine(self, signals: dict) -> float:
+        """weighted mean of the available signals"""
+        total_weight = sum(self.weights.get(name, 0.0) for name in signals)
+        if not total_weight:
+            return 0.0
+        return sum(self.weights.get(name, 0.0) * value for name, value in signals.items()) / total_weight
+
+    async def grade(self, query: str, docs, llm=None) -> tuple[list[bool], int]:
+        """Returns (verdicts, number of borderline docs)."""
+        verdicts = [None] * len(docs)
+        borderline = []
+        for i, doc in enumerate(docs):
+            signals = self.signals(query, doc)
+            score = self.combine(signals)
+            if self.debug:  # calibration (see LOCAL_GRADER_DEBUG)
+                print(f"[CRAG] local grade doc {i}: score={score:.3f} signals={signals}")
+            if score >= self.relevant_threshold:
+                verdicts[i] = True
+            elif score < self.irrelevant_threshold:
+                verdicts[i] = False
+            else:
+                borderline.append((i, score))
+
+        if borderline:
+            if llm is not None:
+                # only the borderline docs pay for an LLM call
+                llm_verdicts, _ = await grade_batched(llm, query, [docs[i] for i, _ in borderline])
+                for (i, _), verdict in zip(borderline, llm_verdicts):
+                    verdicts[i] = verdict
+            else:
+                midpoint = (self.relevant_threshold + self.irrelevant_threshold) / 2
+                for i, score in borderline:
+                    verdicts[i] = score >= midpoint
+
+        return verdicts, len(borderline)
+
+
+class GradingStats:
+    """
+    Token / latency counters per grading mode so the modes can be compared (served on /metrics).
+    fallbacks = batched calls that needed per_doc grading / local calls that asked the LLM about borderline docs
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._modes = {}
+
+    def record(self, mode: str, docs: int, total_tokens: int, latency_ms: float, fell_back: bool = False):
+        with self._lock:
+            s = self._modes.setdefault(mode, {
+                "calls": 0, "docs": 0, "total_tokens": 0, "latency_ms_total": 0.0, "fallbacks": 0
+            })
+            s["calls"] += 1
+            s["docs"] += docs
+            s["total_tokens"] += total_tokens
+            s["latency_ms_total"] += latency_ms
+            s["fallbacks"] += int(fell_back)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                mode: {
+                    **s,
+                    "latency_ms_total": round(s["latency_ms_total"], 2),
+                    "tokens_per_call": round(s["total_tokens"] / s["calls"], 1) if s["calls"] else 0.0,
+                    "latency_ms_avg": round(s["latency_ms_total"] / s["calls"], 2) if s["calls"] else 0.0,
+                }
+                for mode, s in self._modes.items()
+            }
+
+
+grading_stats = GradingStats()
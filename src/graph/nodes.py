@@ -7,25 +7,36 @@ from langchain_core.messages import (
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 # from langchain_community.vectorstores.pgvector import PGVector
-from langchain_postgres import PGVector
 from tqdm import tqdm
 from langchain.messages import RemoveMessage # to delete something from state permenantly
 from langchain_community.document_loaders import DirectoryLoader
-from sqlalchemy.pool import NullPool
 
 import asyncio
+import time
 
 # import from other custom modules
 from src.graph import state
-from src.prompts.rag_prompt import get_prompt_template, DEFAULT_PROMPT_TEMPLATE
+from src.prompts.rag_prompt import get_prompt_template, resolve_prompt_template, DEFAULT_PROMPT_TEMPLATE
 from src.db_connection.connection import CONNECTION_STRING 
-from src.utils.file_hash import get_file_hash
+from src.utils.file_hash import get_file_hash, HASH_CHUNK_SIZE
 from src.graph.state import AgentState
+from src.ingestion.pipeline import IngestionPipeline, IngestionStats
+from src.ingestion.tracker import ingestion_tracker as default_ingestion_tracker
+from src.ingestion.embedder import EmbeddingUploader, EMBED_MAX_IN_FLIGHT, EMBED_BATCH_TOKENS
+from src.graph.rewrite_gate import rewrite_gate as default_rewrite_gate
+from src.graph.context_packer import context_packer as default_context_packer
+from src.graph.speculative import speculative_query, differs_materially, speculation_stats
+from src.graph.grader import grade_batched, grade_per_doc, grading_stats, LocalRelevanceGrader, CRAG_GRADING_MODE, GRADING_MODES
 from fastapi.concurrency import run_in_threadpool
+from postgrest.exceptions import APIError
 
 # SUPBAE CLIENT IS SYNCHRONOUS SO WE USE run_in_threadpool TO AVOID BLOCKING THE MAIN THREAD
 from src.db_connection.connection import supabase_client
 from langchain_community.retrievers import BM25Retriever
+from src.cache.bm25_cache import bm25_cache as default_bm25_cache, combine_indexes
+from src.db_connection.vectorstore import vectorstore_registry as default_vectorstore_registry
+from src.cache.answer_cache import answer_cache as default_answer_cache, prompt_template_hash
+from src.cache.chunk_embedding_store import chunk_embedding_store as default_chunk_store
 # from langchain.schema import Document
 from langchain_core.documents import Document
 
@@ -33,6 +44,21 @@ from langchain_core.documents import Document
 
 #for streaming token count 
 from langchain_community.callbacks import get_openai_callback
+from langgraph.config import get_stream_writer
+
+# documents.token_count not migrated yet (docs/database.md): PostgREST schema cache miss / postgres undefined column
+_MISSING_COLUMN = ("PGRST204", "42703")
+
+
+def emit_stream_event(payload: dict):
+    """
+    Explicit event for stream_graph (stream_mode="custom"): token_usage / summary / answer_cache_hit.
+    No-op when the node is not running inside a graph (e.g. /add_pdf calls nodes directly).
+    """
+    try:
+        get_stream_writer()(payload)
+    except RuntimeError:
+        pass
 
 
 
@@ -83,10 +109,37 @@ def rrf_merge(bm25_docs, dense_docs, k=60, top_n=5):
 
 
 class GraphNodes:
-    def __init__(self,embedding_model,llm,supbase_client):
+    def __init__(self,embedding_model,llm,supbase_client,bm25_cache=None,vectorstore_registry=None,grading_mode=CRAG_GRADING_MODE,local_grader=None,answer_cache=None,embedding_uploader=None,embed_max_in_flight=EMBED_MAX_IN_FLIGHT,embed_batch_tokens=EMBED_BATCH_TOKENS,chunk_store=None,ingestion_tracker=None,rewrite_gate=None,context_packer=None):
         self.embedding_model = embedding_model
         self.llm = llm
         self.supabase_client = supbase_client
+        # per (user_id, doc_id) BM25 index cache shared by all requests (process wide by default)
+        self.bm25_cache = bm25_cache or default_bm25_cache
+        # pooled PGVector stores keyed by collection name (pool is opened in backend/app.py lifespan)
+        self.vectorstore_registry = vectorstore_registry or default_vectorstore_registry
+        # CRAG relevance grading mode: "batched" (one LLM call), "per_doc" (one LLM call per doc) or "local" (scores, LLM only for borderline docs)
+        if grading_mode not in GRADING_MODES:
+            raise ValueError(f"Unknown grading_mode '{grading_mode}', expected one of {GRADING_MODES}")
+        self.grading_mode = grading_mode
+        # non-LLM grader used by "local" mode (thresholds from LOCAL_GRADER_* env)
+        self.local_grader = local_grader or LocalRelevanceGrader()
+        # semantic answer cache (same docs + prompt + similar question ==> reuse the answer)
+        self.answer_cache = answer_cache or default_answer_cache
+        # ingestion embedding: max concurrent embedding batches + token-aware batch size + backoff on 429
+        self.embedding_uploader = embedding_uploader or EmbeddingUploader(
+            embedding_model,
+            max_in_flight=embed_max_in_flight,
+            max_batch_tokens=embed_batch_tokens
+        )
+        # content addressed chunk vectors shared across users (same pdf is embedded once, copied into each user collection)
+        self.chunk_store = chunk_store or default_chunk_store
+        # per document ingestion status + global cap on documents ingested at the same time
+        self.ingestion_tracker = ingestion_tracker or default_ingestion_tracker
+        # local check if a follow-up needs the LLM rewrite at all (REWRITE_GATE_MODE)
+        self.rewrite_gate = rewrite_gate or default_rewrite_gate
+        # merges / dedupes retrieved chunks and packs them within a token budget
+        self.context_packer = context_packer or default_context_packer
+        self.documents_token_count = True  # False once the select found no documents.token_count column
             
     
     #The set_doc_id function now correctly checks if doc_ids (plural) are already present in the state. If they are (which is the case for follow-up questions), it skips the file hashing process, preventing the "Directory uploaded not supported" error when the temporary file is missing.
@@ -99,7 +152,7 @@ class GraphNodes:
         
         if not os.path.isfile(path):
             raise ValueError("Directoy uploaded not supported with hashing yet")
-        state["doc_id"] = get_file_hash(path)
+        state["doc_id"] = get_file_hash(path, chunk_size=HASH_CHUNK_SIZE)
         return state
 
 
@@ -122,6 +175,12 @@ class GraphNodes:
             state["vectorstore_uploaded"] = False
             return state
 
+        # caller (prepare_initial_state) already split doc_ids into existing / new → no second query
+        existing, new = state.get("existing_doc_ids"), state.get("new_doc_ids")
+        if existing is not None and new is not None and set(existing) | set(new) == set(doc_ids):
+            state["vectorstore_uploaded"] = len(new) == 0
+            return state
+
         #check which doc_ids already exist
         existing_doc_ids = set()
         for doc_id in doc_ids:
@@ -157,79 +216,63 @@ class GraphNodes:
             print("Skipping vectoingestion - PDF already exist")
             state["vectorstore_uploaded"] = True
             return state
-        
-        path = os.path.abspath(state["documents_path"])  # ensure absolute
 
-        if not os.path.isfile(path):
-            raise ValueError(f"Invalid documents_path: {path}")
-        
-        # Get doc_id from the doc_ids array (first element for single PDF flow)
-        doc_id = state.get("doc_ids", [])[0] if state.get("doc_ids") else None
-        if not doc_id:
+        # every doc that check_pdf_already_uploaded found missing (all doc_ids if the check did not run)
+        pending_doc_ids = state.get("new_doc_ids") or state.get("doc_ids") or []
+        if not pending_doc_ids:
             raise ValueError("No doc_id found in state")
 
-        print(f"Starting background ingestion for doc_id: {doc_id}")
-
-        # Wrap blocking operations in a helper function to run in threadpool
-        def load_and_split():
-            loader = PyPDFLoader(path)
-            docs = loader.load()
-            splitter = RecursiveCharacterTextSplitter(chunk_size=1000,chunk_overlap=200)
-            return splitter.split_documents(docs)
-
-        # Run heavy I/O and CPU work in threadpool to keep server responsive
-        chunks = await run_in_threadpool(load_and_split)
-
-        # langchain chunk metadata is first updated
-        # langchain chunk metadata (each chunk of document will have this metadata (it will not have page content - only metadata))
-        for i,chunk in enumerate(chunks):
-            source_path = chunk.metadata.get("source","")
-            file_name = os.path.basename(source_path) if source_path else "unknow.pdf"
-            metadata = {
-                "user_id":state["user_id"],
-                "doc_id": doc_id,  # Use doc_id from array
-                "chunk_index":i,
-                "file_name":file_name,
-                "page":chunk.metadata.get("page")  
-            }
-            # update langchian chunk metadata usd by pgvector
-            chunk.metadata.update(metadata)
-
-        vectorstore = PGVector(
-            connection=CONNECTION_STRING,
-            collection_name=f"user_{state['user_id']}",  # User-based collection for multi-PDF
-            embeddings=self.embedding_model,
-            use_jsonb=True,
-            engine_args={"poolclass": NullPool}  # disable pooling
+        # doc_id -> pdf path; the single documents_path (old single PDF flow) belongs to doc_ids[0]
+        paths = dict(state.get("documents_paths") or {})
+        if state.get("documents_path") and state.get("doc_ids"):
+            paths.setdefault(state["doc_ids"][0], state["documents_path"])
+
+        user_id = state["user_id"]
+        # shared pooled PGVector for this user's collection (created once per process)
+        vectorstore = await run_in_threadpool(
+            self.vectorstore_registry.get,
+            f"user_{user_id}",  # User-based collection for multi-PDF
+            self.embedding_model
         )
-        batch_size=50
-        # upload embedding 
-        for i in tqdm(range(0, len(chunks), batch_size), desc="Uploading chunks"):
-            batch = chunks[i:i + batch_size]
-            # async 
-            await run_in_threadpool(vectorstore.add_documents, batch)
-            # vectorstore.add_documents(batch)
-        
 
-        # Insert metadata to supbase table
-        rows = [{   
-                "user_id":state["user_id"],
-                "doc_id": doc_id,  # Use doc_id from array
-                "chunk_index": i,
-                "file_name": chunk.metadata["file_name"],
-                "page": chunk.metadata.get("page"),
-                "content": chunk.page_content,
-        } for i,chunk in enumerate(chunks)
-        ]
-        if rows:
-            try:
-                await run_in_threadpool(
-                    lambda: self.supabase_client.table("documents").insert(rows).execute()
-                )
-            except Exception:
-                print("Chunks already exist — skipping insert")
-    
-        print(f"Uploaded {len(chunks)} chunks")
+        async def ingest_one(doc_id, stats):
+            path = os.path.abspath(paths[doc_id]) if doc_id in paths else None  # ensure absolute
+            if not path or not os.path.isfile(path):
+                raise ValueError(f"Invalid documents_path for doc_id {doc_id}: {path}")
+
+            print(f"Starting background ingestion for doc_id: {doc_id}")
+            # streaming pipeline: page-by-page parsing → splitting → concurrent embedding → batched writes
+            # (all stages overlap and bounded queues keep memory flat, see src/ingestion/pipeline.py)
+            pipeline = IngestionPipeline(
+                embedding_model=self.embedding_model,
+                vectorstore=vectorstore,
+                supabase_client=self.supabase_client,
+                uploader=self.embedding_uploader,
+                chunk_store=self.chunk_store
+            )
+            await pipeline.run(path, user_id, doc_id, stats)
+
+            # chunks of this doc changed so the cached BM25 index (if any) is stale
+            self.bm25_cache.invalidate(user_id, doc_id)
+            print(f"Uploaded {stats.chunks} chunks for doc_id: {doc_id}")
+
+        # one task per document, the tracker limits how many run at the same time (process wide)
+        all_stats = {doc_id: IngestionStats() for doc_id in pending_doc_ids}
+        results = await asyncio.gather(
+            *[
+                self.ingestion_tracker.run(user_id, doc_id, lambda d=doc_id: ingest_one(d, all_stats[d]), all_stats[doc_id])
+                for doc_id in pending_doc_ids
+            ],
+            return_exceptions=True  # one failing pdf does not cancel the others
+        )
+        state["ingestion_status"] = self.ingestion_tracker.get(user_id, pending_doc_ids)
+
+        failed = {doc_id: result for doc_id, result in zip(pending_doc_ids, results) if isinstance(result, BaseException)}
+        if failed:
+            for doc_id, error in failed.items():
+                print(f"Ingestion failed for doc_id {doc_id}: {error}")
+            # surface the error (same as before for a single pdf), the other docs are already ingested
+            raise next(iter(failed.values()))
 
         state["vectorstore_uploaded"] = True
         return state
@@ -244,8 +287,12 @@ class GraphNodes:
         human_messages = [m for m in state.get("messages", []) if isinstance(m, HumanMessage)]
         current_query = human_messages[-1].content
         
-        # If there's conversation history, rewrite the query
+        # If there's conversation history, rewrite the query (unless the local gate finds it already standalone)
+        call_llm, decision = False, {}
         if len(state.get("messages", [])) > 1:
+            call_llm, decision = self.rewrite_gate.decide(current_query, [m.content for m in state["messages"][-5:-1]])
+
+        if call_llm:
             #if thier is summary we will use it as text for creating contextual aware query
             memory_text = state.get("summary") or ""
             # else we will use past conversation for creating contextual aware query
@@ -270,94 +317,229 @@ class GraphNodes:
             
             print(f"Original: {current_query}")
             print(f"Rewritten: {rewritten_query}")
-            
-            
-            # Store rewritten query for retrieval
-            state["rewritten_query"] = rewritten_query
+            await run_in_threadpool(self.rewrite_gate.log, decision, rewritten_query)
         else:
-            state["rewritten_query"] = current_query
+            rewritten_query = current_query
+            if decision:
+                await run_in_threadpool(self.rewrite_gate.log, decision)
+        # Store rewritten query for retrieval
+        # cache_query keeps it for the answer cache: query_transformer overwrites rewritten_query on CRAG retries
+        # only its own keys: speculative_retriever may write the state in the same step
+        return {"rewritten_query": rewritten_query, "cache_query": rewritten_query}
+
+
+
+    # ======================== SEMANTIC ANSWER CACHE ========================
+    # runs after query_rewriter (so follow-ups are matched on their standalone question)
+    # hit  → answer is put in state and the graph ends (stream_graph replays it as tokens, no retrieval / LLM)
+    # miss → normal retrieval path
+    async def answer_cache_lookup(self, state: AgentState):
+        state["answer_cache_hit"] = False  # reset, the flag is checkpointed from the previous turn
+
+        # global switch, per user opt out (user_settings.answer_cache_enabled) or nothing to key on
+        if not self.answer_cache.enabled or state.get("answer_cache_enabled") is False or not state.get("doc_ids"):
+            return state
+
+        query = state.get("cache_query") or state["messages"][-1].content
+        template_hash = prompt_template_hash(resolve_prompt_template(state.get("custom_prompt")))
+        try:
+            answer, similarity = await self.answer_cache.lookup(state["doc_ids"], template_hash, query)
+        except Exception as e:
+            print(f"Answer cache lookup failed: {e}")
+            return state
+
+        if answer is None:
+            return state
+
+        print(f"[ANSWER CACHE] hit (similarity {similarity:.3f}) → skipping retrieval and generation")
+        if state.get("speculative_retrieval"):
+            speculation_stats.record("unused")
+            state["speculative_retrieval"] = None
+        state["answer_cache_hit"] = True
+        state["answer"] = answer
+        state["messages"].append(AIMessage(content=answer))
+        emit_stream_event({"answer_cache_hit": answer})  # stream_graph replays it as token frames
         return state
 
 
+    def answer_cache_route(self, state: AgentState):
+        return "cached" if state.get("answer_cache_hit") else "retriever"
+
+
+    def is_answer_cacheable(self, state: AgentState) -> bool:
+        """
+        Only answers that depend on nothing but docs + prompt + question are shared:
+        first question of a thread (no history, no summary) and with some retrieved context.
+        """
+        if not self.answer_cache.enabled or state.get("answer_cache_enabled") is False:
+            return False
+        if not state.get("doc_ids") or not state.get("context"):
+            return False
+        human_messages = [m for m in state.get("messages", []) if isinstance(m, HumanMessage)]
+        return len(human_messages) == 1 and len(state.get("messages", [])) == 1 and not (state.get("summary") or "").strip()
+
+
 
     # Hybrid Retrieval: BM25 (keyword) + Dense (semantic) using EnsembleRetriever
     async def retriever(self, state: AgentState):
+        # Use rewritten query if available (from query_rewriter node), else fall back to raw message
+        query = state.get("rewritten_query") or state["messages"][-1].content
+
+        # speculative docs (SPECULATIVE_RETRIEVAL) are only valid for the question they were fetched for
+        # and only once: CRAG retries coming back from query_transformer search again
+        speculation = state.get("speculative_retrieval")
+        state["speculative_retrieval"] = None
+        if speculation and speculation.get("message_id") == state["messages"][-1].id:
+            differs, coverage = differs_materially(query, speculation["query"])
+            speculation_stats.record("re_retrieved" if differs else "reused")
+            print(f"[SPECULATIVE] coverage {coverage:.2f} → "
+                  f"{'re-retrieving on the rewritten query' if differs else 'reusing speculative docs'}")
+            if not differs:
+                state["retrieved_docs"] = speculation["docs"]
+                return state
+
+        state["retrieved_docs"] = await self.hybrid_search(state, query)
+        return state
+
+
+    async def speculative_retriever(self, state: AgentState):
+        """
+        Runs next to query_rewriter (no LLM): hybrid search on the raw question + conversation keywords.
+        Only returns its own key, the two branches write the state in the same step.
+        """
+        start = time.perf_counter()
+        query = speculative_query(state["messages"], state.get("summary") or "")
+        docs = await self.hybrid_search(state, query)
+        speculation_stats.record_speculation((time.perf_counter() - start) * 1000)
+        print(f"[SPECULATIVE] retrieved {len(docs)} docs for: {query}")
+        return {"speculative_retrieval": {"message_id": state["messages"][-1].id, "query": query, "docs": docs}}
+
+
+    async def hybrid_search(self, state: AgentState, query: str):
+        """BM25 + dense search over the thread's docs merged with RRF (top 4)"""
         doc_ids = state.get("doc_ids",[])
 
         if not doc_ids:
-            state["retrieved_docs"] = []
-            return state
+            return []
 
-        # 1. Load document chunks from Supabase for BM25
-        response = await run_in_threadpool(
-            lambda: self.supabase_client
-            .table("documents")
-            .select("content, chunk_index, page, file_name")
-            .in_("doc_id", doc_ids)  #  Query multiple doc_ids
-            .eq("user_id", state["user_id"])
-            .execute()
-        )
-        # if thier is no response then we will empty the retrived docs in state
-        if not response.data:
-            state["retrieved_docs"] = []
-            return state
-        
-        # Convert to LangChain Document objects for BM25
-        bm25_docs = [
-            Document(
-                page_content=row["content"],
-                metadata={
-                    "doc_id": doc_ids[0] if doc_ids else "",  # Use first doc_id for metadata
-                    "user_id": state["user_id"],
-                    "chunk_index": row["chunk_index"],
-                    "page": row["page"],
-                    "file_name": row["file_name"]
-                }
-            )
-            for row in response.data
-        ]
-        
+        # 1. BM25 indexes come from the per (user_id, doc_id) cache, only missing docs are loaded from Supabase
+        indexes = {}
+        missing_doc_ids = []
+        for doc_id in doc_ids:
+            index = self.bm25_cache.get(state["user_id"], doc_id)
+            if index is not None:
+                indexes[doc_id] = index
+            else:
+                missing_doc_ids.append(doc_id)
+
+        if missing_doc_ids:
+            def select(columns):
+                return (
+                    self.supabase_client
+                    .table("documents")
+                    .select(columns)
+                    .in_("doc_id", missing_doc_ids)  #  Query only the docs that are not cached
+                    .eq("user_id", state["user_id"])
+                    .execute()
+                )
+
+            columns = "doc_id, content, chunk_index, page, file_name"
+            try:
+                response = await run_in_threadpool(
+                    select, f"{columns}, token_count" if self.documents_token_count else columns
+                )
+            except APIError as e:
+                if e.code not in _MISSING_COLUMN or "token_count" not in (e.message or ""):
+                    raise
+                # column not migrated yet: context packing counts the chunks on the fly
+                print(f"WARNING: documents.token_count is missing ({e.code}), apply the migration in docs/database.md")
+                self.documents_token_count = False
+                response = await run_in_threadpool(select, columns)
+
+            # group rows per doc so each doc gets its own cache entry
+            rows_by_doc = {}
+            for row in response.data or []:
+                rows_by_doc.setdefault(row["doc_id"], []).append(row)
+
+            for doc_id, rows in rows_by_doc.items():
+                # Convert to LangChain Document objects for BM25
+                bm25_docs = [
+                    Document(
+                        page_content=row["content"],
+                        metadata={
+                            "doc_id": doc_id,
+                            "user_id": state["user_id"],
+                            "chunk_index": row["chunk_index"],
+                            "page": row["page"],
+                            "file_name": row["file_name"],
+                            "token_count": row.get("token_count")  # counted at ingestion (context packing budget)
+                        }
+                    )
+                    for row in rows
+                ]
+                # tokenizing is CPU bound so build the index in threadpool
+                indexes[doc_id] = await run_in_threadpool(
+                    self.bm25_cache.build, state["user_id"], doc_id, bm25_docs
+                )
 
-        bm25_retriever = BM25Retriever.from_documents(bm25_docs, k=3)
+        # if thier is no chunk for any doc then we will empty the retrived docs in state
+        if not indexes:
+            return []
+
+        # combine cached per-doc indexes (keeps doc_ids order) instead of rebuilding from raw text
+        bm25_retriever = combine_indexes([indexes[d] for d in doc_ids if d in indexes], k=3)
 
 
         # Dense Retriever semantic base it search from vector store
-        vectorstore = PGVector(
-            connection=CONNECTION_STRING,
-            collection_name=f"user_{state['user_id']}",  # User-based collection for multi-PDF
-            embeddings=self.embedding_model,
-            use_jsonb=True,
-            engine_args={"poolclass": NullPool}
-        )
-        dense_retriever = vectorstore.as_retriever(
-            search_type="similarity",
-            search_kwargs={
-                "k": 4,
-                "filter": {"doc_id": {"$in": doc_ids},  # Multiple doc_ids filter
-                           "user_id": state["user_id"]}
-            }
+        vectorstore = await run_in_threadpool(
+            self.vectorstore_registry.get,
+            f"user_{state['user_id']}",  # User-based collection for multi-PDF
+            self.embedding_model
         )
-        
-        # Use rewritten query if available (from query_rewriter node), else fall back to raw message
-        query = state.get("rewritten_query") or state["messages"][-1].content
+        dense_filter = {"doc_id": {"$in": doc_ids},  # Multiple doc_ids filter
+                        "user_id": state["user_id"]}
+
+        # we search with scores (instead of retriever.invoke) so the local CRAG grader can use them as signals
+        # scores are put on COPIES of the docs as BM25 docs are shared by the cache
+        def bm25_search():
+            scores = bm25_retriever.vectorizer.get_scores(bm25_retriever.preprocess_func(query))
+            top = scores.argsort()[::-1][:bm25_retriever.k]  # same ranking as BM25Retriever.invoke
+            return [
+                Document(
+                    page_content=bm25_retriever.docs[i].page_content,
+                    metadata={**bm25_retriever.docs[i].metadata, "bm25_score": float(scores[i])}
+                )
+                for i in top
+            ], {doc.page_content: float(score) for doc, score in zip(bm25_retriever.docs, scores)}
+
+        def dense_search():
+            results = vectorstore.similarity_search_with_relevance_scores(query, k=4, filter=dense_filter)
+            for doc, score in results:
+                doc.metadata["dense_score"] = score
+            return [doc for doc, _ in results]
 
         # Get results from both retrievers IN PARALLEL (faster than sequential)
-        bm25_results, dense_results = await asyncio.gather(
-            run_in_threadpool(bm25_retriever.invoke, query),
-            run_in_threadpool(dense_retriever.invoke, query)
+        (bm25_results, bm25_scores), dense_results = await asyncio.gather(
+            run_in_threadpool(bm25_search),
+            run_in_threadpool(dense_search)
         )
 
         # Merge using RRF (Reciprocal Rank Fusion)
         retrieved_docs = rrf_merge(bm25_results, dense_results, k=60, top_n=4)
-        
-        state["retrieved_docs"] = retrieved_docs
-        return state
+
+        # dense-only hits still get their BM25 score (the grader uses both)
+        for doc in retrieved_docs:
+            if "bm25_score" not in doc.metadata and doc.page_content in bm25_scores:
+                doc.metadata["bm25_score"] = bm25_scores[doc.page_content]
+
+        return retrieved_docs
 
 
 
     # ======================== CORRECTIVE RAG ========================
 
-    # After retriever fetches docs, retrieval_grader asks the LLM to grade each doc as "relevant" or "irrelevant" (all docs graded in parallel)
+    # After retriever fetches docs, retrieval_grader asks the LLM to grade each doc as "relevant" or "irrelevant"
+    # (batched mode: all docs in one structured call, per_doc mode: all docs graded in parallel)
     # Only relevant docs are kept. A retrieval_confidence score is calculated
     # decide_to_generate checks:
     # ≥ 25% relevant → proceed to context_builder (generate answer)
@@ -368,7 +550,8 @@ class GraphNodes:
     async def retrieval_grader(self, state: AgentState):
         """
         Corrective RAG - Grade each retrieved document for relevance.
-        Uses the LLM to assess whether each document is relevant to the query.
+        Uses the LLM (or the local scorer) to assess whether each document is relevant to the query
+        (see self.grading_mode).
         Filters out irrelevant docs and sets retrieval_confidence score.
         """
         docs = state.get("retrieved_docs", [])
@@ -379,32 +562,25 @@ class GraphNodes:
             state["retrieval_confidence"] = 0.0
             return state
 
-        grader_prompt = """You are a document relevance grader.
-        Your job is to assess whether a retrieved document is relevant to the user's query.
-
-        Query: {query}
-
-        Document:
-        {document}
-
-        Does this document contain information relevant to answering the query?
-        Respond with ONLY one word: "relevant" or "irrelevant"
-        """
-
-        async def grade_single_doc(doc):
-            """Grade a single document for relevance."""
-            prompt = grader_prompt.format(
-                query=query,
-                document=doc.page_content[:1000]  # Limit to first 1000 chars to save tokens
-            )
-            result = await self.llm.ainvoke([HumanMessage(content=prompt)])
-            return doc, "relevant" in result.content.strip().lower()
-
-        # Grade all documents in parallel for speed
-        #Each document is graded independently:
-        grading_results = await asyncio.gather(
-            *[grade_single_doc(doc) for doc in docs]
-        )
+        # Grade all documents (batched = one structured call, per_doc = one call per doc in parallel, local = no LLM unless borderline)
+        start_time = time.perf_counter()
+        fell_back = False
+        with get_openai_callback() as cb:
+            if self.grading_mode == "batched":
+                verdicts, fell_back = await grade_batched(self.llm, query, docs)
+            elif self.grading_mode == "local":
+                # local scores decide, the LLM is only asked about borderline docs
+                verdicts, borderline = await self.local_grader.grade(query, docs, llm=self.llm)
+                fell_back = borderline > 0
+            else:
+                verdicts = await grade_per_doc(self.llm, query, docs)
+        latency_ms = (time.perf_counter() - start_time) * 1000
+
+        # report tokens + latency per mode so batched vs per_doc can be compared on /metrics
+        grading_stats.record(self.grading_mode, len(docs), cb.total_tokens, latency_ms, fell_back)
+        print(f"[CRAG] {self.grading_mode} grading: {cb.total_tokens} tokens in {latency_ms:.0f} ms")
+
+        grading_results = list(zip(docs, verdicts))
 
         # Filter to only relevant docs
         # if only one doc is relevant then we will take it and use for answer generation
@@ -490,13 +666,8 @@ class GraphNodes:
             state["context"] = ""
             state["answer"] = ("I could not find relevant information in the provided document.")
         else:
-            context = "\n\n".join(
-                f"[Source: {doc.metadata.get('file_name', 'Unknown')} "
-                f"- Page {doc.metadata.get('page', 'N/A')}]\n"    # page no
-                f"{doc.page_content}"
-                for doc in retrieved_docs
-            )
-            state["context"] = context
+            # neighbouring chunks merged, repeats dropped, packed within CONTEXT_TOKEN_BUDGET (src/graph/context_packer.py)
+            state["context"] = self.context_packer.pack(retrieved_docs)
         
         # Yield control back to event loop to avoid blocking
         await asyncio.sleep(0)
@@ -526,6 +697,7 @@ class GraphNodes:
 
         # now delete the orignal messages that have been summarized
         message_to_delete = state["messages"][:-2] if len(state["messages"]) > 2 else []
+        emit_stream_event({"summary": response.content})  # stored on the threads row by on_complete
 
         return {
             "summary":response.content,
@@ -568,12 +740,8 @@ class GraphNodes:
         # Inject memory as system message
         prompt_messages.append(SystemMessage(content=f"Conversation Memory:\n{memory_text}"))
 
-        # Chossing the System Prompt Template
-        custom_prompt = state.get("custom_prompt")
-        if custom_prompt:
-            prompt_template = get_prompt_template(custom_prompt)
-        else:
-            prompt_template = DEFAULT_PROMPT_TEMPLATE
+        # Chossing the System Prompt Template (custom prompt if user has one else default)
+        prompt_template = resolve_prompt_template(state.get("custom_prompt"))
         
         formatted_prompt = prompt_template.format(
             context=context,
@@ -614,6 +782,18 @@ class GraphNodes:
         #             }).execute()
         #     )
 
+        # cache the answer for the same docs + prompt + similar question (before the AI message is appended)
+        if self.is_answer_cacheable(state):
+            try:
+                await self.answer_cache.store(
+                    state["doc_ids"],
+                    prompt_template_hash(prompt_template),
+                    state.get("cache_query") or state["messages"][-1].content,
+                    response.content
+                )
+            except Exception as e:
+                print(f"Answer cache store failed: {e}")
+
         # store token in state 
         state["token_usage"] = {
             "total_tokens": cb.total_tokens,
@@ -622,6 +802,7 @@ class GraphNodes:
             "query": query,
             "answer": response.content
             }
+        emit_stream_event({"token_usage": state["token_usage"]})  # logged by on_complete
         # Save AI response in state
         state["messages"].append(AIMessage(content=response.content))
         state["answer"] = response.content
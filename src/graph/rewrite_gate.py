@@ -0,0 +1,165 @@
+import os
+import re
+import json
+import time
+import threading
+from pathlib import Path
+from src.graph.grader import stem
+from src.graph.speculative import content_terms
+
+
+# ======================== QUERY REWRITE GATE ========================
+# query_rewriter used to call the LLM for EVERY follow-up, also for questions that are already standalone
+# ("What is Section 420 PPC?"). The gate classifies the follow-up locally (no network) first:
+#   reference  ==> pronoun / deictic word pointing to an earlier turn ("it", "that section", "the above") or a
+#                  definite document noun ("the act", "the section", "the ordinance")                      → rewrite
+#   ellipsis   ==> continuation opener ("and ...", "what about ...", "why?", "explain more")               → rewrite
+#   anchored   ==> explicit section / article number ("Section 420", "Art. 25A", "s. 302") or a named
+#                  statute ("PPC", "CrPC", "Anti-Terrorism Act", "Constitution")                           → skip
+#   unanchored ==> anything else                                                                           → rewrite
+# A wrong skip costs answer quality, a wrong rewrite only latency, so references / ellipsis always win and a
+# question without an anchor is rewritten however long it is: "How many days for appeal" has three content words
+# but still depends on the act the conversation is about. Content words and overlap with the earlier turns are
+# logged as features for tuning.
+#
+# REWRITE_GATE_MODE: "on" (skip the LLM when not needed), "shadow" (always rewrite, only log the decision)
+# or "off". REWRITE_GATE_LOG_PATH (jsonl, empty = no file, the default) turns on the decision log for offline
+# tuning; it holds raw user questions, so only set it where that is allowed. Each worker writes its own file
+# (<name>.<pid>.jsonl) and stops at REWRITE_GATE_LOG_MAX_MB (printed once, counted in dropped_logs).
+# When the LLM ran, the log also has the rewrite and the terms it added (added_terms = 0 → rewrite was useless).
+
+REWRITE_GATE_MODE = os.environ.get("REWRITE_GATE_MODE", "on").lower()
+REWRITE_GATE_LOG_PATH = os.environ.get("REWRITE_GATE_LOG_PATH", "")
+REWRITE_GATE_LOG_MAX_MB = float(os.environ.get("REWRITE_GATE_LOG_MAX_MB", "20"))
+
+REFERENCE_WORDS = {
+    "it", "its", "this", "that", "these", "those", "they", "them", "their", "theirs",
+    "he", "him", "his", "she", "her", "hers", "former", "latter", "above", "aforementioned",
+    "same", "previous", "earlier", "mentioned", "said",
+}
+# "the act" / "the section" with no name or number after it = the one the conversation is about
+DEFINITE_REFERENCE_PATTERN = re.compile(
+    r"\bthe\s+(act|law|ordinance|code|statute|section|article|clause|provision|rule|rules|order|chapter|schedule"
+    r"|amendment|bill|judgment|judgement|case|document|pdf|file)\b(?!\s*(,\s*)?(\d|(?-i:[A-Z])|of\b))",
+    re.IGNORECASE,
+)
+ELLIPSIS_PATTERN = re.compile(
+    r"^\s*(and|but|also|so|then|what about|how about|what if|why|why not|more|elaborate|explain more|explain further"
+    r"|continue|go on|ok|okay|and then|what else|any exceptions?|example)\b",
+    re.IGNORECASE,
+)
+ANCHOR_PATTERN = re.compile(
+    r"\b(section|sec\.?|s\.|article|art\.?|clause|rule|order|chapter|schedule)\s*\d+[a-z]?\b|§\s*\d+",
+    re.IGNORECASE,
+)
+# named statute: acronym ("PPC", "CrPC", "QSO"), "<Name> Act / Ordinance / Code ..." or the Constitution
+STATUTE_PATTERN = re.compile(
+    r"\b[A-Z][a-z]?[A-Z][A-Za-z]*\b|\b[A-Z][\w-]*\s+(Act|Ordinance|Code|Order|Rules|Regulations)\b|(?i:\bconstitution\b)"
+)
+WORD_PATTERN = re.compile(r"[a-z]+")
+
+
+def rewrite_features(question: str, history: list[str]) -> dict:
+    """local signals of a follow-up (history = content of the earlier messages)"""
+    words = WORD_PATTERN.findall(question.lower())
+    terms = content_terms(question)
+    history_stems = {stem(t) for text in history for t in content_terms(text)}
+    question_stems = {stem(t) for t in terms}
+    return {
+        "references": sorted(set(words) & REFERENCE_WORDS),
+        "ellipsis": bool(ELLIPSIS_PATTERN.match(question)),
+        "definite_reference": bool(DEFINITE_REFERENCE_PATTERN.search(question)),
+        "anchored": bool(ANCHOR_PATTERN.search(question) or STATUTE_PATTERN.search(question)),
+        "content_terms": len(terms),
+        "overlap": round(len(question_stems & history_stems) / len(question_stems), 3) if question_stems else 0.0,
+    }
+
+
+def needs_rewrite(features: dict) -> tuple[bool, str]:
+    """(rewrite needed, reason)"""
+    if features["references"] or features["definite_reference"]:
+        return True, "reference"
+    if features["ellipsis"]:
+        return True, "ellipsis"
+    if features["anchored"]:
+        return False, "anchored"
+    return True, "unanchored"
+
+
+class RewriteGate:
+    """decides if query_rewriter needs the LLM, counts (served on /metrics) and logs the decisions"""
+
+    def __init__(
+        self,
+        mode: str = REWRITE_GATE_MODE,
+        log_path: str = REWRITE_GATE_LOG_PATH,
+        log_max_bytes: int = int(REWRITE_GATE_LOG_MAX_MB * 1024 * 1024),
+    ):
+        if mode not in ("on", "shadow", "off"):
+            raise ValueError(f"Unknown REWRITE_GATE_MODE '{mode}', expected on / shadow / off")
+        self.mode = mode
+        # per worker file: several workers appending to one file interleave / race on the size check
+        self.log_path = None
+        if log_path:
+            path = Path(log_path)
+            self.log_path = path.with_name(f"{path.stem}.{os.getpid()}{path.suffix}")
+        self.log_max_bytes = log_max_bytes
+        self._lock = threading.Lock()
+        self._reasons = {}
+        self.skipped = 0
+        self.rewritten = 0
+        self.dropped_logs = 0
+
+    def decide(self, question: str, history: list[str]) -> tuple[bool, dict]:
+        """returns (call the LLM, decision record for log())"""
+        if self.mode == "off":
+            return True, {}
+        features = rewrite_features(question, history)
+        rewrite, reason = needs_rewrite(features)
+        call_llm = rewrite or self.mode == "shadow"
+        with self._lock:
+            self._reasons[reason] = self._reasons.get(reason, 0) + 1
+            if call_llm:
+                self.rewritten += 1
+            else:
+                self.skipped += 1
+        # no question text here: it only goes to the opt-in REWRITE_GATE_LOG_PATH file
+        print(f"[REWRITE GATE] {reason} → {'rewrite' if rewrite else 'skip'}"
+              f"{' (shadow)' if self.mode == 'shadow' and not rewrite else ''}")
+        return call_llm, {"ts": time.time(), "mode": self.mode, "question": question,
+                          "rewrite": rewrite, "reason": reason, **features}
+
+    def log(self, decision: dict, rewritten_query: str | None = None):
+        """append one decision to the jsonl file (blocking file I/O → call it in the threadpool)"""
+        if not decision or self.log_path is None:
+            return
+        if rewritten_query is not None:
+            question_stems = {stem(t) for t in content_terms(decision["question"])}
+            decision["rewritten_query"] = rewritten_query
+            decision["added_terms"] = len({stem(t) for t in content_terms(rewritten_query)} - question_stems)
+        line = json.dumps(decision, ensure_ascii=False) + "\n"
+        with self._lock:
+            size = self.log_path.stat().st_size if self.log_path.exists() else 0
+            if size + len(line) > self.log_max_bytes:
+                if not self.dropped_logs:
+                    print(f"[REWRITE GATE] {self.log_path} reached {self.log_max_bytes} bytes → decisions are no longer logged")
+                self.dropped_logs += 1
+                return
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+    def stats(self) -> dict:
+        with self._lock:
+            decided = self.skipped + self.rewritten
+            return {
+                "mode": self.mode,
+                "log_path": str(self.log_path) if self.log_path else None,
+                "skipped": self.skipped,
+                "rewritten": self.rewritten,
+                "skip_rate": round(self.skipped / decided, 3) if decided else 0.0,
+                "reasons": dict(self._reasons),
+                "dropped_logs": self.dropped_logs,
+            }
+
+
+rewrite_gate = RewriteGate()
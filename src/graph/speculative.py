@@ -0,0 +1,115 @@
+import os
+import threading
+from collections import Counter
+from langchain_core.messages import HumanMessage
+from src.graph.grader import tokenize, stem, STOP_WORDS
+
+
+# ======================== SPECULATIVE RETRIEVAL ========================
+# For follow-ups query_rewriter is a blocking LLM call and retriever could only start after it.
+# With SPECULATIVE_RETRIEVAL=true the graph fans out after check_pdf / document_ingestion:
+#   query_rewriter          ==> LLM rewrite (as before)
+#   speculative_retriever   ==> hybrid search on raw question + keywords of the conversation (no LLM)
+# both join in answer_cache_lookup. retriever then compares the rewritten query with the speculative one:
+#   rewrite adds nothing material (terms covered, no new section number) ==> speculative docs are used (win)
+#   otherwise                                                             ==> normal retrieval on the rewrite
+# CRAG retries (query_transformer → retriever) always search again, speculative docs are used once.
+# Win rate is served on /metrics (speculative_retrieval).
+
+SPECULATIVE_RETRIEVAL = os.environ.get("SPECULATIVE_RETRIEVAL", "true").lower() == "true"
+# fraction of the rewritten query terms that must already be in the speculative query to keep its docs
+SPECULATIVE_MIN_COVERAGE = float(os.environ.get("SPECULATIVE_MIN_COVERAGE", "0.8"))
+# conversation keywords added to the raw question
+SPECULATIVE_KEYWORDS = int(os.environ.get("SPECULATIVE_KEYWORDS", "8"))
+SPECULATIVE_HISTORY_MESSAGES = 4  # previous messages the keywords are taken from (besides the summary)
+
+
+def content_terms(text: str) -> list[str]:
+    """non stop word tokens of a text, in order"""
+    return [t for t in tokenize(text) if t not in STOP_WORDS and (len(t) > 2 or t.isdigit())]
+
+
+def conversation_keywords(messages, summary: str = "", max_terms: int = SPECULATIVE_KEYWORDS) -> list[str]:
+    """
+    Most frequent content terms of the previous messages + summary that are not already in the question.
+    Numbers (section / article numbers) come first as they are what follow-ups usually refer to.
+    """
+    if len(messages) < 2:
+        return []
+    question_stems = {stem(t) for t in content_terms(messages[-1].content)}
+
+    counts = Counter()
+    # questions count twice: they name the topic, answers are long and noisy
+    for m in messages[-1 - SPECULATIVE_HISTORY_MESSAGES:-1]:
+        weight = 2 if isinstance(m, HumanMessage) else 1
+        for term in content_terms(m.content):
+            counts[term] += weight
+    for term in content_terms(summary or ""):
+        counts[term] += 1
+
+    keywords, seen = [], set(question_stems)
+    for term, _ in sorted(counts.items(), key=lambda item: (not item[0].isdigit(), -item[1])):
+        if stem(term) in seen:
+            continue
+        seen.add(stem(term))
+        keywords.append(term)
+        if len(keywords) >= max_terms:
+            break
+    return keywords
+
+
+def speculative_query(messages, summary: str = "", max_terms: int = SPECULATIVE_KEYWORDS) -> str:
+    """raw question + conversation keywords (just the question for the first turn)"""
+    question = messages[-1].content
+    keywords = conversation_keywords(messages, summary, max_terms)
+    return f"{question} {' '.join(keywords)}" if keywords else question
+
+
+def differs_materially(rewritten: str, speculative: str, min_coverage: float = SPECULATIVE_MIN_COVERAGE) -> tuple[bool, float]:
+    """
+    Does the rewritten query need its own retrieval? Returns (differs, coverage).
+    differs = a number in the rewrite the speculative query does not have, or term coverage below min_coverage
+    """
+    rewritten_terms = {stem(t) for t in content_terms(rewritten)}
+    if not rewritten_terms:
+        return False, 1.0
+    speculative_terms = {stem(t) for t in content_terms(speculative)}
+    coverage = len(rewritten_terms & speculative_terms) / len(rewritten_terms)
+    new_numbers = {t for t in rewritten_terms if t.isdigit()} - speculative_terms
+    return bool(new_numbers) or coverage < min_coverage, coverage
+
+
+class SpeculationStats:
+    """
+    How often the speculative retrieval is used (served on /metrics).
+    reused = retriever kept the speculative docs, re_retrieved = rewrite differed materially,
+    unused = graph ended before retriever (answer cache hit)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {"speculations": 0, "reused": 0, "re_retrieved": 0, "unused": 0}
+        self._latency_ms_total = 0.0
+
+    def record_speculation(self, latency_ms: float):
+        with self._lock:
+            self._counts["speculations"] += 1
+            self._latency_ms_total += latency_ms
+
+    def record(self, outcome: str):
+        with self._lock:
+            self._counts[outcome] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            decided = self._counts["reused"] + self._counts["re_retrieved"]
+            return {
+                "enabled": SPECULATIVE_RETRIEVAL,
+                **self._counts,
+                "win_rate": round(self._counts["reused"] / decided, 3) if decided else 0.0,
+                "latency_ms_avg": round(self._latency_ms_total / self._counts["speculations"], 2)
+                if self._counts["speculations"] else 0.0,
+            }
+
+
+speculation_stats = SpeculationStats()
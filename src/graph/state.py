@@ -17,13 +17,20 @@ class AgentState(TypedDict,total=False):
     doc_ids:List[str]  # Array of doc_ids for multi-PDF support
     existing_doc_ids: List[str]  # Doc IDs that already exist in vectorstore
     new_doc_ids: List[str]  # Doc IDs that need ingestion
+    documents_paths: Dict[str, str]  # doc_id -> uploaded pdf path (every doc that may need ingestion)
+    ingestion_status: Dict[str, Dict[str, Any]]  # doc_id -> ingestion status / progress of this run
     user_id:str   # for tenant isolation
     summary:str
     vectorstore_uploaded:bool
     rewritten_query:str
+    cache_query: str  # query_rewriter output, answer cache key (rewritten_query changes on CRAG retries)
     token_usage: Dict[str, Any]
     custom_prompt: str  # User's custom prompt
 
     
     retrieval_confidence: float  # CRAG: ratio of relevant docs (0.0–1.0)
-    crag_retries: int  # CRAG: retry counter (max 1)
\ No newline at end of file
+    crag_retries: int  # CRAG: retry counter (max 1)
+
+    answer_cache_enabled: bool  # per user opt out of the semantic answer cache (user_settings)
+    answer_cache_hit: bool  # answer came from the answer cache (stream_graph replays it)
+    speculative_retrieval: Dict[str, Any]  # message_id / query / docs of speculative_retriever (used once by retriever)
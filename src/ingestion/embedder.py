@@ -0,0 +1,200 @@
+import os
+import time
+import random
+import asyncio
+import weakref
+import threading
+
+
+# ============================ RATE LIMIT AWARE EMBEDDING UPLOADER ============================
+# Used by the ingestion pipeline (src/ingestion/pipeline.py) for the embedding stage.
+#
+# - max_in_flight  ==> how many embedding batches are sent to the provider at the same time
+# - max_batch_tokens ==> batches are cut by token count (tiktoken) and not only by chunk count,
+#                        so a batch of long chunks never goes over the provider request limit
+# - 429 (rate limit) ==> retried with exponential backoff + jitter (base_delay * 2^attempt)
+# - every batch is timed (latency, tokens, retries) so the settings can be tuned from the logs / stats
+
+EMBED_MAX_IN_FLIGHT = int(os.environ.get("EMBED_MAX_IN_FLIGHT", "4"))  # concurrent embedding requests
+EMBED_BATCH_TOKENS = int(os.environ.get("EMBED_BATCH_TOKENS", "8000"))  # max tokens in one embedding request
+EMBED_MAX_RETRIES = int(os.environ.get("EMBED_MAX_RETRIES", "6"))  # retries on 429 before giving up
+EMBED_BACKOFF_BASE_S = float(os.environ.get("EMBED_BACKOFF_BASE_S", "1.0"))
+EMBED_BACKOFF_MAX_S = float(os.environ.get("EMBED_BACKOFF_MAX_S", "30.0"))
+
+
+class TokenCounter:
+    """
+    tiktoken counter for the embedding model (falls back to ~4 chars per token if the encoding can not be loaded).
+    The encoding is loaded on first use, tiktoken downloads it the first time so we do not do that at import.
+    """
+
+    def __init__(self, model: str = "text-embedding-3-small"):
+        self.model = model
+        self._encoding = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            try:
+                import tiktoken
+                try:
+                    self._encoding = tiktoken.encoding_for_model(self.model)
+                except KeyError:
+                    self._encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                print(f"tiktoken not available ({e}) → estimating tokens from characters")
+                self._encoding = None
+            self._loaded = True
+
+    def count(self, text: str) -> int:
+        if not self._loaded:
+            self._load()
+        if self._encoding is None:
+            return max(1, len(text) // 4)
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """openai.RateLimitError or any http error carrying a 429 status"""
+    try:
+        import openai
+        if isinstance(error, openai.RateLimitError):
+            return True
+    except ImportError:
+        pass
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status == 429
+
+
+class EmbeddingUploaderStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.texts = 0
+        self.tokens = 0
+        self.rate_limited = 0  # 429 responses
+        self.retries = 0
+        self.failures = 0
+        self.latency_ms_total = 0.0
+        self.latency_ms_max = 0.0
+        self.in_flight = 0
+        self.in_flight_peak = 0
+
+    def started(self):
+        with self._lock:
+            self.in_flight += 1
+            self.in_flight_peak = max(self.in_flight_peak, self.in_flight)
+
+    def finished(self, texts: int, tokens: int, latency_ms: float, ok: bool):
+        with self._lock:
+            self.in_flight -= 1
+            if not ok:
+                self.failures += 1
+                return
+            self.batches += 1
+            self.texts += texts
+            self.tokens += tokens
+            self.latency_ms_total += latency_ms
+            self.latency_ms_max = max(self.latency_ms_max, latency_ms)
+
+    def retried(self, rate_limited: bool):
+        with self._lock:
+            self.retries += 1
+            self.rate_limited += int(rate_limited)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "texts": self.texts,
+                "tokens": self.tokens,
+                "rate_limited": self.rate_limited,
+                "retries": self.retries,
+                "failures": self.failures,
+                "in_flight_peak": self.in_flight_peak,
+                "latency_ms_avg": round(self.latency_ms_total / self.batches, 2) if self.batches else 0.0,
+                "latency_ms_max": round(self.latency_ms_max, 2),
+            }
+
+
+class EmbeddingUploader:
+    """
+    Wraps an Embeddings model for ingestion: bounded concurrency + backoff on 429.
+    One uploader is shared by all ingestions of a GraphNodes, so max_in_flight is a process wide limit
+    (several PDFs being ingested at the same time do not multiply the load on the provider).
+    """
+
+    def __init__(
+        self,
+        embedding_model,
+        max_in_flight: int = EMBED_MAX_IN_FLIGHT,
+        max_batch_tokens: int = EMBED_BATCH_TOKENS,
+        max_retries: int = EMBED_MAX_RETRIES,
+        backoff_base_s: float = EMBED_BACKOFF_BASE_S,
+        backoff_max_s: float = EMBED_BACKOFF_MAX_S,
+    ):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be >= 1")
+        self.embedding_model = embedding_model
+        self.max_in_flight = max_in_flight
+        self.max_batch_tokens = max_batch_tokens
+        self.max_retries = max_retries
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+        self.model = getattr(embedding_model, "model", None) or "text-embedding-3-small"
+        self.token_counter = TokenCounter(self.model)
+        self.counters = EmbeddingUploaderStats()
+        # one semaphore per event loop (asyncio primitives are bound to the loop they are used in)
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_in_flight)
+        return semaphore
+
+    def backoff_delay(self, attempt: int) -> float:
+        """exponential backoff with full jitter: random(0, base * 2^attempt), capped at backoff_max_s"""
+        return random.uniform(0, min(self.backoff_max_s, self.backoff_base_s * (2 ** attempt)))
+
+    async def embed_batch(self, texts: list[str], tokens: int | None = None) -> list[list[float]]:
+        """Embed one batch. Waits for a free in-flight slot, retries 429s with backoff, records timing."""
+        if tokens is None:
+            tokens = sum(self.token_counter.count(t) for t in texts)
+
+        async with self._semaphore():
+            self.counters.started()
+            start = time.perf_counter()
+            ok = False
+            try:
+                attempt = 0
+                while True:
+                    try:
+                        vectors = await self.embedding_model.aembed_documents(texts)
+                        ok = True
+                        return vectors
+                    except Exception as e:
+                        if not is_rate_limit_error(e) or attempt >= self.max_retries:
+                            raise
+                        delay = self.backoff_delay(attempt)
+                        attempt += 1
+                        self.counters.retried(rate_limited=True)
+                        print(f"Embedding batch rate limited (429) → retry {attempt}/{self.max_retries} in {delay:.2f}s")
+                        # keep the slot while sleeping so the other workers also slow down
+                        await asyncio.sleep(delay)
+            finally:
+                latency_ms = (time.perf_counter() - start) * 1000
+                self.counters.finished(len(texts), tokens, latency_ms, ok)
+                if ok:
+                    print(f"Embedded batch: {len(texts)} chunks, {tokens} tokens in {latency_ms:.0f} ms ({attempt} retries)")
+
+    def stats(self) -> dict:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "max_batch_tokens": self.max_batch_tokens,
+            **self.counters.stats(),
+        }
@@ -0,0 +1,110 @@
+import os
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+# ============================ PROCESS POOL PDF PARSING ============================
+# pypdf text extraction is pure python CPU work. In a thread it holds the GIL, so a big statute upload
+# slowed down every other request of the same uvicorn worker.
+#
+# Large pdfs are now cut in page ranges and each range is extracted + split in a separate process:
+#
+#   pages 0-19  ──> process 1 ──┐
+#   pages 20-39 ──> process 2 ──┼──> results consumed IN PAGE ORDER ──> same batches as before
+#   pages 40-59 ──> process 3 ──┘
+#
+# Only a window of ranges is submitted at a time, so a slow embedding stage still pauses the parsing (backpressure).
+# Small pdfs (< PDF_PARSE_MIN_PAGES) stay in the ingestion thread, starting processes would cost more than it saves.
+# This module is imported by the worker processes (spawn), so it must not import the app / graph modules.
+
+PDF_PARSE_BACKEND = os.environ.get("PDF_PARSE_BACKEND", "process")  # "process" or "thread"
+PDF_PARSE_PROCESSES = int(os.environ.get("PDF_PARSE_PROCESSES", str(min(4, os.cpu_count() or 1))))
+PDF_PARSE_PAGES_PER_TASK = int(os.environ.get("PDF_PARSE_PAGES_PER_TASK", "20"))
+PDF_PARSE_MIN_PAGES = int(os.environ.get("PDF_PARSE_MIN_PAGES", "40"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(processes: int = PDF_PARSE_PROCESSES) -> ProcessPoolExecutor:
+    """Process pool shared by all ingestions of this worker (created on first large pdf)."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn, not fork: forking a process that runs the event loop + db pool threads is not safe
+            _executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+
+def shutdown_executor():
+    """called from backend/app.py lifespan on shutdown"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def count_pages(path: str) -> int:
+    from pypdf import PdfReader
+    return len(PdfReader(path).pages)
+
+
+def parse_page_range(path: str, start: int, end: int, chunk_size: int, chunk_overlap: int) -> list[dict]:
+    """
+    Runs in a worker process: extract pages [start, end) the way PyPDFLoader does (plain extraction, stripped)
+    and split every page separately. Returns one dict per page: page, page_label, total_pages, chunks (texts).
+    """
+    from pypdf import PdfReader
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    reader = PdfReader(path)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    total_pages = len(reader.pages)
+    page_labels = reader.page_labels  # computed for the whole pdf on every access, so read it once
+    pages = []
+    for page_number in range(start, min(end, total_pages)):
+        text = reader.pages[page_number].extract_text().strip()
+        pages.append({
+            "page": page_number,
+            "page_label": page_labels[page_number],
+            "total_pages": total_pages,
+            "chunks": splitter.split_text(text),
+        })
+    return pages
+
+
+def iter_pages_parallel(
+    path: str,
+    total_pages: int,
+    chunk_size: int,
+    chunk_overlap: int,
+    stop: threading.Event,
+    pages_per_task: int = PDF_PARSE_PAGES_PER_TASK,
+    processes: int = PDF_PARSE_PROCESSES,
+):
+    """
+    Yields the parse_page_range page dicts in page order while the next ranges are extracted in other processes.
+    Stops submitting (and cancels what is queued) when `stop` is set or the consumer stops iterating.
+    """
+    executor = get_executor(processes)
+    ranges = deque(range(0, total_pages, pages_per_task))
+    window = deque()  # submitted futures, in page order
+    max_window = processes * 2
+
+    def submit():
+        while ranges and len(window) < max_window and not stop.is_set():
+            start = ranges.popleft()
+            window.append(executor.submit(parse_page_range, path, start, start + pages_per_task, chunk_size, chunk_overlap))
+
+    try:
+        submit()
+        while window:
+            pages = window.popleft().result()
+            submit()
+            yield from pages
+    finally:
+        for future in window:
+            future.cancel()
@@ -0,0 +1,345 @@
+import os
+import time
+import asyncio
+import resource
+import threading
+from langchain_community.document_loaders import PyPDFLoader
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+from fastapi.concurrency import run_in_threadpool
+from postgrest.exceptions import APIError
+
+from src.ingestion.embedder import EmbeddingUploader
+from src.cache.chunk_embedding_store import ChunkEmbeddingStore
+from src.ingestion import pdf_parser
+
+
+# ============================ STREAMING INGESTION PIPELINE ============================
+# Old flow:  load WHOLE pdf → split everything → embed + upload 50 chunks at a time (one after another)
+#            parse / embed / db write never overlap and memory grows with the pdf size
+#
+# New flow (all stages run at the same time):
+#
+#   parser thread ──(pages)──> splitter ──[embed_queue]──> N embedding workers ──[write_queue]──> writer
+#   PyPDFLoader.lazy_load      page by page   bounded          EmbeddingUploader      bounded        PGVector + "documents" table
+#                                                               (chunk_embedding_store
+#                                                                 is checked first)
+#
+# The queues are bounded, so when embedding or writing is slow the parser simply waits (backpressure)
+# ==> at most (queue sizes + workers) batches are in memory, whatever the pdf size.
+#
+# The writer stores every batch as it arrives: vectors (PGVector) then its "documents" rows (text only), so neither
+# memory nor the request size grows with the pdf. Those rows mean "this pdf is ingested" (check_pdf /
+# is_doc_ingested) and feed the BM25 indexes, so a failed ingestion must never leave part of them behind:
+# - any failure → the vectors AND the documents rows written by this run are deleted (rows batch by batch, by
+#   chunk_index, so rows of another run are never touched), the pdf is ingested again on the next upload
+# - unique violation on a batch → the same pdf is ingested concurrently by another request, this run stops and
+#   deletes what it wrote (the other run keeps going; if both collide both stop and the next upload ingests it)
+
+# batches are closed at INGEST_BATCH_SIZE chunks or at uploader.max_batch_tokens tokens (whichever comes first)
+# and the number of embedding workers is the uploader in-flight limit (see src/ingestion/embedder.py)
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "50"))  # max chunks per embedding / write batch
+INGEST_QUEUE_SIZE = int(os.environ.get("INGEST_QUEUE_SIZE", "4"))  # batches waiting between two stages
+
+_DONE = object()  # end of stream marker
+_UNIQUE_VIOLATION = "23505"
+# documents.token_count not migrated yet (docs/database.md): PostgREST schema cache miss / postgres undefined column
+_MISSING_COLUMN = ("PGRST204", "42703")
+
+
+class _Stopped(Exception):
+    """raised inside the parser thread when another stage failed"""
+
+
+class _DuplicateIngestion(Exception):
+    """a documents batch hit the unique key: the same pdf is being ingested by another run"""
+
+
+class IngestionStats:
+    def __init__(self):
+        self.pages = 0
+        self.chunks = 0
+        self.chunks_written = 0
+        self.batches = 0
+        self.parse_s = 0.0
+        self.embed_s = 0.0
+        self.reused_embeddings = 0  # chunks whose vector came from the chunk embedding store
+        self.write_s = 0.0
+        self.wall_s = 0.0
+        self.peak_rss_mb = 0.0
+
+    def as_dict(self) -> dict:
+        return {k: round(v, 3) if isinstance(v, float) else v for k, v in vars(self).items()}
+
+
+class IngestionPipeline:
+    """Stage-overlapped pdf ingestion for one document of one user."""
+
+    def __init__(
+        self,
+        embedding_model,
+        vectorstore,
+        supabase_client,
+        uploader: EmbeddingUploader | None = None,
+        chunk_store: ChunkEmbeddingStore | None = None,
+        batch_size: int = INGEST_BATCH_SIZE,
+        queue_size: int = INGEST_QUEUE_SIZE,
+        chunk_size: int = 1000,
+        chunk_overlap: int = 200,
+        parse_backend: str = pdf_parser.PDF_PARSE_BACKEND,
+        parse_processes: int = pdf_parser.PDF_PARSE_PROCESSES,
+    ):
+        self.embedding_model = embedding_model
+        self.vectorstore = vectorstore
+        self.supabase_client = supabase_client
+        self.uploader = uploader or EmbeddingUploader(embedding_model)
+        # content addressed vectors shared across users (None = always call the embedding API)
+        self.chunk_store = chunk_store
+        self.batch_size = batch_size
+        self.embed_workers = self.uploader.max_in_flight
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        # "process" = large pdfs are extracted in page ranges by a process pool (src/ingestion/pdf_parser.py)
+        if parse_backend not in ("process", "thread"):
+            raise ValueError(f"Unknown parse_backend '{parse_backend}', expected 'process' or 'thread'")
+        self.parse_backend = parse_backend
+        self.parse_processes = parse_processes
+        self.documents_token_count = True  # False once an insert found no documents.token_count column
+
+    # ------------------------- stage 1: parse + split (thread, large pdfs: process pool) -------------------------
+    def _produce(self, path, user_id, doc_id, embed_queue, loop, stop, stats):
+        """
+        Runs in a worker thread: parse page by page, split each page, push full batches to embed_queue.
+        Blocks when embed_queue is full (backpressure) and gives up when `stop` is set (another stage failed).
+        """
+        def put(item):
+            future = asyncio.run_coroutine_threadsafe(embed_queue.put(item), loop)
+            while True:
+                try:
+                    return future.result(timeout=0.5)
+                except TimeoutError:
+                    if stop.is_set():
+                        future.cancel()
+                        raise _Stopped()
+
+        start = time.perf_counter()
+        file_name = os.path.basename(path)
+        try:
+            self._split_pages(path, user_id, doc_id, file_name, put, stop, stats)
+        except _Stopped:
+            return
+        stats.parse_s = time.perf_counter() - start
+
+    def _iter_pages(self, path, stop):
+        """yields (page metadata, chunk texts of that page) in page order"""
+        if self.parse_backend == "process":
+            total_pages = pdf_parser.count_pages(path)
+            if total_pages >= pdf_parser.PDF_PARSE_MIN_PAGES:
+                print(f"Parsing {total_pages} pages with {self.parse_processes} processes")
+                for page in pdf_parser.iter_pages_parallel(
+                    path, total_pages, self.chunk_size, self.chunk_overlap, stop, processes=self.parse_processes
+                ):
+                    metadata = {
+                        "source": path,
+                        "total_pages": page["total_pages"],
+                        "page": page["page"],
+                        "page_label": page["page_label"],
+                    }
+                    yield metadata, page["chunks"]
+                return
+
+        # small pdf (or thread backend): parse here page by page
+        for page in PyPDFLoader(path).lazy_load():
+            yield page.metadata, self.splitter.split_text(page.page_content)
+
+    def _split_pages(self, path, user_id, doc_id, file_name, put, stop, stats):
+        batch = []
+        batch_tokens = []  # token count per chunk of the batch
+        chunk_index = 0
+        max_batch_tokens = self.uploader.max_batch_tokens
+        # same splitting as before: every page is split separately
+        for page_metadata, texts in self._iter_pages(path, stop):
+            if stop.is_set():
+                raise _Stopped()
+            stats.pages += 1
+            for text in texts:
+                # token counting happens here in the parser thread, not on the event loop
+                # the count is also stored with the chunk (context packing budget at query time)
+                tokens = self.uploader.token_counter.count(text)
+                chunk = Document(page_content=text, metadata={
+                    **page_metadata,
+                    "user_id": user_id,
+                    "doc_id": doc_id,
+                    "chunk_index": chunk_index,
+                    "file_name": file_name,
+                    "page": page_metadata.get("page"),
+                    "token_count": tokens
+                })
+                chunk_index += 1
+                stats.chunks = chunk_index  # live progress (read by the ingestion tracker)
+                if batch and sum(batch_tokens) + tokens > max_batch_tokens:
+                    put((batch, batch_tokens))
+                    batch, batch_tokens = [], []
+                batch.append(chunk)
+                batch_tokens.append(tokens)
+                if len(batch) >= self.batch_size:
+                    put((batch, batch_tokens))
+                    batch, batch_tokens = [], []
+        if batch:
+            put((batch, batch_tokens))
+
+    # ------------------------- stage 2: embed (async workers) -------------------------
+    async def _embed_worker(self, embed_queue, write_queue, stats):
+        while True:
+            item = await embed_queue.get()
+            if item is _DONE:
+                return
+            batch, tokens = item
+            start = time.perf_counter()
+            vectors = await self._embed([c.page_content for c in batch], tokens, stats)
+            stats.embed_s += time.perf_counter() - start
+            await write_queue.put((batch, vectors))
+
+    async def _embed(self, texts, tokens, stats):
+        """vectors from the chunk embedding store when possible, the embedding API only for the missing chunks"""
+        if self.chunk_store is None:
+            return await self.uploader.embed_batch(texts, sum(tokens))
+
+        model = self.uploader.model
+        vectors = await run_in_threadpool(self.chunk_store.get_many, model, texts)
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        stats.reused_embeddings += len(texts) - len(missing)
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            new_vectors = await self.uploader.embed_batch(missing_texts, sum(tokens[i] for i in missing))
+            for i, vector in zip(missing, new_vectors):
+                vectors[i] = vector
+            await run_in_threadpool(self.chunk_store.put_many, model, missing_texts, new_vectors)
+        return vectors
+
+    # ------------------------- stage 3: write (vectors + documents rows, batch by batch) -------------------------
+    def _write_batch(self, batch, vectors, user_id, doc_id, vector_ids, row_batches):
+        """stores the vectors then the documents rows of one batch (ids / chunk indexes recorded for the cleanup)"""
+        ids = self.vectorstore.add_embeddings(
+            texts=[c.page_content for c in batch],
+            embeddings=vectors,
+            metadatas=[c.metadata for c in batch],
+        )
+        vector_ids.extend(ids)
+        rows = [{
+            "user_id": user_id,
+            "doc_id": doc_id,
+            "chunk_index": c.metadata["chunk_index"],
+            "file_name": c.metadata["file_name"],
+            "page": c.metadata.get("page"),
+            "content": c.page_content,
+            "token_count": c.metadata.get("token_count"),
+        } for c in batch]
+        self._insert_rows(rows)
+        row_batches.append([row["chunk_index"] for row in rows])
+
+    def _insert_rows(self, rows):
+        """one insert per batch (a single statement: all rows of the batch or none)"""
+        try:
+            if self.documents_token_count:
+                try:
+                    self.supabase_client.table("documents").insert(rows).execute()
+                    return
+                except APIError as e:
+                    if e.code not in _MISSING_COLUMN or "token_count" not in (e.message or ""):
+                        raise
+                    # the pdf is still ingested, context packing counts these chunks on the fly
+                    print(f"WARNING: documents.token_count is missing ({e.code}), apply the migration in "
+                          "docs/database.md — inserting the chunks without it")
+                    self.documents_token_count = False
+            rows = [{k: v for k, v in row.items() if k != "token_count"} for row in rows]
+            self.supabase_client.table("documents").insert(rows).execute()
+        except APIError as e:
+            if e.code == _UNIQUE_VIOLATION:
+                raise _DuplicateIngestion() from e
+            raise
+
+    async def _writer(self, write_queue, user_id, doc_id, stats, vector_ids, row_batches):
+        while True:
+            item = await write_queue.get()
+            if item is _DONE:
+                return
+            batch, vectors = item
+            start = time.perf_counter()
+            await run_in_threadpool(self._write_batch, batch, vectors, user_id, doc_id, vector_ids, row_batches)
+            stats.write_s += time.perf_counter() - start
+            stats.batches += 1
+            stats.chunks_written += len(batch)
+
+    def _delete_written(self, vector_ids, row_batches, user_id, doc_id):
+        """best effort: documents rows then vectors written by a failed / duplicate ingestion"""
+        deleted_rows = 0
+        try:
+            for chunk_indexes in row_batches:
+                (self.supabase_client.table("documents").delete()
+                    .eq("user_id", user_id).eq("doc_id", doc_id).in_("chunk_index", chunk_indexes).execute())
+                deleted_rows += len(chunk_indexes)
+            if row_batches:
+                print(f"Deleted {deleted_rows} documents rows of doc_id {doc_id}")
+        except Exception as e:
+            print(f"Could not delete the documents rows of doc_id {doc_id} ({deleted_rows} deleted): {e}")
+        self._delete_vectors(vector_ids, doc_id)
+
+    def _delete_vectors(self, vector_ids, doc_id):
+        """best effort: vectors of a failed / duplicate ingestion"""
+        if not vector_ids:
+            return
+        try:
+            self.vectorstore.delete(ids=vector_ids)
+            print(f"Deleted {len(vector_ids)} vectors of doc_id {doc_id}")
+        except Exception as e:
+            print(f"Could not delete {len(vector_ids)} vectors of doc_id {doc_id}: {e}")
+
+    # ------------------------- orchestration -------------------------
+    async def run(self, path: str, user_id: str, doc_id: str, stats: IngestionStats | None = None) -> IngestionStats:
+        stats = stats if stats is not None else IngestionStats()
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        stop = threading.Event()
+        embed_queue = asyncio.Queue(maxsize=self.queue_size)
+        write_queue = asyncio.Queue(maxsize=self.queue_size)
+
+        async def guarded(coro):
+            # if any stage fails, tell the parser thread to exit instead of waiting on a full queue
+            try:
+                return await coro
+            except BaseException:
+                stop.set()
+                raise
+
+        async def produce():
+            await run_in_threadpool(self._produce, path, user_id, doc_id, embed_queue, loop, stop, stats)
+            for _ in range(self.embed_workers):
+                await embed_queue.put(_DONE)
+
+        async def embed():
+            async with asyncio.TaskGroup() as workers:
+                for _ in range(self.embed_workers):
+                    workers.create_task(self._embed_worker(embed_queue, write_queue, stats))
+            await write_queue.put(_DONE)
+
+        vector_ids, row_batches = [], []
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(produce())
+                tg.create_task(guarded(embed()))
+                tg.create_task(guarded(self._writer(write_queue, user_id, doc_id, stats, vector_ids, row_batches)))
+        except BaseException as e:
+            await asyncio.shield(run_in_threadpool(self._delete_written, vector_ids, row_batches, user_id, doc_id))
+            duplicate = isinstance(e, BaseExceptionGroup) and e.split(_DuplicateIngestion)[1] is None
+            if not duplicate:
+                raise
+            print(f"doc_id {doc_id} is being ingested by another request — this run stopped")
+
+        stats.wall_s = time.perf_counter() - start
+        # ru_maxrss is in KB on linux (process wide peak, not only this ingestion)
+        stats.peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"Ingestion stats for {doc_id}: {stats.as_dict()}")
+        return stats
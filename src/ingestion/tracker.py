@@ -0,0 +1,89 @@
+import os
+import time
+import asyncio
+import weakref
+import threading
+
+
+# ============================ MULTI DOCUMENT INGESTION ============================
+# document_ingestion used to ingest only doc_ids[0]. Now every pending doc of the graph run gets its own task,
+# but at most INGEST_MAX_CONCURRENT_DOCS documents are ingested at the same time in this process
+# (each document already runs several embedding batches in parallel, see src/ingestion/embedder.py).
+#
+# Status of every document (queued → running → completed / failed) with live progress (pages, chunks, chunks written)
+# is kept here so the frontend can poll GET /ingestion_status while a background ingestion runs.
+
+INGEST_MAX_CONCURRENT_DOCS = int(os.environ.get("INGEST_MAX_CONCURRENT_DOCS", "2"))
+INGEST_STATUS_TTL_S = int(os.environ.get("INGEST_STATUS_TTL_S", "3600"))  # finished statuses are forgotten after this
+
+
+class IngestionTracker:
+    def __init__(self, max_concurrent_docs: int = INGEST_MAX_CONCURRENT_DOCS, status_ttl_s: int = INGEST_STATUS_TTL_S):
+        if max_concurrent_docs < 1:
+            raise ValueError("max_concurrent_docs must be >= 1")
+        self.max_concurrent_docs = max_concurrent_docs
+        self.status_ttl_s = status_ttl_s
+        self._status: dict[tuple[str, str], dict] = {}  # (user_id, doc_id) -> status
+        self._lock = threading.Lock()
+        # one semaphore per event loop (asyncio primitives are bound to the loop they are used in)
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_concurrent_docs)
+        return semaphore
+
+    def _update(self, user_id: str, doc_id: str, **fields):
+        with self._lock:
+            self._status.setdefault((user_id, doc_id), {"doc_id": doc_id}).update(fields)
+
+    def _forget_expired(self):
+        now = time.time()
+        with self._lock:
+            for key, status in list(self._status.items()):
+                finished_at = status.get("finished_at")
+                if finished_at and now - finished_at > self.status_ttl_s:
+                    del self._status[key]
+
+    async def run(self, user_id: str, doc_id: str, ingest, stats):
+        """
+        Run `ingest()` (a coroutine function) for one document once a global slot is free.
+        `stats` is the live IngestionStats of that run, read for the progress.
+        """
+        self._forget_expired()
+        self._update(user_id, doc_id, status="queued", error=None, stats=stats,
+                     queued_at=time.time(), started_at=None, finished_at=None)
+        async with self._semaphore():
+            self._update(user_id, doc_id, status="running", started_at=time.time())
+            try:
+                result = await ingest()
+            except BaseException as e:
+                self._update(user_id, doc_id, status="failed", error=str(e) or e.__class__.__name__, finished_at=time.time())
+                raise
+            self._update(user_id, doc_id, status="completed", finished_at=time.time())
+            return result
+
+    def get(self, user_id: str, doc_ids: list[str] | None = None) -> dict[str, dict]:
+        """doc_id -> status (+ progress) for this user's documents"""
+        with self._lock:
+            items = [
+                dict(status) for (uid, doc_id), status in self._status.items()
+                if uid == user_id and (doc_ids is None or doc_id in doc_ids)
+            ]
+        result = {}
+        for status in items:
+            stats = status.pop("stats", None)
+            if stats is not None:
+                status["progress"] = {
+                    "pages": stats.pages,
+                    "chunks": stats.chunks,
+                    "chunks_written": stats.chunks_written,
+                }
+            result[status["doc_id"]] = status
+        return result
+
+
+# process wide tracker (the concurrency cap is global for this worker)
+ingestion_tracker = IngestionTracker()
@@ -53,6 +53,16 @@ def get_prompt_template(custom_prompt: str) -> str:
     return template
 
 
+def resolve_prompt_template(custom_prompt: str | None) -> str:
+    """
+    Effective template for a request: the user's custom prompt if set, else the default.
+    (also used to key the answer cache so answers of different prompts never mix)
+    """
+    if custom_prompt:
+        return get_prompt_template(custom_prompt)
+    return DEFAULT_PROMPT_TEMPLATE
+
+
 # # Backward compatibility - keep PROMPT_TEMPLATE for existing code
 # PROMPT_TEMPLATE = DEFAULT_PROMPT_TEMPLATE
 
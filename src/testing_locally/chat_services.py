@@ -4,7 +4,7 @@ import os
 from langgraph.checkpoint.postgres import PostgresSaver
 from langchain_core.messages import HumanMessage
 
-from src.utils.file_hash import get_file_hash
+from src.utils.file_hash import get_file_hash, HASH_CHUNK_SIZE
 from src.graph.builder import GraphBuilder
 from src.db_connection.connection import CONNECTION_STRING
 
@@ -18,7 +18,7 @@ if __name__ == "__main__":
         raise FileNotFoundError("File is not found")
     
     # Generate unique doc_id for PDF
-    doc_id = get_file_hash(file_path)
+    doc_id = get_file_hash(file_path, chunk_size=HASH_CHUNK_SIZE)  # chunked: big statutes are not loaded in memory
 
     # Create a collection name based on file name
     collection_name = (os.path.splitext(os.path.basename(file_path))[0].lower().replace(" ", "_"))
@@ -0,0 +1,134 @@
+"""
+CPU per streamed answer: one SSE frame per token (old stream_graph) vs coalesced frames (TokenCoalescer).
+
+No OpenAI / database: a fake graph replays astream_events v2 shaped events (node events + one
+on_chat_model_stream per token with a small gap between tokens) and every frame is written to a real
+socket like uvicorn does, so the syscall per frame is part of the measurement.
+
+    python -m src.testing_locally.stream_benchmark --streams 200 --tokens 400 --gap-ms 5
+"""
+import io
+import os
+import json
+import time
+import socket
+import asyncio
+import argparse
+import contextlib
+from types import SimpleNamespace
+
+from backend.services.streaming import stream_graph, STREAM_FLUSH_INTERVAL_MS, STREAM_FLUSH_BYTES
+
+
+class FakeGraph:
+    """astream_events v2 shaped events of one answer"""
+
+    def __init__(self, tokens: int, gap_s: float, node_events: int = 40):
+        self.tokens = tokens
+        self.gap_s = gap_s
+        self.node_events = node_events  # retriever / grader / rewriter events around the answer
+
+    async def astream_events(self, state, config=None, version="v2"):
+        for i in range(self.node_events):
+            yield {"event": "on_chain_start" if i % 2 == 0 else "on_chain_end", "data": {},
+                   "metadata": {"langgraph_node": "retriever"}}
+        for i in range(self.tokens):
+            if self.gap_s:
+                await asyncio.sleep(self.gap_s)
+            yield {"event": "on_chat_model_stream", "data": {"chunk": SimpleNamespace(content=f" tok{i % 97}")},
+                   "metadata": {"langgraph_node": "agent_response"}}
+        yield {"event": "on_chain_end", "data": {"output": {"token_usage": {"total_tokens": self.tokens}}},
+               "metadata": {"langgraph_node": "agent_response"}}
+
+
+async def legacy_stream(graph, state, config):
+    """the per token loop stream_graph used before coalescing (json.dumps + frame + sleep(0) per token)"""
+    yield f"data: {json.dumps({'type': 'thread_created', 'thread_id': 't'})}\n\n"
+    async for event in graph.astream_events(state, config=config, version="v2"):
+        node = event.get("metadata", {}).get("langgraph_node")
+        if event["event"] == "on_chat_model_stream" and node == "agent_response":
+            chunk = event.get("data", {}).get("chunk")
+            if chunk and getattr(chunk, "content", None):
+                yield f"data: {json.dumps({'token': chunk.content})}\n\n"
+                await asyncio.sleep(0)
+    yield f"data: {json.dumps({'type': 'done'})}\n\n"
+
+
+async def coalesced_stream(graph, state, config, flush_interval_ms, flush_bytes):
+    response = await stream_graph(graph, state, config, thread_id="t",
+                                  flush_interval_ms=flush_interval_ms, flush_bytes=flush_bytes)
+    async for frame in response.body_iterator:
+        yield frame
+
+
+async def drain(reader):
+    while await reader.read(65536):
+        pass
+
+
+async def one_answer(make_stream, stats):
+    # a real socket per stream: each frame = one transport write, like uvicorn's send()
+    a, b = socket.socketpair()
+    reader, reader_side = await asyncio.open_connection(sock=b)  # keep both writers: a collected StreamWriter closes its socket
+    _, writer = await asyncio.open_connection(sock=a)
+    drainer = asyncio.create_task(drain(reader))
+    ttft = None
+    start = time.perf_counter()
+    async for frame in make_stream():
+        data = frame if isinstance(frame, bytes) else frame.encode("utf-8")
+        if ttft is None and b'"token"' in data:
+            ttft = time.perf_counter() - start
+        writer.write(data)
+        await writer.drain()
+        stats["frames"] += 1
+        stats["bytes"] += len(data)
+    writer.close()
+    await drainer
+    reader_side.close()
+    stats["ttft"].append(ttft or 0.0)
+
+
+async def run(mode: str, args) -> dict:
+    graph = FakeGraph(args.tokens, args.gap_ms / 1000)
+    config = {"configurable": {"thread_id": "t"}}
+    stats = {"frames": 0, "bytes": 0, "ttft": []}
+
+    if mode == "per_token":
+        make_stream = lambda: legacy_stream(graph, {}, config)
+    else:
+        make_stream = lambda: coalesced_stream(graph, {}, config, args.flush_ms, args.flush_bytes)
+
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    await asyncio.gather(*(one_answer(make_stream, stats) for _ in range(args.streams)))
+    cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+
+    ttft = sorted(stats["ttft"])
+    return {
+        "mode": mode,
+        "cpu_ms_per_answer": round(cpu * 1000 / args.streams, 2),
+        "frames_per_answer": round(stats["frames"] / args.streams, 1),
+        "bytes_per_answer": stats["bytes"] // args.streams,
+        "ttft_ms_p50": round(ttft[len(ttft) // 2] * 1000, 2),
+        "wall_s": round(wall, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=200, help="concurrent streamed answers")
+    parser.add_argument("--tokens", type=int, default=400, help="tokens per answer")
+    parser.add_argument("--gap-ms", type=float, default=5, help="time between two model tokens")
+    parser.add_argument("--flush-ms", type=float, default=STREAM_FLUSH_INTERVAL_MS)
+    parser.add_argument("--flush-bytes", type=int, default=STREAM_FLUSH_BYTES)
+    args = parser.parse_args()
+
+    print(f"{args.streams} streams x {args.tokens} tokens, gap {args.gap_ms} ms, "
+          f"flush {args.flush_ms} ms / {args.flush_bytes} bytes, pid {os.getpid()}")
+    for mode in ("per_token", "coalesced"):
+        with contextlib.redirect_stdout(io.StringIO()):  # stream_graph progress prints
+            result = asyncio.run(run(mode, args))
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Event rate + CPU per answer: astream_events v2 (old stream_graph source) vs stream_mode=["messages", "custom"].
+
+No OpenAI / database: a graph with the same shape as GraphBuilder (rewriter LLM → retriever → per doc grader LLMs
+→ context → streamed agent_response → summary LLM) runs on fake chat models that stream their answer word by word,
+so the other LLM calls produce the same kind of side events as in production.
+
+    python -m src.testing_locally.stream_modes_benchmark --answers 50 --tokens 300 --graded-docs 5
+"""
+import io
+import re
+import time
+import asyncio
+import argparse
+import itertools
+import contextlib
+from typing import Annotated, TypedDict
+
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from langchain_core.outputs import ChatGenerationChunk
+from langgraph.graph import StateGraph, START, END, add_messages
+
+from src.graph.nodes import emit_stream_event
+from src.graph.builder import no_stream
+from backend.services.streaming import stream_graph, _graph_stream_events, _graph_stream_modes
+
+
+class BenchState(TypedDict, total=False):
+    messages: Annotated[list, add_messages]
+    rewritten_query: str
+    docs: list
+    context: str
+    token_usage: dict
+    summary: str
+
+
+class FakeStreamingChat(GenericFakeChatModel):
+    """GenericFakeChatModel with a native async stream (the default one hops to a thread for every chunk)"""
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        text = next(self.messages).content
+        for token in re.split(r"(\s)", text):
+            if not token:
+                continue
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+
+def fake_llm(text: str) -> FakeStreamingChat:
+    return FakeStreamingChat(messages=itertools.cycle([AIMessage(content=text)]))
+
+
+def build_graph(tokens: int, graded_docs: int):
+    answer = " ".join(f"word{i % 89}" for i in range(tokens))
+    rewriter, grader, agent, summarizer = (fake_llm(text) for text in
+                                           ("standalone question about section 302", "yes", answer, "summary " * 40))
+
+    async def query_rewriter(state):
+        response = await rewriter.ainvoke(state["messages"])
+        return {"rewritten_query": response.content}
+
+    async def retriever(state):
+        return {"docs": [f"chunk {i} " * 50 for i in range(graded_docs)]}
+
+    async def retrieval_grader(state):
+        await asyncio.gather(*(grader.ainvoke([HumanMessage(content=doc)]) for doc in state["docs"]))
+        return {}
+
+    async def context_builder(state):
+        return {"context": "\n\n".join(state["docs"])}
+
+    async def agent_response(state):
+        response = await agent.ainvoke([HumanMessage(content=state["context"])])
+        usage = {"total_tokens": tokens, "prompt_tokens": 0, "completion_tokens": tokens}
+        emit_stream_event({"token_usage": usage})
+        return {"messages": [AIMessage(content=response.content)], "token_usage": usage}
+
+    async def summarize(state):
+        response = await summarizer.ainvoke(state["messages"])
+        emit_stream_event({"summary": response.content})
+        return {"summary": response.content}
+
+    workflow = StateGraph(BenchState)
+    # same no_stream wrapping as GraphBuilder (skipped by the messages stream mode, not by astream_events)
+    for name, node in [("query_rewriter", no_stream(query_rewriter, "query_rewriter")), ("retriever", retriever),
+                       ("retrieval_grader", no_stream(retrieval_grader, "retrieval_grader")), ("context_builder", context_builder),
+                       ("agent_response", agent_response), ("summarize", no_stream(summarize, "summarize"))]:
+        workflow.add_node(name, node)
+    workflow.add_edge(START, "query_rewriter")
+    workflow.add_edge("query_rewriter", "retriever")
+    workflow.add_edge("retriever", "retrieval_grader")
+    workflow.add_edge("retrieval_grader", "context_builder")
+    workflow.add_edge("context_builder", "agent_response")
+    workflow.add_edge("agent_response", "summarize")
+    workflow.add_edge("summarize", END)
+    return workflow.compile()
+
+
+async def count_items(source, graph) -> dict:
+    """raw items the consumer has to look at for ONE answer"""
+    counts = {"items": 0, "token": 0, "token_usage": 0, "summary": 0}
+    async for kind, _ in source(graph, {"messages": [HumanMessage(content="what about that?")]}, {}):
+        counts["items"] += 1
+        if kind in counts:
+            counts[kind] += 1
+    return counts
+
+
+async def answer(graph, source_name: str) -> tuple[int, dict]:
+    captured = {}
+
+    async def on_complete(final_answer, final_state):
+        captured.update(final_state, answer=final_answer)
+
+    response = await stream_graph(graph, {"messages": [HumanMessage(content="what about that?")]}, {},
+                                  on_complete, stream_source=source_name)
+    frames = 0
+    async for _ in response.body_iterator:
+        frames += 1
+    return frames, captured
+
+
+async def run(source_name: str, args) -> dict:
+    graph = build_graph(args.tokens, args.graded_docs)
+    source = _graph_stream_modes if source_name == "modes" else _graph_stream_events
+    counts = await count_items(source, graph)
+
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    results = await asyncio.gather(*(answer(graph, source_name) for _ in range(args.answers)))
+    cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+
+    _, captured = results[0]
+    return {
+        "source": source_name,
+        "items_per_answer": counts["items"],
+        "tokens_per_answer": counts["token"],
+        "items_per_token": round(counts["items"] / max(counts["token"], 1), 2),
+        "cpu_ms_per_answer": round(cpu * 1000 / args.answers, 2),
+        "wall_s": round(wall, 2),
+        "token_usage_captured": "token_usage" in captured,
+        "summary_captured": "summary" in captured,
+        "answer_words": len(captured.get("answer", "").split()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--answers", type=int, default=50, help="concurrent answers")
+    parser.add_argument("--tokens", type=int, default=300, help="words in the streamed answer")
+    parser.add_argument("--graded-docs", type=int, default=5, help="grader LLM calls (per_doc CRAG grading)")
+    args = parser.parse_args()
+
+    print(f"{args.answers} answers x {args.tokens} tokens, {args.graded_docs} grader calls")
+    for source_name in ("events", "modes"):
+        with contextlib.redirect_stdout(io.StringIO()):  # stream_graph progress prints
+            result = asyncio.run(run(source_name, args))
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
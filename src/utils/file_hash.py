@@ -1,5 +1,8 @@
 import hashlib
-def get_file_hash(file_path: str) -> str:
+
+HASH_CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+def get_file_hash(file_path: str, chunk_size: int | None = None) -> str:
     """
     It reads a file (like a PDF) and generates a SHA-256 hash,
       which is a fixed-length unique string representing the file’s content.
@@ -7,10 +10,17 @@ def get_file_hash(file_path: str) -> str:
     If:
     The file content is exactly the same → hash is the same
     Even 1 byte changes → hash is completely different
+
+    chunk_size=None → whole file is read at once
+    chunk_size=N    → file is read N bytes at a time (memory stays at N bytes, same hash)
     """
     hasher = hashlib.sha256()
     with open(file_path, "rb") as f:
-        hasher.update(f.read())
+        if chunk_size is None:
+            hasher.update(f.read())
+        else:
+            while chunk := f.read(chunk_size):
+                hasher.update(chunk)
     return hasher.hexdigest()
 
 # get_file_hash() reads the entire file content and produces a SHA-256 hash.
@@ -0,0 +1,44 @@
+import re
+import unittest
+
+from src.cache.answer_cache import AnswerCache, query_anchors
+
+
+class WordEmbeddings:
+    """bag of words without digits: "section 420" and "section 421" get the SAME vector (worst case for the cache)"""
+
+    async def aembed_query(self, text: str):
+        words = re.findall(r"[a-z]+", text.lower())
+        return [float(sum(1 for w in words if hash(w) % 16 == i)) for i in range(16)]
+
+
+class QueryAnchorsTest(unittest.TestCase):
+    def test_abbreviations_are_normalized(self):
+        self.assertEqual(query_anchors("What does Sec. 420 say?"), query_anchors("what does section 420 say"))
+        self.assertEqual(query_anchors("Art. 25A"), frozenset({"article 25a", "25a"}))
+
+    def test_no_anchor(self):
+        self.assertEqual(query_anchors("punishment for false evidence"), frozenset())
+
+
+class AnswerCacheAnchorTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.cache = AnswerCache(WordEmbeddings(), similarity_threshold=0.95)
+        await self.cache.store(["doc"], "tpl", "punishment under section 420 PPC", "cheating answer")
+
+    async def test_other_section_is_a_miss(self):
+        answer, _ = await self.cache.lookup(["doc"], "tpl", "punishment under section 421 PPC")
+        self.assertIsNone(answer)
+
+    async def test_same_section_is_a_hit(self):
+        answer, similarity = await self.cache.lookup(["doc"], "tpl", "Punishment under section 420 PPC?")
+        self.assertEqual(answer, "cheating answer")
+        self.assertGreaterEqual(similarity, 0.95)
+
+    async def test_question_without_the_section_is_a_miss(self):
+        answer, _ = await self.cache.lookup(["doc"], "tpl", "punishment under PPC")
+        self.assertIsNone(answer)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+from langchain_core.documents import Document
+
+from src.graph.grader import BatchGrades, DocumentGrade, LocalRelevanceGrader
+
+QUERY = "punishment for cheating under section 420"
+
+RELEVANT = Document(
+    page_content="Section 420. Cheating and dishonestly inducing delivery of property: punishment of imprisonment "
+                 "which may extend to seven years.",
+    metadata={"bm25_score": 12.0, "dense_score": 0.62},
+)
+IRRELEVANT = Document(
+    page_content="The President shall be elected by the members of an electoral college.",
+    metadata={"bm25_score": 0.0, "dense_score": 0.12},
+)
+# half of the query terms and middling retrieval scores
+BORDERLINE = Document(
+    page_content="Punishment for cheating by personation is described in the next chapter.",
+    metadata={"bm25_score": 2.0, "dense_score": 0.3},
+)
+
+
+class FakeGradingLLM:
+    """stands in for the chat model: answers the batched structured-output call, counts the docs it was asked about"""
+
+    def __init__(self, relevant: bool):
+        self.relevant = relevant
+        self.graded_docs = 0
+
+    def with_structured_output(self, schema):
+        return self
+
+    async def ainvoke(self, messages):
+        count = messages[0].content.count("[Document ")
+        self.graded_docs += count
+        return BatchGrades(grades=[DocumentGrade(index=i, relevant=self.relevant) for i in range(count)])
+
+
+class LocalGraderTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.grader = LocalRelevanceGrader(relevant_threshold=0.5, irrelevant_threshold=0.3)
+
+    def test_scores_are_ordered(self):
+        relevant, borderline, irrelevant = (self.grader.score(QUERY, d) for d in (RELEVANT, BORDERLINE, IRRELEVANT))
+        self.assertGreaterEqual(relevant, 0.5)
+        self.assertLess(irrelevant, 0.3)
+        self.assertTrue(0.3 <= borderline < 0.5, borderline)
+
+    def test_missing_signals_are_skipped(self):
+        doc = Document(page_content=RELEVANT.page_content)  # found by neither score source: coverage only
+        self.assertEqual(self.grader.score(QUERY, doc), self.grader.signals(QUERY, doc)["coverage"])
+
+    async def test_clear_docs_never_reach_the_llm(self):
+        llm = FakeGradingLLM(relevant=False)
+        verdicts, borderline = await self.grader.grade(QUERY, [RELEVANT, IRRELEVANT], llm=llm)
+        self.assertEqual(verdicts, [True, False])
+        self.assertEqual(borderline, 0)
+        self.assertEqual(llm.graded_docs, 0)
+
+    async def test_borderline_doc_is_asked_to_the_llm(self):
+        llm = FakeGradingLLM(relevant=True)
+        verdicts, borderline = await self.grader.grade(QUERY, [RELEVANT, BORDERLINE, IRRELEVANT], llm=llm)
+        self.assertEqual(verdicts, [True, True, False])
+        self.assertEqual(borderline, 1)
+        self.assertEqual(llm.graded_docs, 1)
+
+    async def test_borderline_without_llm_uses_the_midpoint(self):
+        score = self.grader.score(QUERY, BORDERLINE)
+        verdicts, borderline = await self.grader.grade(QUERY, [BORDERLINE])
+        self.assertEqual(borderline, 1)
+        self.assertEqual(verdicts, [score >= 0.4])
+
+
+if __name__ == "__main__":
+    unittest.main()